@@ -0,0 +1,203 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+"""
+Benchmarks for template compilation, rendering and the template steps.
+Each benchmark returns a dictionary of measurements; times are in
+seconds and are the median of the repeated runs.
+"""
+import copy
+import statistics
+from time import perf_counter
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from quartet_capture.models import Rule, Task
+from quartet_capture.rules import RuleContext
+from quartet_output.steps import ContextKeys
+from EPCPyYes.core.v1_2 import template_events
+from quartet_templates.cache import get_environment, compile_template, \
+    template_cache
+from quartet_templates.models import Template
+from quartet_templates.steps import TemplateStep, ChangeTemplatesStep
+
+BENCHMARKS = {}
+
+SMALL_TEMPLATE = '''<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">
+   <soapenv:Header/>
+   <soapenv:Body>
+      <ids>
+      {% for serial_number in data %}
+         <id>{{ serial_number }}</id>
+      {% endfor %}
+      </ids>
+      <uuid>{{ UUID }}</uuid>
+   </soapenv:Body>
+</soapenv:Envelope>
+'''
+
+EVENT_TEMPLATE = '''<ObjectEvent>
+    <eventTime>{{ event.event_time }}</eventTime>
+    <epcList>
+    {% for epc in event.epc_list %}
+        <epc>{{ epc }}</epc>
+    {% endfor %}
+    </epcList>
+    <action>{{ event.action }}</action>
+</ObjectEvent>
+'''
+
+
+def large_template(size: int = 2 * 1024 * 1024) -> str:
+    """
+    Builds an EPCIS sized template of roughly `size` characters with a
+    large static body and a loop over the data.
+    """
+    vocabulary = '''    <VocabularyElement id="urn:epc:id:sgln:0614141.00001.{{ index }}">
+        <attribute id="urn:epcglobal:cbv:mda#name">Location {{ index }}</attribute>
+        <attribute id="urn:epcglobal:cbv:mda#streetAddressOne">100 Main Street</attribute>
+    </VocabularyElement>
+'''
+    static = '''    <VocabularyElement id="urn:epc:id:sgln:0614141.00002.0">
+        <attribute id="urn:epcglobal:cbv:mda#name">Static Location</attribute>
+    </VocabularyElement>
+'''
+    parts = ['<epcis:EPCISDocument>\n<EPCISHeader>\n']
+    length = 0
+    index = 0
+    while length < size:
+        part = (vocabulary.replace('{{ index }}', str(index))
+                if index % 10 == 0 else static)
+        parts.append(part)
+        length += len(part)
+        index += 1
+    parts.append('</EPCISHeader>\n<EventList>\n'
+                 '{% for serial_number in data %}'
+                 '<epc>{{ serial_number }}</epc>\n{% endfor %}'
+                 '</EventList>\n</epcis:EPCISDocument>\n')
+    return ''.join(parts)
+
+
+def benchmark(name: str):
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+def measure(function, repeat: int) -> float:
+    """
+    Runs the function `repeat` times and returns the median run time.
+    """
+    times = []
+    for i in range(repeat):
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+    return statistics.median(times)
+
+
+def compile_and_render(name: str, content: str, data: list,
+                       repeat: int) -> dict:
+    environment = get_environment()
+    compiled = compile_template(environment, name, content)
+    return {
+        'compile_seconds': measure(
+            lambda: compile_template(environment, name, content), repeat),
+        'render_seconds': measure(
+            lambda: compiled.render(data=data, UUID='uuid'), repeat),
+        'output_characters': len(compiled.render(data=data, UUID='uuid')),
+    }
+
+
+@benchmark('small_template')
+def small_template(options: dict) -> dict:
+    data = ['urn:epc:id:sgtin:0614141.107346.%s' % i for i in range(100)]
+    return compile_and_render('Small Template', SMALL_TEMPLATE, data,
+                              options['repeat'])
+
+
+@benchmark('large_template')
+def large_template_benchmark(options: dict) -> dict:
+    data = ['urn:epc:id:sgtin:0614141.107346.%s' % i for i in range(10000)]
+    content = large_template()
+    result = compile_and_render('Large Template', content, data,
+                                max(1, options['repeat'] // 5))
+    result['template_characters'] = len(content)
+    return result
+
+
+@benchmark('template_step')
+def template_step(options: dict) -> dict:
+    """
+    Runs the TemplateStep end to end, including the template lookup, task
+    parameters and task messages, and counts its queries.
+    """
+    Template.objects.update_or_create(name='Benchmark Template', defaults={
+        'content': SMALL_TEMPLATE, 'description': 'Benchmark template'})
+    rule = Rule.objects.create(name='Benchmark Rule')
+    task = Task.objects.create(rule=rule, status='RUNNING')
+    data = ['urn:epc:id:sgtin:0614141.107346.%s' % i for i in range(100)]
+
+    def execute():
+        step = TemplateStep(task, **{'Template Name': 'Benchmark Template',
+                                     'Context Key': 'OUTPUT'})
+        step.execute(data, RuleContext(rule.name, task.name))
+
+    execute()
+    with CaptureQueriesContext(connection) as queries:
+        execute()
+    return {
+        'queries': len(queries.captured_queries),
+        'seconds': measure(execute, options['repeat']),
+    }
+
+
+def change_templates(count: int, options: dict) -> dict:
+    Template.objects.update_or_create(name='Benchmark Event', defaults={
+        'content': EVENT_TEMPLATE, 'description': 'Benchmark event'})
+    rule = Rule.objects.create(name='Benchmark Rule %s' % count)
+    task = Task.objects.create(rule=rule, status='RUNNING')
+    event = template_events.ObjectEvent(
+        epc_list=['urn:epc:id:sgtin:0614141.107346.1'])
+    events = [copy.copy(event) for i in range(count)]
+    rule_context = RuleContext(rule.name, task.name, context={
+        ContextKeys.OBJECT_EVENTS_KEY.value: events})
+
+    def execute():
+        step = ChangeTemplatesStep(task, **{
+            'Object Event Template': 'Benchmark Event'})
+        step.execute(None, rule_context)
+
+    template_cache.clear()
+    with CaptureQueriesContext(connection) as queries:
+        execute()
+    return {
+        'events': count,
+        'queries': len(queries.captured_queries),
+        'seconds': measure(execute, max(1, options['repeat'] // 5)),
+        'render_seconds_per_event': measure(events[0].render,
+                                            options['repeat']),
+    }
+
+
+@benchmark('change_templates_10k')
+def change_templates_10k(options: dict) -> dict:
+    return change_templates(10000, options)
+
+
+@benchmark('change_templates_100k')
+def change_templates_100k(options: dict) -> dict:
+    return change_templates(100000, options)
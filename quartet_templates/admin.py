@@ -1,6 +1,16 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from quartet_templates import models
 
+
+class TemplateChangeList(ChangeList):
+    '''
+    Does not load the template content when listing templates.
+    '''
+    def get_queryset(self, request, *args, **kwargs):
+        return super().get_queryset(request, *args, **kwargs).defer('content')
+
+
 @admin.register(models.Template)
 class TemplateAdmin(admin.ModelAdmin):
     list_display = (
@@ -8,5 +18,8 @@ class TemplateAdmin(admin.ModelAdmin):
         'description'
     )
 
+    def get_changelist(self, request, **kwargs):
+        return TemplateChangeList
+
 def register_to_site(admin_site):
     admin_site.register(models.Template, TemplateAdmin)
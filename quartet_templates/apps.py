@@ -3,4 +3,7 @@ from django.apps import AppConfig
 
 class QuartetTemplatesConfig(AppConfig):
     name = 'quartet_templates'
-    verbose_name = 'QU4RTET Templates'
\ No newline at end of file
+    verbose_name = 'QU4RTET Templates'
+
+    def ready(self):
+        from quartet_templates import signals  # noqa: F401
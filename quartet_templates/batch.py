@@ -0,0 +1,229 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+
+# the compiled template, and render limits, of a pool worker process
+_worker_template = None
+_worker_limits = (None, None)
+# the compiled templates, and default EPCPyYes environment, of an event
+# rendering pool worker process
+_worker_templates = {}
+_worker_environment = None
+
+
+def chunked(iterable, size: int):
+    """
+    Lazily splits an iterable into lists of at most `size` items.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _initialize_worker(name: str, content: str, options: dict,
+                       limits: tuple = (None, None)):
+    """
+    Sets up django in a newly spawned worker process and compiles the
+    template it will render.  Each worker compiles the template once.
+    """
+    global _worker_template, _worker_limits
+    _worker_limits = limits
+    django.setup()
+    from quartet_templates.cache import template_cache
+    from quartet_templates.generation import generation_watcher
+    # the worker only renders the template it was given by content so it
+    # never needs to check for changes made by other processes
+    generation_watcher.interval = None
+    _worker_template = template_cache.get_template(name, content, **options)
+
+
+def _render_chunk(contexts: list) -> list:
+    from quartet_templates.limits import limit_stream
+    timeout, max_size = _worker_limits
+    if not (timeout or max_size):
+        return [_worker_template.render(context) for context in contexts]
+    name = _worker_template.quartet_source[0]
+    return [''.join(limit_stream(name, _worker_template.generate(context),
+                                 timeout, max_size))
+            for context in contexts]
+
+
+def render_in_pool(name: str, content: str, contexts, processes: int,
+                   chunk_size: int = 100, timeout: float = None,
+                   max_size: int = None, **options):
+    """
+    Renders a template against each of the contexts using a pool of
+    worker processes.  The contexts are sent to the workers in chunks and
+    the rendered output is yielded in the same order as the contexts.
+    Only a few chunks per worker are in flight at any time so neither the
+    contexts nor the output are held in memory all at once.  Contexts must
+    be picklable.
+    :param name: The template name.
+    :param content: The template source.
+    :param contexts: An iterable of context dictionaries.
+    :param processes: The number of worker processes.
+    :param chunk_size: The number of contexts sent to a worker at a time.
+    :param timeout: The maximum time in seconds each render may take.
+    :param max_size: The maximum output size in bytes of each render.
+    :param options: The trim_blocks, lstrip_blocks and autoescape options.
+    :return: A generator of rendered strings.
+    """
+    executor = ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_initialize_worker,
+        initargs=(name, content, options, (timeout, max_size))
+    )
+    with executor:
+        yield from _map_in_order(executor, _render_chunk,
+                                 chunked(contexts, chunk_size), processes)
+
+
+def _map_in_order(executor, function, chunks, processes: int):
+    """
+    Submits each chunk to the executor and yields the items of each
+    result in order, keeping at most two chunks per worker in flight.
+    """
+    pending = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(function, chunk))
+        if len(pending) >= processes * 2:
+            yield from pending.popleft().result()
+    while pending:
+        yield from pending.popleft().result()
+
+
+def pack_event(event, key: tuple) -> tuple:
+    """
+    Returns a picklable copy of an EPCPyYes template event.  The event's
+    jinja2 environment and template can not be pickled so they are left
+    out and the template is identified by `key` instead.
+    :param event: An EPCPyYes template event.
+    :param key: The key of the event's template, see render_events_in_pool.
+    :return: A tuple of the event class, template key and event state.
+    """
+    state = {attribute: value for attribute, value in event.__dict__.items()
+             if attribute not in ('_env', '_template', '_context')}
+    context = {name: value for name, value in event._context.items()
+               if value is not event}
+    return type(event), key, state, context
+
+
+def _initialize_event_worker(templates: list, sources: dict = None):
+    """
+    Sets up django in a newly spawned worker process and compiles each of
+    the templates the events it renders use, once.  The quartet templates
+    they include, extend or import are loaded from `sources`, then event
+    templates try the EPCPyYes package templates before the database is
+    queried for a template whose name is only known at render time.
+    """
+    global _worker_environment
+    django.setup()
+    from jinja2.loaders import ChoiceLoader, DictLoader, PackageLoader
+    from EPCPyYes.core.v1_2.template_events import _load_default_environment
+    from quartet_templates.cache import template_cache, get_environment
+    from quartet_templates.loaders import template_loader
+    from quartet_templates.generation import generation_watcher
+    generation_watcher.interval = None
+    _worker_environment = _load_default_environment()
+    source_loader = DictLoader(sources or {})
+    environments = set()
+    for key, name, content, options in templates:
+        if content is None:
+            _worker_templates[key] = _worker_environment.get_template(name)
+            continue
+        environment = get_environment(**options)
+        if id(environment) not in environments:
+            loaders = [source_loader, template_loader]
+            if options.get('event_templates'):
+                loaders.insert(1, PackageLoader('EPCPyYes', 'templates'))
+            environment.loader = ChoiceLoader(loaders)
+            environments.add(id(environment))
+        _worker_templates[key] = template_cache.get_template(
+            name, content, **options)
+
+
+def collect_sources(contents) -> dict:
+    """
+    Returns the content of every quartet template the template sources
+    include, extend or import, directly or through another template, so
+    worker processes do not need to load them from the database.
+    :param contents: The template sources.
+    :return: A dictionary of template content keyed by template name.
+    """
+    from quartet_templates.cache import find_references, get_environment
+    from quartet_templates.models import Template
+    environment = get_environment()
+    sources = {}
+    pending = set()
+    for content in contents:
+        pending |= find_references(environment, content)
+    while pending:
+        found = dict(Template.objects.filter(name__in=pending).values_list(
+            'name', 'content'))
+        sources.update(found)
+        pending = set()
+        for content in found.values():
+            pending |= find_references(environment, content)
+        pending -= set(sources)
+    return sources
+
+
+def _render_event_chunk(events: list) -> list:
+    rendered = []
+    for event_class, key, state, context in events:
+        event = event_class.__new__(event_class)
+        event.__dict__.update(state)
+        event._env = _worker_environment
+        event._template = _worker_templates[key]
+        event._context = dict(context, event=event)
+        rendered.append(event.render())
+    return rendered
+
+
+def render_events_in_pool(templates: list, events, processes: int,
+                          chunk_size: int = 1000):
+    """
+    Renders EPCPyYes template events using a pool of worker processes and
+    yields the output of each event in order.  Each worker compiles each
+    template once.  Templates that are not in the database, i.e.
+    `epcis/event_times.xml`, are included from the EPCPyYes package.
+    :param templates: A list of (key, name, content, options) tuples, one
+    for each template the events use.  If content is None the template is
+    loaded by name from the default EPCPyYes environment, otherwise it is
+    compiled from the content with the environment options.
+    :param events: An iterable of events packed with pack_event.
+    :param processes: The number of worker processes.
+    :param chunk_size: The number of events sent to a worker at a time.
+    :return: A generator of rendered strings.
+    """
+    executor = ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_initialize_event_worker,
+        initargs=(templates, collect_sources(
+            content for _, _, content, _ in templates if content is not None))
+    )
+    with executor:
+        yield from _map_in_order(executor, _render_event_chunk,
+                                 chunked(events, chunk_size), processes)
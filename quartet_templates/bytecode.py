@@ -0,0 +1,190 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import fnmatch
+import os
+from hashlib import sha1
+
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+from jinja2.bccache import Bucket, BytecodeCache, FileSystemBytecodeCache
+
+from quartet_templates.compact import is_compact
+from quartet_templates.limits import LoopBudgetExtension
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+
+class ContentKeyMixin:
+    """
+    Keys bytecode buckets by the template name, the checksum of the
+    template content and the options of the environment that compiled it.
+    The default jinja2 key only uses the template name, which is not safe
+    when several environments share one persistent cache.
+    """
+
+    def get_bucket(self, environment, name: str, filename: str,
+                   source: str) -> Bucket:
+        checksum = self.get_source_checksum(source)
+        parts = [
+            name or '',
+            checksum,
+            str(environment.trim_blocks),
+            str(environment.lstrip_blocks),
+            str(environment.autoescape),
+            str(environment.is_async)
+        ]
+        if is_compact(environment):
+            parts.append('compact')
+        # bytecode compiled before loops checked the render budget
+        # must not be reused
+        if LoopBudgetExtension.identifier in environment.extensions:
+            parts.append('loop_budget')
+        key = sha1('|'.join(parts).encode('utf-8')).hexdigest()
+        bucket = Bucket(environment, key, checksum)
+        self.load_bytecode(bucket)
+        return bucket
+
+
+class DatabaseBytecodeCache(ContentKeyMixin, BytecodeCache):
+    """
+    Stores marshalled template bytecode in the TemplateBytecode table so
+    newly started processes can skip compiling templates that any other
+    process has already compiled.  Once the stored bytecode exceeds
+    `max_size` bytes the least recently used entries are removed.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+
+    def load_bytecode(self, bucket: Bucket):
+        from quartet_templates.models import TemplateBytecode
+        queryset = TemplateBytecode.objects.filter(key=bucket.key)
+        code = queryset.values_list('code', flat=True).first()
+        if code is not None:
+            bucket.bytecode_from_string(bytes(code))
+            queryset.update(last_used=timezone.now())
+
+    def dump_bytecode(self, bucket: Bucket):
+        from quartet_templates.models import TemplateBytecode
+        code = bucket.bytecode_to_string()
+        TemplateBytecode.objects.update_or_create(
+            key=bucket.key,
+            defaults={'code': code, 'size': len(code),
+                      'last_used': timezone.now()}
+        )
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the total size of
+        the stored bytecode is no larger than `max_size`.
+        :return: None
+        """
+        from quartet_templates.models import TemplateBytecode
+        total = TemplateBytecode.objects.aggregate(
+            total=Sum('size'))['total'] or 0
+        if total <= self.max_size:
+            return
+        stale = []
+        entries = TemplateBytecode.objects.order_by('last_used').values_list(
+            'key', 'size')
+        for key, size in entries.iterator():
+            if total <= self.max_size:
+                break
+            stale.append(key)
+            total -= size
+        TemplateBytecode.objects.filter(key__in=stale).delete()
+
+    def clear(self):
+        from quartet_templates.models import TemplateBytecode
+        TemplateBytecode.objects.all().delete()
+
+
+class DirectoryBytecodeCache(ContentKeyMixin, FileSystemBytecodeCache):
+    """
+    Stores marshalled template bytecode in a local directory.  Cache files
+    are touched when loaded and, once the directory holds more than
+    `max_size` bytes of bytecode, the least recently used files are
+    removed.
+    """
+
+    def __init__(self, directory: str = None,
+                 pattern: str = '__quartet_templates_%s.cache',
+                 max_size: int = DEFAULT_MAX_SIZE):
+        super().__init__(directory, pattern)
+        self.max_size = max_size
+
+    def load_bytecode(self, bucket: Bucket):
+        super().load_bytecode(bucket)
+        if bucket.code is not None:
+            try:
+                os.utime(self._get_cache_filename(bucket))
+            except OSError:
+                pass
+
+    def dump_bytecode(self, bucket: Bucket):
+        super().dump_bytecode(bucket)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used cache files until the total size
+        of the directory's bytecode is no larger than `max_size`.
+        :return: None
+        """
+        entries = []
+        for filename in fnmatch.filter(os.listdir(self.directory),
+                                       self.pattern % ('*',)):
+            path = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def get_bytecode_cache() -> BytecodeCache:
+    """
+    Returns a bytecode cache based on the QUARTET_TEMPLATES_BYTECODE_CACHE
+    setting, which may be `database`, `filesystem` or None (the default)
+    to disable persistent bytecode caching.  The size limit in bytes is
+    read from QUARTET_TEMPLATES_BYTECODE_CACHE_MAX_SIZE and the directory
+    of the filesystem backend from QUARTET_TEMPLATES_BYTECODE_CACHE_DIR.
+    :return: A jinja2 BytecodeCache or None.
+    """
+    backend = getattr(settings, 'QUARTET_TEMPLATES_BYTECODE_CACHE', None)
+    max_size = getattr(settings, 'QUARTET_TEMPLATES_BYTECODE_CACHE_MAX_SIZE',
+                       DEFAULT_MAX_SIZE)
+    if not backend:
+        return None
+    elif backend == 'database':
+        return DatabaseBytecodeCache(max_size=max_size)
+    elif backend == 'filesystem':
+        return DirectoryBytecodeCache(
+            getattr(settings, 'QUARTET_TEMPLATES_BYTECODE_CACHE_DIR', None),
+            max_size=max_size
+        )
+    raise ValueError('Unknown QUARTET_TEMPLATES_BYTECODE_CACHE backend %s. '
+                     'Use "database" or "filesystem".' % backend)
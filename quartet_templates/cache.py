@@ -0,0 +1,339 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import hashlib
+import threading
+from collections import OrderedDict
+from time import perf_counter
+
+from django.conf import settings
+from jinja2 import Template as JinjaTemplate, meta, nodes
+from jinja2.environment import Environment
+from jinja2.exceptions import TemplateNotFound
+
+from quartet_templates.bytecode import get_bytecode_cache
+from quartet_templates.compact import CompactExtension
+from quartet_templates.generation import generation_watcher
+from quartet_templates.limits import LoopBudgetExtension
+from quartet_templates.metrics import render_metrics
+from quartet_templates.precompiled import precompiled_templates
+
+# the name the random filter is reported as in a template's variables so
+# the output of templates that use it is known to be non-deterministic
+RANDOM_FILTER = '|random'
+
+_environments = {}
+_environment_lock = threading.Lock()
+_bytecode_cache = None
+
+
+def get_environment(trim_blocks: bool = True, lstrip_blocks: bool = True,
+                    autoescape: bool = True, enable_async: bool = False,
+                    compact: bool = False,
+                    event_templates: bool = False) -> Environment:
+    """
+    Returns the process-wide jinja2 Environment for the given option set.
+    Environments are created once per option set and shared by every
+    template rendered with those options.  Each environment loads any
+    included, extended or imported templates from the database.
+    :param trim_blocks: The jinja2 trim_blocks option.
+    :param lstrip_blocks: The jinja2 lstrip_blocks option.
+    :param autoescape: The jinja2 autoescape option.
+    :param enable_async: The jinja2 enable_async option.
+    :param compact: Whether or not to compact the static text of the
+    templates, see quartet_templates.compact.
+    :param event_templates: Whether or not the templates render EPCPyYes
+    events, in which case templates that are not in the database are
+    loaded from the EPCPyYes package templates.
+    :return: A jinja2 Environment.
+    """
+    global _bytecode_cache
+    from quartet_templates.loaders import template_loader, \
+        event_template_loader
+    key = (trim_blocks, lstrip_blocks, autoescape, enable_async, compact,
+           event_templates)
+    environment = _environments.get(key)
+    if environment is None:
+        with _environment_lock:
+            environment = _environments.get(key)
+            if environment is None:
+                if _bytecode_cache is None:
+                    _bytecode_cache = get_bytecode_cache()
+                environment = Environment(
+                    trim_blocks=trim_blocks,
+                    lstrip_blocks=lstrip_blocks,
+                    autoescape=autoescape,
+                    enable_async=enable_async,
+                    extensions=[LoopBudgetExtension] + (
+                        [CompactExtension] if compact else []),
+                    loader=event_template_loader if event_templates
+                    else template_loader,
+                    bytecode_cache=_bytecode_cache,
+                    cache_size=getattr(
+                        settings, 'QUARTET_TEMPLATES_CACHE_SIZE', 128)
+                )
+                _environments[key] = environment
+    return environment
+
+
+def content_hash(content: str) -> str:
+    """
+    Returns a hex digest identifying a template body.
+    :param content: The template source.
+    :return: A sha1 hex digest string.
+    """
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def compile_template(environment: Environment, name: str,
+                     content: str) -> JinjaTemplate:
+    """
+    Compiles the template source into a jinja2 Template using the
+    environment supplied.  If the environment has a bytecode cache the
+    compiled code is loaded from, or stored into, that cache.
+    :param environment: The environment to compile with.
+    :param name: The name of the template (used in tracebacks).
+    :param content: The template source.
+    :return: A compiled jinja2 Template.
+    """
+    bytecode_cache = environment.bytecode_cache
+    bucket = None
+    code = None
+    if bytecode_cache is not None:
+        bucket = bytecode_cache.get_bucket(environment, name, None, content)
+        code = bucket.code
+    if code is None:
+        code = environment.compile(content, name=name)
+        if bucket is not None:
+            bucket.code = code
+            bytecode_cache.set_bucket(bucket)
+    return environment.template_class.from_code(
+        environment, code, environment.make_globals(None)
+    )
+
+
+def find_references(environment: Environment, content: str) -> frozenset:
+    """
+    Returns the names of the templates the template source includes,
+    extends or imports.  Dynamic template names are ignored.
+    :param environment: The environment to parse the source with.
+    :param content: The template source.
+    :return: A frozenset of template names.
+    """
+    return frozenset(
+        name for name in
+        meta.find_referenced_templates(environment.parse(content)) if name
+    )
+
+
+def find_variables(environment: Environment, content: str) -> frozenset:
+    """
+    Returns the names of the undeclared variables in the template source,
+    i.e. the context variables it can look up, or None if the template
+    includes, extends or imports a template whose name is only known at
+    render time, in which case any variable may be used.  The `lipsum`
+    global is included if it is used and a template that uses the random
+    filter also gets the RANDOM_FILTER name.
+    :param environment: The environment to parse the source with.
+    :param content: The template source.
+    :return: A frozenset of variable names or None.
+    """
+    ast = environment.parse(content)
+    if None in meta.find_referenced_templates(ast):
+        return None
+    variables = set(meta.find_undeclared_variables(ast))
+    if any(node.name == 'lipsum' for node in ast.find_all(nodes.Name)):
+        variables.add('lipsum')
+    if any(node.name == 'random' for node in ast.find_all(nodes.Filter)):
+        variables.add(RANDOM_FILTER)
+    return frozenset(variables)
+
+
+def collect_variables(environment: Environment, content: str) -> frozenset:
+    """
+    Returns the undeclared variables of the template source and of every
+    template it includes, extends or imports, loading those templates
+    into the environment, or None if the variables can not be known.
+    :param environment: The environment to load templates into.
+    :param content: The template source.
+    :return: A frozenset of variable names or None.
+    """
+    from quartet_templates.loaders import template_loader
+    variables = find_variables(environment, content)
+    if variables is None:
+        return None
+    pending = list(find_references(environment, content))
+    loaded = set()
+    while pending:
+        name = pending.pop()
+        if name in loaded:
+            continue
+        loaded.add(name)
+        try:
+            environment.get_template(name)
+        except TemplateNotFound:
+            # rendering will fail on the missing template anyway
+            continue
+        referenced = template_loader.get_variables(name)
+        if referenced is None:
+            return None
+        variables |= referenced
+        pending.extend(template_loader.get_references(name))
+    return variables
+
+
+def load_references(environment: Environment, names):
+    """
+    Loads the named templates, and every template they reference, into
+    the environment.  Async templates can not query the database while
+    rendering so their references are loaded up front with this function.
+    :param environment: The environment to load the templates into.
+    :param names: The names of the templates to load.
+    :return: None
+    """
+    from quartet_templates.loaders import template_loader
+    pending = list(names)
+    loaded = set()
+    while pending:
+        name = pending.pop()
+        if name not in loaded:
+            environment.get_template(name)
+            loaded.add(name)
+            pending.extend(template_loader.get_references(name))
+
+
+class TemplateCache:
+    """
+    A bounded, thread-safe LRU cache of compiled jinja2 templates.  Entries
+    are keyed by template name, a hash of the template content and the
+    environment options the template was compiled with, so a changed
+    template body can never be served from a stale entry.
+    """
+
+    def __init__(self, max_size: int = 128):
+        """
+        :param max_size: The maximum number of compiled templates to hold.
+        """
+        self.max_size = max_size
+        self._templates = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get_template(self, name: str, content: str, trim_blocks: bool = True,
+                     lstrip_blocks: bool = True, autoescape: bool = True,
+                     enable_async: bool = False, compact: bool = False,
+                     event_templates: bool = False,
+                     checksum: str = None) -> JinjaTemplate:
+        """
+        Returns the compiled template for the name, content and options
+        supplied, compiling and caching it if it is not already cached.
+        The name, content and options are kept with the compiled template
+        as `quartet_source` so it can be compiled again elsewhere, i.e. in
+        a worker process.
+        :param name: The name of the template.
+        :param content: The template source.
+        :param trim_blocks: The jinja2 trim_blocks option.
+        :param lstrip_blocks: The jinja2 lstrip_blocks option.
+        :param autoescape: The jinja2 autoescape option.
+        :param enable_async: The jinja2 enable_async option.
+        :param compact: Whether or not to compact the static text.
+        :param event_templates: Whether or not the template renders
+        EPCPyYes events and may include the EPCPyYes package templates.
+        :param checksum: The content hash of the content if it is already
+        known, i.e. Template.get_checksum, so it is not computed again.
+        :return: A compiled jinja2 Template.
+        """
+        generation_watcher.check()
+        key = (name, checksum or content_hash(content), trim_blocks,
+               lstrip_blocks, autoescape, enable_async, compact,
+               event_templates)
+        template = self._lookup(key)
+        if template is not None:
+            return template
+        environment = get_environment(trim_blocks, lstrip_blocks, autoescape,
+                                      enable_async, compact, event_templates)
+        start = perf_counter()
+        template = precompiled_templates.load(environment, name, key[1])
+        if template is None:
+            template = compile_template(environment, name, content)
+        template.quartet_source = (name, content, {
+            'trim_blocks': trim_blocks, 'lstrip_blocks': lstrip_blocks,
+            'autoescape': autoescape, 'enable_async': enable_async,
+            'compact': compact, 'event_templates': event_templates})
+        render_metrics.record_compile(name, perf_counter() - start)
+        with self._lock:
+            self._templates[key] = template
+            self._templates.move_to_end(key)
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+        return template
+
+    def peek(self, name: str, content: str, trim_blocks: bool = True,
+             lstrip_blocks: bool = True, autoescape: bool = True,
+             enable_async: bool = False, compact: bool = False,
+             event_templates: bool = False,
+             checksum: str = None) -> JinjaTemplate:
+        """
+        Returns the compiled template if it is cached without compiling it
+        on a miss.  This never touches the database so it is safe to call
+        from async code.
+        :return: A compiled jinja2 Template or None.
+        """
+        return self._lookup((name, checksum or content_hash(content),
+                             trim_blocks, lstrip_blocks, autoescape,
+                             enable_async, compact, event_templates))
+
+    def _lookup(self, key: tuple) -> JinjaTemplate:
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                render_metrics.record_cache_hit(key[0])
+        return template
+
+    def invalidate(self, name: str):
+        """
+        Removes every compiled version of the named template.
+        :param name: The name of the template to remove.
+        :return: None
+        """
+        with self._lock:
+            for key in [key for key in self._templates if key[0] == name]:
+                del self._templates[key]
+
+    def clear(self):
+        """
+        Removes all of the compiled templates from the cache.
+        :return: None
+        """
+        with self._lock:
+            self._templates.clear()
+
+    def names(self) -> set:
+        """
+        Returns the names of the templates in the cache.
+        """
+        with self._lock:
+            return {key[0] for key in self._templates}
+
+    def __contains__(self, name: str):
+        with self._lock:
+            return any(key[0] == name for key in self._templates)
+
+    def __len__(self):
+        return len(self._templates)
+
+
+template_cache = TemplateCache(
+    getattr(settings, 'QUARTET_TEMPLATES_CACHE_SIZE', 128)
+)
@@ -0,0 +1,88 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+"""
+Compact mode removes the indentation and line breaks between the tags of
+a template's static text when the template is compiled, so the compiled
+code writes the compacted text and rendering costs nothing extra.  Only
+whitespace that contains a line break and sits between a tag and another
+tag or a template statement (`{% ... %}`) is removed.  Whitespace next
+to a variable (`{{ ... }}`), whitespace within a line and everything a
+variable renders is left untouched.
+"""
+import re
+
+from jinja2.ext import Extension
+from jinja2.lexer import Token
+
+WHITESPACE = re.compile(r'\s+')
+
+
+def compact_text(data: str, strip_start: bool = True,
+                 strip_end: bool = True,
+                 line_break_before: bool = False) -> str:
+    """
+    Removes the whitespace runs containing a line break that are between
+    two tags, or between a tag and a template statement, from a piece of
+    static template text.
+    :param data: The static text.
+    :param strip_start: Whether the text follows a template statement, or
+    starts the template, so leading whitespace counts as between tags.
+    :param strip_end: Whether the text precedes a template statement, or
+    ends the template, so trailing whitespace counts as between tags.
+    :param line_break_before: Whether the line break between the previous
+    statement and the text was already removed, i.e. by trim_blocks.
+    :return: The compacted text.
+    """
+    def replace(match):
+        start, end = match.span()
+        if (start and data[start - 1] == '>' or not start and strip_start) \
+                and (end < len(data) and data[end] == '<' or
+                     end == len(data) and strip_end) \
+                and ('\n' in match.group() or
+                     not start and line_break_before):
+            return ''
+        return match.group()
+    return WHITESPACE.sub(replace, data)
+
+
+class CompactExtension(Extension):
+    """
+    A jinja2 extension that compacts the static text of every template
+    compiled by its environment, see compact_text.
+    """
+
+    def filter_stream(self, stream):
+        previous = None
+        tokens = iter(stream)
+        token = next(tokens, None)
+        while token is not None:
+            following = next(tokens, None)
+            if token.type == 'data':
+                after_statement = previous is not None and \
+                    previous.type == 'block_end'
+                token = Token(token.lineno, token.type, compact_text(
+                    token.value,
+                    previous is None or after_statement,
+                    following is None or following.type == 'block_begin',
+                    after_statement and token.lineno > previous.lineno))
+            yield token
+            previous, token = token, following
+
+
+def is_compact(environment) -> bool:
+    """
+    Returns whether or not the environment compiles compact templates.
+    """
+    return CompactExtension.identifier in environment.extensions
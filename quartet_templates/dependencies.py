@@ -0,0 +1,69 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+"""
+The include/extends/import dependency graph between templates.  The
+edges are stored in the TemplateDependency model so the templates affected
+by a change can be found without parsing every template.
+"""
+from jinja2.exceptions import TemplateSyntaxError
+
+from quartet_templates.cache import get_environment, find_references
+from quartet_templates.models import TemplateDependency
+
+
+def parse_references(content: str) -> frozenset:
+    """
+    Returns the names of the templates the content references or an empty
+    set if the content can not be parsed.
+    """
+    try:
+        return find_references(get_environment(), content)
+    except TemplateSyntaxError:
+        return frozenset()
+
+
+def set_dependencies(templates):
+    """
+    Replaces the stored dependency edges of the templates with the
+    references parsed from their current content.
+    :param templates: Saved Template instances.
+    :return: None
+    """
+    edges = [
+        TemplateDependency(template=template, referenced_name=name)
+        for template in templates
+        for name in parse_references(template.content)
+    ]
+    TemplateDependency.objects.filter(
+        template__in=[template.pk for template in templates]).delete()
+    TemplateDependency.objects.bulk_create(edges)
+
+
+def get_dependents(*names: str) -> set:
+    """
+    Returns the names of every template that includes, extends or imports
+    any of the named templates, directly or through other templates.
+    :param names: The names of the changed templates.
+    :return: A set of template names, not including the names given.
+    """
+    dependents = set()
+    pending = set(names)
+    while pending:
+        found = set(TemplateDependency.objects.filter(
+            referenced_name__in=pending).order_by().values_list(
+            'template__name', flat=True))
+        pending = found - dependents - set(names)
+        dependents |= pending
+    return dependents
@@ -0,0 +1,132 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+"""
+Cross-process cache coherency.  A single TemplateGeneration row holds a
+counter that is bumped, in the same transaction, whenever a template is
+saved, imported or deleted and each saved template records the generation
+it was saved with.  Every process checks the counter at most once every
+QUARTET_TEMPLATES_GENERATION_CHECK_INTERVAL seconds and, when it has
+moved, invalidates only the templates that changed since it last looked.
+"""
+import logging
+import threading
+from time import monotonic
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.utils import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+GENERATION_ID = 1
+
+
+def next_generation() -> int:
+    """
+    Bumps the global template generation and returns the new value.  The
+    row stays locked until the calling transaction ends so generations are
+    committed in order.
+    :return: The new generation.
+    """
+    from quartet_templates.models import TemplateGeneration
+    queryset = TemplateGeneration.objects.filter(pk=GENERATION_ID)
+    if not queryset.update(generation=F('generation') + 1):
+        TemplateGeneration.objects.get_or_create(pk=GENERATION_ID)
+        queryset.update(generation=F('generation') + 1)
+    return queryset.values_list('generation', flat=True).get()
+
+
+def get_generation() -> int:
+    """
+    Returns the current global template generation.
+    """
+    from quartet_templates.models import TemplateGeneration
+    return TemplateGeneration.objects.filter(pk=GENERATION_ID).values_list(
+        'generation', flat=True).first() or 0
+
+
+class GenerationWatcher:
+    """
+    Drops the templates other processes have changed from this process's
+    template cache and template loader.  `check` queries the generation
+    counter at most once every `interval` seconds; an interval of None
+    turns checking off.
+    """
+
+    def __init__(self, interval: float = 5):
+        self.interval = interval
+        self.generation = None
+        self.checked = None
+        self._lock = threading.Lock()
+
+    def due(self) -> bool:
+        return self.interval is not None and (
+            self.checked is None or
+            monotonic() - self.checked >= self.interval)
+
+    def check(self):
+        """
+        Invalidates any templates that changed since the last check if the
+        check interval has passed.
+        :return: None
+        """
+        if not self.due() or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self.checked = monotonic()
+            with transaction.atomic():
+                current = get_generation()
+                if self.generation is not None and \
+                        current != self.generation:
+                    self._invalidate_changes(current)
+            self.generation = current
+        except DatabaseError:
+            # rendering should not fail because the check could not run,
+            # it is tried again after the next interval
+            logger.warning('The template generation could not be checked.',
+                           exc_info=True)
+        finally:
+            self._lock.release()
+
+    def _invalidate_changes(self, current: int):
+        from quartet_templates.cache import template_cache
+        from quartet_templates.loaders import template_loader
+        from quartet_templates.models import Template
+        from quartet_templates.signals import invalidate
+        cached = template_cache.names() | template_loader.loaded_names()
+        if current < self.generation:
+            # the counter went backwards, i.e. the database was restored,
+            # so nothing cached can be trusted
+            changed = cached
+        else:
+            changed = set(Template.objects.filter(
+                generation__gt=self.generation).order_by().values_list(
+                'name', flat=True))
+            if cached:
+                changed |= cached - set(Template.objects.filter(
+                    name__in=cached).order_by().values_list(
+                    'name', flat=True))
+        if changed:
+            invalidate(*changed)
+
+    def reset(self):
+        self.generation = None
+        self.checked = None
+
+
+generation_watcher = GenerationWatcher(
+    getattr(settings, 'QUARTET_TEMPLATES_GENERATION_CHECK_INTERVAL', 5)
+)
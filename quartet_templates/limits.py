@@ -0,0 +1,223 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+"""
+Render budgets.  A template render can be limited to a wall time in
+seconds and to a number of bytes of (utf-8 encoded) output.  The limits
+are checked as each chunk of output is generated, so a runaway template
+is stopped part way through rendering rather than after it has finished.
+
+A template can also run away without generating any output, i.e. nested
+`{% for %}` loops that only `{% set %}` variables.  The LoopBudgetExtension
+passes the iterable of every `{% for %}` loop through a filter that checks
+the time limit of the synchronous render in progress on each iteration.
+A single filter, test or python call that takes too long is only stopped
+once it returns to the template.  Async renders are only checked as
+output is generated.
+"""
+import threading
+from time import perf_counter
+
+from django.conf import settings
+from jinja2.ext import Extension
+from jinja2.lexer import Token
+
+# the name of the filter the LoopBudgetExtension applies to loop iterables
+LOOP_FILTER = 'quartet_loop_budget'
+# the budget of the synchronous render in progress in each thread
+_active = threading.local()
+
+
+class RenderLimitExceeded(Exception):
+    """
+    Raised when rendering a template takes longer or produces more output
+    than its render budget allows.
+    """
+
+    def __init__(self, message: str, template_name: str = None):
+        super().__init__(message)
+        self.template_name = template_name
+
+
+def get_render_limits(template, timeout: float = None,
+                      max_size: int = None) -> tuple:
+    """
+    Resolves the render limits for a template.  Explicit limits, i.e. from
+    step parameters, take precedence over the limits stored on the
+    template which take precedence over the
+    QUARTET_TEMPLATES_RENDER_TIMEOUT and QUARTET_TEMPLATES_MAX_OUTPUT_SIZE
+    settings.  A limit of None or 0 means unlimited.
+    :param template: The quartet_templates Template being rendered or None
+    if the limits do not belong to a single template.
+    :param timeout: The maximum render time in seconds.
+    :param max_size: The maximum output size in bytes.
+    :return: A tuple of (timeout, max_size).
+    """
+    if timeout is None and template is not None:
+        timeout = template.render_timeout
+    if timeout is None:
+        timeout = getattr(settings, 'QUARTET_TEMPLATES_RENDER_TIMEOUT', None)
+    if max_size is None and template is not None:
+        max_size = template.max_output_size
+    if max_size is None:
+        max_size = getattr(settings, 'QUARTET_TEMPLATES_MAX_OUTPUT_SIZE',
+                           None)
+    return timeout or None, max_size or None
+
+
+class RenderBudget:
+    """
+    Tracks the time and output spent by a single render against its
+    limits.
+    """
+
+    def __init__(self, name: str, timeout: float = None,
+                 max_size: int = None):
+        self.name = name
+        self.timeout = timeout
+        self.max_size = max_size
+        self.size = 0
+        self.deadline = perf_counter() + timeout if timeout else None
+
+    def spend(self, chunk: str):
+        """
+        Accounts for a chunk of output.
+        :param chunk: The rendered chunk.
+        :raises RenderLimitExceeded: If either limit has been exceeded.
+        """
+        if self.max_size:
+            self.size += len(chunk.encode('utf-8'))
+            if self.size > self.max_size:
+                raise RenderLimitExceeded(
+                    'Rendering template %s was stopped after producing '
+                    'more than the maximum output size of %s bytes.' % (
+                        self.name, self.max_size), self.name)
+        self.check_time()
+
+    def check_time(self):
+        """
+        :raises RenderLimitExceeded: If the time limit has been exceeded.
+        """
+        if self.deadline and perf_counter() > self.deadline:
+            raise RenderLimitExceeded(
+                'Rendering template %s was stopped after exceeding the '
+                'render timeout of %s seconds.' % (self.name, self.timeout),
+                self.name)
+
+    def watch(self, chunks):
+        """
+        Passes through the chunks of a synchronous streamed render and, if
+        there is a time limit, makes this the active budget of the thread
+        until the render is finished or closed so the template's loops
+        check the time limit too.  The budget is not switched for each
+        chunk, which would slow rendering down noticeably, so renders
+        interleaved in one thread are checked against the budget of the
+        one started last.  The chunks are not accounted for, see spend.
+        :param chunks: An iterable of rendered chunks.
+        """
+        if not self.deadline:
+            yield from chunks
+            return
+        previous = getattr(_active, 'budget', None)
+        _active.budget = self
+        try:
+            yield from chunks
+        finally:
+            _active.budget = previous
+
+
+def loop_budget(iterable):
+    """
+    The filter applied to the iterable of each `{% for %}` loop.  Returns
+    the iterable unchanged unless a render with a time limit is in
+    progress, in which case the time limit is checked on each iteration.
+    """
+    budget = getattr(_active, 'budget', None)
+    if budget is None:
+        return iterable
+    return _check_iterations(iterable, budget)
+
+
+def _check_iterations(iterable, budget: RenderBudget):
+    for item in iterable:
+        budget.check_time()
+        yield item
+
+
+class LoopBudgetExtension(Extension):
+    """
+    A jinja2 extension that rewrites `{% for x in items %}` as
+    `{% for x in (items)|quartet_loop_budget %}` so loops that produce no
+    output still check the time limit, see loop_budget.
+    """
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.filters[LOOP_FILTER] = loop_budget
+
+    def filter_stream(self, stream):
+        previous = None
+        tokens = iter(stream)
+        for token in tokens:
+            yield token
+            if token.test('name:for') and previous is not None and \
+                    previous.type == 'block_begin':
+                yield from self._wrap_iterable(tokens)
+            previous = token
+
+    def _wrap_iterable(self, tokens):
+        depth = 0
+        wrapping = False
+        for token in tokens:
+            if token.type in ('lparen', 'lbracket', 'lbrace'):
+                depth += 1
+            elif token.type in ('rparen', 'rbracket', 'rbrace'):
+                depth -= 1
+            if not wrapping:
+                yield token
+                if depth == 0 and token.test('name:in'):
+                    wrapping = True
+                    yield Token(token.lineno, 'lparen', '(')
+                continue
+            if depth == 0 and (token.type == 'block_end' or
+                               token.test_any('name:if', 'name:recursive')):
+                yield Token(token.lineno, 'rparen', ')')
+                yield Token(token.lineno, 'pipe', '|')
+                yield Token(token.lineno, 'name', LOOP_FILTER)
+                yield token
+                return
+            yield token
+
+
+def limit_stream(name: str, chunks, timeout: float = None,
+                 max_size: int = None):
+    """
+    Passes through the chunks of a streamed render, raising
+    RenderLimitExceeded as soon as a limit is exceeded.
+    """
+    budget = RenderBudget(name, timeout, max_size)
+    for chunk in budget.watch(chunks):
+        budget.spend(chunk)
+        yield chunk
+
+
+async def alimit_stream(name: str, chunks, timeout: float = None,
+                        max_size: int = None):
+    """
+    The async generator version of limit_stream.
+    """
+    budget = RenderBudget(name, timeout, max_size)
+    async for chunk in chunks:
+        budget.spend(chunk)
+        yield chunk
@@ -0,0 +1,99 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import threading
+
+from jinja2.exceptions import TemplateNotFound
+from jinja2.loaders import BaseLoader, ChoiceLoader, PackageLoader
+
+from quartet_templates.models import Template
+
+
+class QuartetTemplateLoader(BaseLoader):
+    """
+    A jinja2 loader that resolves template names against the Template
+    model so templates can `include`, `extend` and `import` one another
+    by name.
+
+    Each template name has an in-process version number which is bumped
+    whenever the template is saved or deleted.  The `uptodate` check of a
+    loaded template only compares that version, so the jinja2 environment
+    can keep reusing a compiled template without querying the database.
+    """
+
+    def __init__(self):
+        self._versions = {}
+        self._references = {}
+        self._variables = {}
+        self._lock = threading.Lock()
+
+    def get_source(self, environment, template: str):
+        from quartet_templates.cache import find_references, find_variables
+        version = self._versions.get(template, 0)
+        content = Template.objects.filter(name=template).values_list(
+            'content', flat=True).first()
+        if content is None:
+            raise TemplateNotFound(template)
+        self._references[template] = find_references(environment, content)
+        self._variables[template] = find_variables(environment, content)
+
+        def uptodate():
+            return self._versions.get(template, 0) == version
+
+        return content, None, uptodate
+
+    def list_templates(self):
+        return list(Template.objects.values_list('name', flat=True))
+
+    def get_references(self, name: str) -> frozenset:
+        """
+        Returns the names of the templates the last loaded version of the
+        named template includes, extends or imports.
+        :param name: The template name.
+        :return: A frozenset of template names.
+        """
+        return self._references.get(name, frozenset())
+
+    def get_variables(self, name: str) -> frozenset:
+        """
+        Returns the undeclared variables of the last loaded version of the
+        named template, or None if they can not be known.
+        :param name: The template name.
+        :return: A frozenset of variable names or None.
+        """
+        return self._variables.get(name, frozenset())
+
+    def loaded_names(self) -> set:
+        """
+        Returns the names of the templates that have been loaded.
+        """
+        return set(self._references)
+
+    def invalidate(self, name: str):
+        """
+        Marks any loaded version of the named template as out of date.
+        :param name: The name of the template that changed.
+        :return: None
+        """
+        with self._lock:
+            self._versions[name] = self._versions.get(name, 0) + 1
+
+
+template_loader = QuartetTemplateLoader()
+
+# event templates may include the default EPCPyYes templates, i.e.
+# `epcis/event_times.xml`, so any name that is not in the database falls
+# back to the EPCPyYes package templates
+event_template_loader = ChoiceLoader([
+    template_loader, PackageLoader('EPCPyYes', 'templates')])
@@ -0,0 +1,42 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+from django.utils.translation import gettext as _
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from quartet_templates.precompiled import compile_all
+
+
+class Command(BaseCommand):
+    help = _("Compiles every template into python modules that are loaded "
+             "instead of compiling templates at runtime.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--target", dest="target",
+            default=getattr(settings, "QUARTET_TEMPLATES_COMPILED_DIR", None),
+            help="The directory to compile the templates into.  Defaults "
+                 "to the QUARTET_TEMPLATES_COMPILED_DIR setting."
+        )
+
+    def handle(self, *args, **options):
+        target = options.get("target")
+        if not target:
+            raise CommandError("No target directory was given and the "
+                               "QUARTET_TEMPLATES_COMPILED_DIR setting is "
+                               "not configured.")
+        verbose = options.get("verbosity", 1) > 1
+        count = compile_all(
+            target, log_function=self.stdout.write if verbose else None)
+        self.stdout.write("Compiled %s templates into %s." % (count, target))
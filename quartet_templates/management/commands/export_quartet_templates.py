@@ -0,0 +1,53 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import sys
+
+from django.utils.translation import gettext as _
+from django.core.management.base import BaseCommand
+from quartet_templates import transfer
+
+
+class Command(BaseCommand):
+    help = _("Exports every template as NDJSON or as a gzipped tar "
+             "archive.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "output", nargs="?", default="-",
+            help="The file to export to, or - for standard output.  Files "
+                 "ending in .tar.gz or .tgz are written as tar archives."
+        )
+        parser.add_argument(
+            "--tar", dest="tar", action="store_true",
+            help="Export a gzipped tar archive instead of NDJSON."
+        )
+
+    def handle(self, *args, **options):
+        output = options["output"]
+        tar = options["tar"] or output.endswith((".tar.gz", ".tgz"))
+        if output == "-":
+            stream = sys.stdout.buffer
+        else:
+            stream = open(output, "wb")
+        try:
+            if tar:
+                for chunk in transfer.export_tar():
+                    stream.write(chunk)
+            else:
+                for line in transfer.export_ndjson():
+                    stream.write(line.encode("utf-8"))
+        finally:
+            if stream is not sys.stdout.buffer:
+                stream.close()
@@ -0,0 +1,61 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import sys
+import tarfile
+
+from django.utils.translation import gettext as _
+from django.core.management.base import BaseCommand, CommandError
+from quartet_templates import transfer
+
+
+class Command(BaseCommand):
+    help = _("Creates or updates templates, by name, from NDJSON or a tar "
+             "archive created by export_quartet_templates.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "input", nargs="?", default="-",
+            help="The file to import from, or - for standard input.  Files "
+                 "ending in .tar, .tar.gz or .tgz are read as tar archives."
+        )
+        parser.add_argument(
+            "--tar", dest="tar", action="store_true",
+            help="Import a tar archive instead of NDJSON."
+        )
+        parser.add_argument(
+            "--batch-size", dest="batch_size", type=int,
+            default=transfer.BATCH_SIZE,
+            help="The number of templates to write at a time."
+        )
+
+    def handle(self, *args, **options):
+        source = options["input"]
+        tar = options["tar"] or source.endswith((".tar", ".tar.gz", ".tgz"))
+        if source == "-":
+            stream = sys.stdin.buffer
+        else:
+            stream = open(source, "rb")
+        try:
+            records = (transfer.read_tar(stream) if tar
+                       else transfer.read_ndjson(stream))
+            result = transfer.import_templates(
+                records, batch_size=options["batch_size"])
+        except (transfer.InvalidRecord, tarfile.TarError) as e:
+            raise CommandError(str(e))
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
+        self.stdout.write("Created %(created)s and updated %(updated)s "
+                          "templates." % result)
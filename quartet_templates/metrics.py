@@ -0,0 +1,181 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import logging
+import threading
+from bisect import bisect_left
+from time import monotonic
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+
+logger = logging.getLogger(__name__)
+
+# histogram bucket upper bounds, the final bucket of each histogram
+# counts any value larger than the last bound
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = tuple(4 ** n for n in range(4, 16))
+
+
+def new_histogram(bounds: tuple) -> list:
+    return [0] * (len(bounds) + 1)
+
+
+def add_to_histogram(histogram: list, bounds: tuple, value: float):
+    histogram[bisect_left(bounds, value)] += 1
+
+
+def merge_histograms(first: list, second: list) -> list:
+    return [a + b for a, b in zip(first, second)]
+
+
+def percentile(histogram: list, bounds: tuple, percent: float):
+    """
+    Estimates a percentile from a histogram as the upper bound of the
+    bucket the percentile falls into.  Values that fall beyond the last
+    bucket are reported as the last bound.
+    :param histogram: The bucket counts.
+    :param bounds: The bucket upper bounds.
+    :param percent: The percentile to estimate, i.e. 90 or 99.
+    :return: The estimated value or None if the histogram is empty.
+    """
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = total * percent / 100.0
+    cumulative = 0
+    for index, count in enumerate(histogram):
+        cumulative += count
+        if cumulative >= rank:
+            return bounds[min(index, len(bounds) - 1)]
+
+
+class TemplateStats:
+    """
+    The metrics a single process has gathered for one template since they
+    were last flushed to the database.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.compile_time = 0.0
+        self.render_time = 0.0
+        self.output_size = 0
+        self.max_output_size = 0
+        self.compile_histogram = new_histogram(TIME_BUCKETS)
+        self.render_histogram = new_histogram(TIME_BUCKETS)
+        self.size_histogram = new_histogram(SIZE_BUCKETS)
+
+
+class RenderMetrics:
+    """
+    Gathers render metrics per template in memory and periodically adds
+    them to the TemplateMetric table so the metrics of every worker
+    process can be read through the API.  Metrics are flushed at most once
+    every QUARTET_TEMPLATES_METRICS_FLUSH_INTERVAL seconds (default 60)
+    and can be switched off with QUARTET_TEMPLATES_METRICS = False.
+    """
+
+    def __init__(self, enabled: bool = True, flush_interval: float = 60):
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._last_flush = monotonic()
+
+    def _get_stats(self, name: str) -> TemplateStats:
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = self._stats[name] = TemplateStats()
+        return stats
+
+    def record_cache_hit(self, name: str):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._get_stats(name).cache_hits += 1
+
+    def record_compile(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._get_stats(name)
+            stats.cache_misses += 1
+            stats.compile_time += seconds
+            add_to_histogram(stats.compile_histogram, TIME_BUCKETS, seconds)
+
+    def record_render(self, name: str, seconds: float, size: int,
+                      flush: bool = True):
+        """
+        Records a single render of a template.
+        :param name: The template name.
+        :param seconds: The time it took to render the template.
+        :param size: The size of the rendered output in characters.
+        :param flush: Whether or not to flush the metrics if they are due
+        to be flushed.  Async callers should pass False and flush from a
+        synchronous context when `flush_due` returns True.
+        :return: None
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._get_stats(name)
+            stats.calls += 1
+            stats.render_time += seconds
+            stats.output_size += size
+            stats.max_output_size = max(stats.max_output_size, size)
+            add_to_histogram(stats.render_histogram, TIME_BUCKETS, seconds)
+            add_to_histogram(stats.size_histogram, SIZE_BUCKETS, size)
+        if flush and self.flush_due():
+            self.flush()
+
+    def flush_due(self) -> bool:
+        return (self.enabled and
+                monotonic() - self._last_flush >= self.flush_interval)
+
+    def flush(self):
+        """
+        Adds the metrics gathered since the last flush to the
+        TemplateMetric table.  Metrics can never cause a render to fail,
+        so any database errors are logged and the metrics are dropped.
+        :return: None
+        """
+        from quartet_templates.models import TemplateMetric
+        with self._lock:
+            stats, self._stats = self._stats, {}
+            self._last_flush = monotonic()
+        for name, template_stats in stats.items():
+            try:
+                with transaction.atomic():
+                    metric, _ = TemplateMetric.objects.select_for_update(
+                    ).get_or_create(template_name=name)
+                    metric.add(template_stats)
+                    metric.save()
+            except DatabaseError:
+                logger.exception('Could not store the render metrics for '
+                                 'template %s.', name)
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+render_metrics = RenderMetrics(
+    enabled=getattr(settings, 'QUARTET_TEMPLATES_METRICS', True),
+    flush_interval=getattr(settings,
+                           'QUARTET_TEMPLATES_METRICS_FLUSH_INTERVAL', 60)
+)
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_templates', '0002_auto_20190305_2241'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TemplateBytecode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='The bytecode cache key.', max_length=40, unique=True)),
+                ('code', models.BinaryField(help_text='The marshalled template bytecode.')),
+                ('size', models.PositiveIntegerField(help_text='The size of the bytecode in bytes.')),
+                ('last_used', models.DateTimeField(db_index=True, help_text='When the bytecode was last written or loaded.')),
+            ],
+            options={
+                'verbose_name': 'Template Bytecode',
+                'verbose_name_plural': 'Template Bytecode',
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_templates', '0003_templatebytecode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TemplateMetric',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('template_name', models.CharField(help_text='The name of the template the metrics are for.', max_length=100, unique=True)),
+                ('calls', models.BigIntegerField(default=0, help_text='The number of times the template was rendered.')),
+                ('cache_hits', models.BigIntegerField(default=0, help_text='The number of times the compiled template was found in the template cache.')),
+                ('cache_misses', models.BigIntegerField(default=0, help_text='The number of times the template had to be compiled.')),
+                ('compile_time', models.FloatField(default=0.0, help_text='The total time spent compiling the template.')),
+                ('render_time', models.FloatField(default=0.0, help_text='The total time spent rendering the template.')),
+                ('output_size', models.BigIntegerField(default=0, help_text='The total size of the rendered output.')),
+                ('max_output_size', models.BigIntegerField(default=0, help_text='The size of the largest rendered output.')),
+                ('compile_histogram', models.TextField(blank=True, default='', help_text='Compile time histogram.')),
+                ('render_histogram', models.TextField(blank=True, default='', help_text='Render time histogram.')),
+                ('size_histogram', models.TextField(blank=True, default='', help_text='Output size histogram.')),
+            ],
+            options={
+                'verbose_name': 'Template Metric',
+                'verbose_name_plural': 'Template Metrics',
+                'ordering': ['template_name'],
+            },
+        ),
+    ]
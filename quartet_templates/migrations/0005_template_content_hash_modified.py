@@ -0,0 +1,35 @@
+from hashlib import sha1
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_content_hashes(apps, schema_editor):
+    Template = apps.get_model('quartet_templates', 'Template')
+    for template in Template.objects.only('id', 'content').iterator():
+        Template.objects.filter(pk=template.pk).update(
+            content_hash=sha1(template.content.encode('utf-8')).hexdigest()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_templates', '0004_templatemetric'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='template',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', editable=False, help_text='A sha1 hash of the template content.', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='template',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=timezone.now, help_text='When the template was last changed.'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_content_hashes,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_templates', '0005_template_content_hash_modified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='template',
+            name='max_output_size',
+            field=models.PositiveIntegerField(blank=True, help_text='The maximum number of bytes of output rendering this template may produce.  Leave blank for no limit.', null=True),
+        ),
+        migrations.AddField(
+            model_name='template',
+            name='render_timeout',
+            field=models.FloatField(blank=True, help_text='The maximum number of seconds rendering this template may take.  Leave blank for no limit.', null=True),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+from jinja2 import Environment, meta
+from jinja2.exceptions import TemplateSyntaxError
+
+
+def backfill_dependencies(apps, schema_editor):
+    Template = apps.get_model('quartet_templates', 'Template')
+    TemplateDependency = apps.get_model('quartet_templates',
+                                        'TemplateDependency')
+    environment = Environment()
+    edges = []
+    for template in Template.objects.only('id', 'content').iterator():
+        try:
+            names = meta.find_referenced_templates(
+                environment.parse(template.content))
+        except TemplateSyntaxError:
+            continue
+        edges.extend(TemplateDependency(template_id=template.pk,
+                                        referenced_name=name)
+                     for name in set(names) if name)
+    TemplateDependency.objects.bulk_create(edges, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_templates', '0006_template_render_limits'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TemplateDependency',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('referenced_name', models.CharField(db_index=True, help_text='The name of the included, extended or imported template.', max_length=100)),
+                ('template', models.ForeignKey(help_text='The template that references another template.', on_delete=django.db.models.deletion.CASCADE, related_name='dependencies', to='quartet_templates.template')),
+            ],
+            options={
+                'verbose_name': 'Template Dependency',
+                'verbose_name_plural': 'Template Dependencies',
+                'ordering': ['template', 'referenced_name'],
+                'unique_together': {('template', 'referenced_name')},
+            },
+        ),
+        migrations.RunPython(backfill_dependencies,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:58
+
+import quartet_templates.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_templates', '0007_templatedependency'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TemplateContent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(help_text='The sha1 hash of the template content.', max_length=40, unique=True)),
+                ('data', models.BinaryField(help_text='The utf-8 encoded, optionally compressed, content.')),
+                ('compressed', models.BooleanField(default=False, help_text='Whether or not the data is zlib compressed.')),
+                ('size', models.PositiveIntegerField(help_text='The length of the content in characters.')),
+            ],
+            options={
+                'verbose_name': 'Template Content',
+                'verbose_name_plural': 'Template Content',
+            },
+        ),
+        migrations.AlterField(
+            model_name='template',
+            name='content',
+            field=quartet_templates.storage.ContentField(help_text='The full Django/Jinja template to be used.'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+def create_generation(apps, schema_editor):
+    TemplateGeneration = apps.get_model('quartet_templates',
+                                        'TemplateGeneration')
+    TemplateGeneration.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_templates', '0008_templatecontent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TemplateGeneration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation', models.BigIntegerField(default=0, help_text='The current template generation.')),
+            ],
+            options={
+                'verbose_name': 'Template Generation',
+                'verbose_name_plural': 'Template Generation',
+            },
+        ),
+        migrations.AddField(
+            model_name='template',
+            name='generation',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False, help_text='The global template generation this template was last saved in.'),
+        ),
+        migrations.RunPython(create_generation,
+                             migrations.RunPython.noop),
+    ]
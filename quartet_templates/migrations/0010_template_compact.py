@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_templates', '0009_template_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='template',
+            name='compact',
+            field=models.BooleanField(default=False, help_text="Whether or not to remove the indentation and line breaks between the tags of the template's static text when it is compiled.  Rendered variables are not changed."),
+        ),
+    ]
@@ -1,5 +1,22 @@
-from django.db import models
+import json
+from time import perf_counter
+
+from asgiref.sync import sync_to_async
+from django.db import models, transaction
+from jinja2 import Template as JinjaTemplate
 from jinja2.environment import Environment
+from quartet_templates.cache import template_cache, find_references, \
+    load_references, content_hash, collect_variables
+from quartet_templates.batch import render_in_pool
+from quartet_templates.storage import ContentField
+from quartet_templates.output import output_cache, make_key
+from quartet_templates.profiler import TemplateProfiler
+from quartet_templates.generation import next_generation, \
+    generation_watcher
+from quartet_templates import metrics
+from quartet_templates.metrics import render_metrics
+from quartet_templates.limits import get_render_limits, limit_stream, \
+    alimit_stream
 
 class Template(models.Model):
     '''
@@ -15,7 +32,7 @@ class Template(models.Model):
         db_index=True,
         unique=True,
         help_text="A name to identify this template")
-    content = models.TextField(
+    content = ContentField(
         null=False,
         blank=False,
         help_text="The full Django/Jinja template to be used.")
@@ -23,20 +40,317 @@ class Template(models.Model):
         max_length=200,
         null=True,
         blank=True)
+    content_hash = models.CharField(
+        max_length=40,
+        editable=False,
+        blank=True,
+        default='',
+        help_text="A sha1 hash of the template content.")
+    modified = models.DateTimeField(
+        auto_now=True,
+        db_index=True,
+        help_text="When the template was last changed.")
+    render_timeout = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="The maximum number of seconds rendering this template "
+                  "may take.  Leave blank for no limit.")
+    max_output_size = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="The maximum number of bytes of output rendering this "
+                  "template may produce.  Leave blank for no limit.")
+    compact = models.BooleanField(
+        default=False,
+        help_text="Whether or not to remove the indentation and line breaks "
+                  "between the tags of the template's static text when it "
+                  "is compiled.  Rendered variables are not changed.")
+    generation = models.BigIntegerField(
+        default=0,
+        editable=False,
+        db_index=True,
+        help_text="The global template generation this template was last "
+                  "saved in.")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remembered so a rename also invalidates the old name
+        instance.loaded_name = instance.__dict__.get('name')
+        return instance
+
+    def get_checksum(self) -> str:
+        '''
+        Returns the content hash of the current content, computing it only
+        once for each content value so a large template is not hashed on
+        every render.  The stored content_hash is not trusted as the
+        content may have been changed without saving the model, i.e. with
+        a queryset update.
+        '''
+        hashed = getattr(self, '_hashed_content', None)
+        if hashed is None or hashed[0] is not self.content:
+            hashed = self._hashed_content = (self.content,
+                                             content_hash(self.content))
+        return hashed[1]
+
+    def save(self, *args, **kwargs):
+        from quartet_templates.dependencies import set_dependencies
+        self.content_hash = self.get_checksum()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = set(update_fields) | {'generation', 'modified'}
+            if 'content' in update_fields:
+                update_fields.add('content_hash')
+            kwargs['update_fields'] = update_fields
+        # the generation is committed together with the change so other
+        # processes never see the new generation without the change
+        with transaction.atomic():
+            self.generation = next_generation()
+            super().save(*args, **kwargs)
+            if update_fields is None or 'content' in update_fields:
+                set_dependencies([self])
+
+    def get_names(self) -> set:
+        '''
+        Returns the template's name and, if it was renamed since it was
+        loaded, the name it was loaded with.
+        '''
+        names = {self.name}
+        loaded_name = getattr(self, 'loaded_name', None)
+        if loaded_name:
+            names.add(loaded_name)
+        return names
 
-    def render(self, context, environment: Environment = None):
+    def render(self, context, environment: Environment = None,
+               autoescape: bool = True, timeout: float = None,
+               max_size: int = None, compact: bool = None):
         '''
         Renders the template passing a dictionary of key/value pairs
-        in the context parameter.
+        in the context parameter.  If no environment is supplied the
+        compiled template is taken from the process-wide template cache.
+        If the render has a time or output size limit (see
+        limits.get_render_limits) it is streamed and stopped with a
+        RenderLimitExceeded error as soon as a limit is exceeded.  If
+        compact is None the template's compact setting is used.
         '''
-        if not environment:
-            environment = Environment(
-                trim_blocks=True,
-                lstrip_blocks=True,
-                autoescape=True
-            )
-        template = environment.from_string(self.content)
-        return template.render(context)
+        timeout, max_size = get_render_limits(self, timeout, max_size)
+        if timeout or max_size:
+            return ''.join(self.render_stream(
+                context, environment, autoescape, timeout, max_size,
+                compact))
+        if environment:
+            template = environment.from_string(self.content)
+        else:
+            template = self.get_compiled_template(autoescape=autoescape,
+                                                  compact=compact)
+        start = perf_counter()
+        ret = template.render(context)
+        render_metrics.record_render(self.name, perf_counter() - start,
+                                     len(ret))
+        return ret
+
+    def render_cached(self, context, autoescape: bool = True,
+                      timeout: float = None, max_size: int = None,
+                      compact: bool = None):
+        '''
+        Renders the template like render but returns the output of an
+        earlier render from the in-process output cache when the
+        template and the context variables it uses are unchanged.
+        Templates that use epoch, random, UUID or datetime, or whose
+        inputs can not be serialized, are always rendered.
+        '''
+        compact = self.compact if compact is None else compact
+        key = make_key(self.name, self.get_checksum(), autoescape,
+                       context, self.get_variables(autoescape,
+                                                   compact=compact),
+                       compact)
+        ret = output_cache.get(key) if key else None
+        if ret is None:
+            ret = self.render(context, autoescape=autoescape,
+                              timeout=timeout, max_size=max_size,
+                              compact=compact)
+            if key:
+                output_cache.set(key, ret)
+        return ret
+
+    def profile(self, context, autoescape: bool = True,
+                limit: int = 20, timeout: float = None,
+                max_size: int = None) -> tuple:
+        '''
+        Renders the template under the TemplateProfiler and returns the
+        output and a report of the template lines, including those of any
+        included templates, that took the most time.  The render limits
+        apply as they do to render.
+        '''
+        template = self.get_compiled_template(autoescape=autoescape)
+        timeout, max_size = get_render_limits(self, timeout, max_size)
+        with TemplateProfiler() as profiler:
+            ret = ''.join(limit_stream(self.name, template.generate(context),
+                                       timeout, max_size))
+        return ret, profiler.report(self.get_sources(profiler.names()), limit)
+
+    def get_sources(self, names) -> dict:
+        '''
+        Returns the content of the named templates keyed by name, using
+        this instance's content for its own name.
+        '''
+        sources = {self.name: self.content}
+        others = set(names) - {self.name}
+        if others:
+            sources.update(Template.objects.filter(
+                name__in=others).values_list('name', 'content'))
+        return sources
+
+    def render_stream(self, context, environment: Environment = None,
+                      autoescape: bool = True, timeout: float = None,
+                      max_size: int = None, compact: bool = None):
+        '''
+        Renders the template piece by piece, yielding each chunk of output
+        as it is rendered rather than building the entire output in memory.
+        The render limits are checked as each chunk is yielded.
+        '''
+        if environment:
+            template = environment.from_string(self.content)
+        else:
+            template = self.get_compiled_template(autoescape=autoescape,
+                                                  compact=compact)
+        chunks = template.generate(context)
+        timeout, max_size = get_render_limits(self, timeout, max_size)
+        if timeout or max_size:
+            chunks = limit_stream(self.name, chunks, timeout, max_size)
+        return self._measure_stream(chunks)
+
+    async def arender(self, context, autoescape: bool = True,
+                      timeout: float = None, max_size: int = None,
+                      compact: bool = None):
+        '''
+        Renders the template asynchronously using an async jinja2
+        environment.  Any database access needed to compile the template,
+        or to load the templates it includes or extends, is run through
+        sync_to_async before rendering starts; a cached template with no
+        references renders without leaving the event loop.
+        '''
+        if generation_watcher.due():
+            await sync_to_async(generation_watcher.check)()
+        options = {'autoescape': autoescape, 'enable_async': True,
+                   'compact': self.compact if compact is None else compact}
+        template = template_cache.peek(self.name, self.content,
+                                       checksum=self.get_checksum(),
+                                       **options)
+        if template is None:
+            template = await sync_to_async(self.get_compiled_template)(
+                **options)
+        references = getattr(template, 'quartet_references', None)
+        if references is None:
+            references = find_references(template.environment, self.content)
+            template.quartet_references = references
+        if references:
+            await sync_to_async(load_references)(template.environment,
+                                                 references)
+        timeout, max_size = get_render_limits(self, timeout, max_size)
+        start = perf_counter()
+        if timeout or max_size:
+            ret = ''.join([chunk async for chunk in alimit_stream(
+                self.name, template.generate_async(context), timeout,
+                max_size)])
+        else:
+            ret = await template.render_async(context)
+        render_metrics.record_render(self.name, perf_counter() - start,
+                                     len(ret), flush=False)
+        if render_metrics.flush_due():
+            await sync_to_async(render_metrics.flush)()
+        return ret
+
+    def render_many(self, contexts, autoescape: bool = True,
+                    processes: int = None, chunk_size: int = 100,
+                    compact: bool = None, timeout: float = None,
+                    max_size: int = None):
+        '''
+        Renders the template once for each context in the contexts
+        iterable, compiling it only once, and yields the rendered output
+        in order.  If processes is greater than one the contexts are
+        rendered in chunks of chunk_size by a pool of worker processes.
+        The render limits apply to each render as they do to render.
+        '''
+        compact = self.compact if compact is None else compact
+        timeout, max_size = get_render_limits(self, timeout, max_size)
+        if processes and processes > 1:
+            yield from render_in_pool(self.name, self.content, contexts,
+                                      processes, chunk_size, timeout=timeout,
+                                      max_size=max_size,
+                                      autoescape=autoescape, compact=compact)
+            return
+        template = self.get_compiled_template(autoescape=autoescape,
+                                              compact=compact)
+        for context in contexts:
+            start = perf_counter()
+            if timeout or max_size:
+                ret = ''.join(limit_stream(
+                    self.name, template.generate(context), timeout,
+                    max_size))
+            else:
+                ret = template.render(context)
+            render_metrics.record_render(self.name, perf_counter() - start,
+                                         len(ret))
+            yield ret
+
+    def _measure_stream(self, chunks):
+        '''
+        Passes through the chunks of a streamed render and records the
+        time spent rendering them and the size of the output.
+        '''
+        elapsed = 0.0
+        size = 0
+        start = perf_counter()
+        for chunk in chunks:
+            elapsed += perf_counter() - start
+            size += len(chunk)
+            yield chunk
+            start = perf_counter()
+        elapsed += perf_counter() - start
+        render_metrics.record_render(self.name, elapsed, size)
+
+    def get_compiled_template(self, trim_blocks: bool = True,
+                              lstrip_blocks: bool = True,
+                              autoescape: bool = True,
+                              enable_async: bool = False,
+                              compact: bool = None,
+                              event_templates: bool = False
+                              ) -> JinjaTemplate:
+        '''
+        Returns the compiled jinja2 template for this instance from the
+        process-wide template cache, compiling it on a cache miss.  If
+        compact is None the template's compact setting is used.  Event
+        templates can include the EPCPyYes package templates.
+        '''
+        return template_cache.get_template(
+            self.name,
+            self.content,
+            trim_blocks=trim_blocks,
+            lstrip_blocks=lstrip_blocks,
+            autoescape=autoescape,
+            enable_async=enable_async,
+            compact=self.compact if compact is None else compact,
+            event_templates=event_templates,
+            checksum=self.get_checksum()
+        )
+
+    def get_variables(self, autoescape: bool = True,
+                      enable_async: bool = False,
+                      compact: bool = None) -> frozenset:
+        '''
+        Returns the names of the context variables the template, or any
+        template it includes, extends or imports, can look up or None if
+        that can not be known ahead of rendering.  The result is kept with
+        the compiled template so it is only worked out once per version.
+        '''
+        template = self.get_compiled_template(autoescape=autoescape,
+                                              enable_async=enable_async,
+                                              compact=compact)
+        if not hasattr(template, 'quartet_variables'):
+            template.quartet_variables = collect_variables(
+                template.environment, self.content)
+        return template.quartet_variables
 
     def __str__(self):
         return self.name
@@ -46,3 +360,201 @@ class Template(models.Model):
         verbose_name = 'Template'
         ordering = ['name']
 
+
+class TemplateContent(models.Model):
+    '''
+    A template body stored once for every template with identical
+    content, optionally zlib compressed.  Used when the
+    QUARTET_TEMPLATES_CONTENT_STORE setting is enabled.
+    '''
+    hash = models.CharField(
+        max_length=40,
+        null=False,
+        blank=False,
+        unique=True,
+        help_text="The sha1 hash of the template content.")
+    data = models.BinaryField(
+        help_text="The utf-8 encoded, optionally compressed, content.")
+    compressed = models.BooleanField(
+        default=False,
+        help_text="Whether or not the data is zlib compressed.")
+    size = models.PositiveIntegerField(
+        help_text="The length of the content in characters.")
+
+    def __str__(self):
+        return self.hash
+
+    class Meta:
+        verbose_name_plural = 'Template Content'
+        verbose_name = 'Template Content'
+
+
+class TemplateGeneration(models.Model):
+    '''
+    A single row holding the global template generation, a counter that
+    is bumped whenever any template is saved, imported or deleted.
+    Processes poll it to find out when their cached templates are stale.
+    '''
+    generation = models.BigIntegerField(
+        default=0,
+        help_text="The current template generation.")
+
+    def __str__(self):
+        return str(self.generation)
+
+    class Meta:
+        verbose_name_plural = 'Template Generation'
+        verbose_name = 'Template Generation'
+
+
+class TemplateBytecode(models.Model):
+    '''
+    Stores the marshalled jinja2 bytecode of a compiled template so that
+    other processes can load it instead of compiling the template again.
+    Used by the database backed bytecode cache.
+    '''
+    key = models.CharField(
+        max_length=40,
+        null=False,
+        blank=False,
+        unique=True,
+        help_text="The bytecode cache key.")
+    code = models.BinaryField(
+        help_text="The marshalled template bytecode.")
+    size = models.PositiveIntegerField(
+        help_text="The size of the bytecode in bytes.")
+    last_used = models.DateTimeField(
+        db_index=True,
+        help_text="When the bytecode was last written or loaded.")
+
+    def __str__(self):
+        return self.key
+
+    class Meta:
+        verbose_name_plural = 'Template Bytecode'
+        verbose_name = 'Template Bytecode'
+
+
+class TemplateMetric(models.Model):
+    '''
+    The render metrics gathered for a template by all of the processes
+    that have rendered it.  Times are in seconds and sizes in characters.
+    The histograms are JSON lists of bucket counts used to estimate
+    percentiles.
+    '''
+    template_name = models.CharField(
+        max_length=100,
+        null=False,
+        blank=False,
+        unique=True,
+        help_text="The name of the template the metrics are for.")
+    calls = models.BigIntegerField(
+        default=0,
+        help_text="The number of times the template was rendered.")
+    cache_hits = models.BigIntegerField(
+        default=0,
+        help_text="The number of times the compiled template was found "
+                  "in the template cache.")
+    cache_misses = models.BigIntegerField(
+        default=0,
+        help_text="The number of times the template had to be compiled.")
+    compile_time = models.FloatField(
+        default=0.0,
+        help_text="The total time spent compiling the template.")
+    render_time = models.FloatField(
+        default=0.0,
+        help_text="The total time spent rendering the template.")
+    output_size = models.BigIntegerField(
+        default=0,
+        help_text="The total size of the rendered output.")
+    max_output_size = models.BigIntegerField(
+        default=0,
+        help_text="The size of the largest rendered output.")
+    compile_histogram = models.TextField(
+        blank=True,
+        default='',
+        help_text="Compile time histogram.")
+    render_histogram = models.TextField(
+        blank=True,
+        default='',
+        help_text="Render time histogram.")
+    size_histogram = models.TextField(
+        blank=True,
+        default='',
+        help_text="Output size histogram.")
+
+    def add(self, stats: metrics.TemplateStats):
+        '''
+        Adds the metrics gathered by a process to this instance.
+        '''
+        self.calls += stats.calls
+        self.cache_hits += stats.cache_hits
+        self.cache_misses += stats.cache_misses
+        self.compile_time += stats.compile_time
+        self.render_time += stats.render_time
+        self.output_size += stats.output_size
+        self.max_output_size = max(self.max_output_size,
+                                   stats.max_output_size)
+        self.compile_histogram = json.dumps(metrics.merge_histograms(
+            self.get_histogram('compile_histogram', metrics.TIME_BUCKETS),
+            stats.compile_histogram))
+        self.render_histogram = json.dumps(metrics.merge_histograms(
+            self.get_histogram('render_histogram', metrics.TIME_BUCKETS),
+            stats.render_histogram))
+        self.size_histogram = json.dumps(metrics.merge_histograms(
+            self.get_histogram('size_histogram', metrics.SIZE_BUCKETS),
+            stats.size_histogram))
+
+    def get_histogram(self, field: str, bounds: tuple) -> list:
+        value = getattr(self, field)
+        return json.loads(value) if value else metrics.new_histogram(bounds)
+
+    def get_percentiles(self, field: str, bounds: tuple) -> dict:
+        '''
+        Returns the estimated 50th, 90th and 99th percentiles of one of
+        the histograms.
+        '''
+        histogram = self.get_histogram(field, bounds)
+        return {
+            'p50': metrics.percentile(histogram, bounds, 50),
+            'p90': metrics.percentile(histogram, bounds, 90),
+            'p99': metrics.percentile(histogram, bounds, 99),
+        }
+
+    def __str__(self):
+        return self.template_name
+
+    class Meta:
+        verbose_name_plural = 'Template Metrics'
+        verbose_name = 'Template Metric'
+        ordering = ['template_name']
+
+
+class TemplateDependency(models.Model):
+    '''
+    An edge in the include/extends/import graph: the template includes,
+    extends or imports the template named referenced_name.  The referenced
+    template does not have to exist.  Edges are rebuilt whenever the
+    template content is saved.
+    '''
+    template = models.ForeignKey(
+        Template,
+        on_delete=models.CASCADE,
+        related_name='dependencies',
+        help_text="The template that references another template.")
+    referenced_name = models.CharField(
+        max_length=100,
+        null=False,
+        blank=False,
+        db_index=True,
+        help_text="The name of the included, extended or imported "
+                  "template.")
+
+    def __str__(self):
+        return '%s -> %s' % (self.template_id, self.referenced_name)
+
+    class Meta:
+        verbose_name_plural = 'Template Dependencies'
+        verbose_name = 'Template Dependency'
+        unique_together = ('template', 'referenced_name')
+        ordering = ['template', 'referenced_name']
@@ -0,0 +1,139 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+"""
+An opt-in, in-process cache of rendered output for templates that always
+render the same output for the same inputs.  Entries are keyed by the
+template name and content hash and a hash of the context variables the
+template uses.  Templates that use the non-deterministic `epoch`,
+`random`, `UUID` or `datetime` variables, the `lipsum` global or the
+`random` filter, or whose inputs can not be hashed, are never cached.
+"""
+import json
+import threading
+from collections import OrderedDict
+from hashlib import sha1
+
+from django.conf import settings
+
+from quartet_templates.cache import RANDOM_FILTER
+
+NON_DETERMINISTIC = frozenset(['epoch', 'random', 'UUID', 'datetime',
+                               'lipsum', RANDOM_FILTER])
+# the JSON types whose values are serialized as they are
+SCALAR_TYPES = (str, int, float, bool, type(None))
+
+
+def serialize(value):
+    """
+    Converts a context value into JSON serializable lists that keep the
+    type of every value, so i.e. `{1: 'v'}` and `{'1': 'v'}` or a tuple
+    and a list with the same items do not serialize alike.
+    :param value: A context value.
+    :return: A JSON serializable value.
+    :raises TypeError: If the value contains an unsupported type.
+    """
+    if isinstance(value, SCALAR_TYPES):
+        return [type(value).__name__, value]
+    elif isinstance(value, (list, tuple)):
+        return [type(value).__name__, [serialize(item) for item in value]]
+    elif isinstance(value, dict):
+        items = [[serialize(key), serialize(item)]
+                 for key, item in value.items()]
+        return ['dict', sorted(items, key=json.dumps)]
+    raise TypeError('%s values can not be serialized.' % type(value).__name__)
+
+
+def make_key(name: str, checksum: str, autoescape: bool, context: dict,
+             variables: frozenset, compact: bool = False) -> tuple:
+    """
+    Returns the output cache key for a render or None if the render can
+    not be cached.
+    :param name: The template name.
+    :param checksum: The content hash of the template.
+    :param autoescape: The autoescape option the template is rendered with.
+    :param context: The render context.
+    :param variables: The variables the template uses, see
+    Template.get_variables.
+    :param compact: Whether or not the template is compiled compact.
+    :return: A tuple of (name, digest) or None.
+    """
+    if variables is None or variables & NON_DETERMINISTIC:
+        return None
+    inputs = {variable: context[variable] for variable in variables
+              if variable in context}
+    try:
+        serialized = json.dumps([checksum, autoescape, compact,
+                                 serialize(inputs)])
+    except (TypeError, ValueError):
+        return None
+    return name, sha1(serialized.encode('utf-8')).hexdigest()
+
+
+class OutputCache:
+    """
+    A thread-safe LRU cache of rendered output bounded by the total size,
+    in utf-8 encoded bytes, of the output it holds.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self._outputs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> str:
+        with self._lock:
+            entry = self._outputs.get(key)
+            if entry is None:
+                return None
+            self._outputs.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: tuple, output: str):
+        size = len(output.encode('utf-8'))
+        if size > self.max_size:
+            return
+        with self._lock:
+            previous = self._outputs.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self._outputs[key] = (output, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self._outputs.popitem(last=False)[1][1]
+
+    def invalidate(self, name: str):
+        """
+        Removes the cached output of the named template.
+        :param name: The name of the template that changed.
+        :return: None
+        """
+        with self._lock:
+            for key in [key for key in self._outputs if key[0] == name]:
+                self.size -= self._outputs.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._outputs.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._outputs)
+
+
+output_cache = OutputCache(
+    getattr(settings, 'QUARTET_TEMPLATES_OUTPUT_CACHE_SIZE',
+            16 * 1024 * 1024)
+)
@@ -0,0 +1,192 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import json
+import logging
+import os
+import threading
+
+from django.conf import settings
+from jinja2 import Template as JinjaTemplate
+from jinja2.environment import Environment
+from jinja2.exceptions import TemplateNotFound
+from jinja2.loaders import ModuleLoader
+
+from quartet_templates.compact import is_compact
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+
+# the option sets templates are rendered with by default, the
+# TemplateStep auto escapes and the ChangeTemplatesStep does not
+DEFAULT_OPTION_SETS = (
+    {'trim_blocks': True, 'lstrip_blocks': True, 'autoescape': True},
+    {'trim_blocks': True, 'lstrip_blocks': True, 'autoescape': False},
+)
+
+
+def get_option_directory(target: str, trim_blocks: bool = True,
+                         lstrip_blocks: bool = True, autoescape: bool = True,
+                         enable_async: bool = False,
+                         compact: bool = False) -> str:
+    """
+    Returns the directory the templates compiled with a given option set
+    are stored in.  Compiled code depends on the environment options so
+    each option set gets its own directory.
+    """
+    directory = 'trim%d_lstrip%d_escape%d_async%d' % (
+        trim_blocks, lstrip_blocks, autoescape, enable_async)
+    if compact:
+        directory += '_compact'
+    return os.path.join(target, directory)
+
+
+def compile_all(target: str, option_sets=DEFAULT_OPTION_SETS,
+                log_function=None) -> int:
+    """
+    Compiles every Template into python modules below the target directory
+    using jinja2's compile_templates, one directory per option set.
+    Templates marked compact are compiled into the compact variant of
+    each option set.  Each directory gets a manifest of the content hash
+    each module was compiled from so stale modules are never used.
+    :param target: The directory to compile the templates into.
+    :param option_sets: The environment options to compile for.
+    :param log_function: Passed to jinja2's compile_templates.
+    :return: The number of templates compiled per option set.
+    """
+    from quartet_templates.cache import get_environment, content_hash
+    from quartet_templates.models import Template
+    # the hashes are read before compiling, if a template changes in
+    # between its hash will not match and it will be compiled live
+    hashes = {False: {}, True: {}}
+    for name, content, compact in Template.objects.values_list(
+            'name', 'content', 'compact').iterator():
+        hashes[compact][name] = content_hash(content)
+    count = 0
+    for options in option_sets:
+        count = 0
+        for compact, compact_hashes in hashes.items():
+            if not compact_hashes:
+                continue
+            options = dict(options, compact=compact)
+            environment = get_environment(**options)
+            directory = get_option_directory(target, **options)
+            environment.compile_templates(
+                directory,
+                filter_func=lambda name: name in compact_hashes,
+                zip=None,
+                log_function=log_function
+            )
+            manifest = {
+                name: checksum for name, checksum in compact_hashes.items()
+                if os.path.exists(os.path.join(
+                    directory, ModuleLoader.get_module_filename(name)))
+            }
+            temporary = os.path.join(directory, MANIFEST + '.tmp')
+            with open(temporary, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(temporary, os.path.join(directory, MANIFEST))
+            count += len(manifest)
+    return count
+
+
+class PrecompiledTemplates:
+    """
+    Loads templates compiled by the compile_quartet_templates management
+    command from the QUARTET_TEMPLATES_COMPILED_DIR directory.  A module is
+    only used when the content hash it was compiled from matches the
+    current content of the template.
+    """
+
+    def __init__(self, target: str = None):
+        self.target = target
+        self._loaders = {}
+        self._lock = threading.Lock()
+
+    def _get_loader(self, options: tuple):
+        loader = self._loaders.get(options)
+        if loader is None:
+            with self._lock:
+                loader = self._loaders.get(options)
+                if loader is None:
+                    directory = get_option_directory(self.target, *options)
+                    try:
+                        with open(os.path.join(directory, MANIFEST)) as f:
+                            manifest = json.load(f)
+                    except (OSError, ValueError):
+                        manifest = {}
+                    loader = self._loaders[options] = (
+                        ModuleLoader(directory), manifest)
+        return loader
+
+    def load(self, environment: Environment, name: str,
+             checksum: str) -> JinjaTemplate:
+        """
+        Returns the precompiled template or None if there is no module for
+        the template or it was compiled from different content.
+        :param environment: The environment the template is used with.
+        :param name: The template name.
+        :param checksum: The content hash of the current template content.
+        :return: A jinja2 Template or None.
+        """
+        if not self.target:
+            return None
+        options = (environment.trim_blocks, environment.lstrip_blocks,
+                   bool(environment.autoescape), environment.is_async,
+                   is_compact(environment))
+        loader, manifest = self._get_loader(options)
+        if manifest.get(name) != checksum:
+            return None
+        try:
+            return loader.load(environment, name)
+        except TemplateNotFound:
+            logger.warning('The precompiled module for template %s could '
+                           'not be loaded.', name)
+            return None
+
+    def reset(self):
+        with self._lock:
+            self._loaders = {}
+
+
+def warm_up(option_sets=DEFAULT_OPTION_SETS) -> int:
+    """
+    Compiles, or loads, the most recently modified templates into the
+    template cache so the first renders after a deploy do not pay the
+    compile cost.  Each template is loaded in its compact setting.  No
+    more templates are loaded than the cache can hold.
+    This queries the database so it is meant to be called once a process
+    is serving requests, i.e. from a wsgi module or a worker start hook,
+    and never while django is being set up.
+    :param option_sets: The environment options to load templates for.
+    :return: The number of templates loaded.
+    """
+    from quartet_templates.cache import template_cache
+    from quartet_templates.models import Template
+    limit = template_cache.max_size // max(len(option_sets), 1)
+    count = 0
+    for name, content, compact in Template.objects.order_by(
+            '-modified').values_list(
+            'name', 'content', 'compact')[:limit].iterator():
+        for options in option_sets:
+            template_cache.get_template(name, content,
+                                        **dict(options, compact=compact))
+        count += 1
+    return count
+
+
+precompiled_templates = PrecompiledTemplates(
+    getattr(settings, 'QUARTET_TEMPLATES_COMPILED_DIR', None)
+)
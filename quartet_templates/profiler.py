@@ -0,0 +1,136 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+"""
+A tracing profiler that attributes render time to template source lines.
+Frames of jinja2 generated code are recognized by the template jinja2
+stores in their globals and each line executed is mapped back to the
+template line it was generated from with the template's debug info.  The
+time until the next line runs, including any filters, tests or python
+methods called from the line, is charged to that template line.
+"""
+import sys
+from time import perf_counter
+
+
+class TemplateProfiler:
+    """
+    Profiles the templates rendered in the current thread while it is used
+    as a context manager.  A profiler that is not enabled does nothing so
+    callers can use one unconditionally.
+
+        with TemplateProfiler() as profiler:
+            template.render(context)
+        print(profiler.format_report())
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.stats = {}
+        self._lines = {}
+        self._last = None
+        self._last_time = None
+        self._previous_trace = None
+
+    def __enter__(self):
+        if self.enabled:
+            self._previous_trace = sys.gettrace()
+            sys.settrace(self._trace_calls)
+        return self
+
+    def __exit__(self, *args):
+        if self.enabled:
+            sys.settrace(self._previous_trace)
+            self._charge(perf_counter())
+            self._last = None
+
+    def _trace_calls(self, frame, event, arg):
+        if '__jinja_template__' in frame.f_globals:
+            return self._trace_lines
+        return None
+
+    def _trace_lines(self, frame, event, arg):
+        now = perf_counter()
+        self._charge(now)
+        if event == 'line':
+            entry = self._lines.get((frame.f_code, frame.f_lineno))
+            if entry is None:
+                template = frame.f_globals['__jinja_template__']
+                entry = self._lines[frame.f_code, frame.f_lineno] = (
+                    (template.name or '<template>',
+                     template.get_corresponding_lineno(frame.f_lineno)),
+                    any(frame.f_lineno == code_line
+                        for line, code_line in template.debug_info))
+            key, starts_line = entry
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = [0, 0.0]
+            # a template line generates several python lines, only count
+            # the first of them
+            if starts_line:
+                stats[0] += 1
+            self._last = key
+        elif event == 'return':
+            # the frame returned or yielded output, the time until it runs
+            # again is spent by its caller
+            self._last = None
+        self._last_time = perf_counter()
+        return self._trace_lines
+
+    def _charge(self, now: float):
+        if self._last is not None:
+            self.stats[self._last][1] += now - self._last_time
+
+    def names(self) -> set:
+        """
+        Returns the names of the templates that were profiled.
+        """
+        return {name for name, line in self.stats}
+
+    def report(self, sources: dict = None, limit: int = 20) -> list:
+        """
+        Returns the template lines that took the most time.
+        :param sources: The source of each template by name, used to add
+        the text of each line to the report.
+        :param limit: The maximum number of lines to report.
+        :return: A list of dictionaries with the template name, line
+        number, source text, number of times the line ran and seconds
+        spent on it, slowest first.
+        """
+        sources = sources or {}
+        rows = sorted(self.stats.items(), key=lambda item: item[1][1],
+                      reverse=True)[:limit]
+        report = []
+        for (name, line), (hits, seconds) in rows:
+            lines = sources.get(name, '').splitlines()
+            report.append({
+                'template': name,
+                'line': line,
+                'source': lines[line - 1].strip() if line <= len(lines)
+                else '',
+                'hits': hits,
+                'seconds': seconds,
+            })
+        return report
+
+    def format_report(self, sources: dict = None, limit: int = 20) -> str:
+        """
+        Returns the report as a text table for the task messages.
+        """
+        lines = ['%10s %8s  %s' % ('seconds', 'hits', 'template:line')]
+        for row in self.report(sources, limit):
+            lines.append('%10.6f %8d  %s:%s  %s' % (
+                row['seconds'], row['hits'], row['template'], row['line'],
+                row['source']))
+        return '\n'.join(lines)
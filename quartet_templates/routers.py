@@ -24,4 +24,16 @@ router.register(
     basename="templates"
 )
 
+router.register(
+    r'template-metrics',
+    views.TemplateMetricViewSet,
+    basename="template-metrics"
+)
+
+router.register(
+    r'template-dependencies',
+    views.TemplateDependencyViewSet,
+    basename="template-dependencies"
+)
+
 urlpatterns = router.urls
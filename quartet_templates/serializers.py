@@ -12,15 +12,87 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 # Copyright 2018 SerialLab Corp.  All rights reserved.
-from rest_framework.serializers import ModelSerializer
+from rest_framework.serializers import ModelSerializer, \
+    SerializerMethodField, CharField
 from quartet_templates import models
+from quartet_templates import metrics
 
 
+class FieldsMixin:
+    '''
+    Limits the serialized fields to those named in a comma separated
+    `fields` query parameter, if one was passed, when listing or
+    retrieving.  Creates and updates always use every field.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        view = self.context.get('view')
+        requested = None
+        if request and getattr(view, 'action', None) in ('list', 'retrieve'):
+            requested = get_requested_fields(request)
+        if requested:
+            for field_name in set(self.fields) - requested:
+                self.fields.pop(field_name)
+
+
+def get_requested_fields(request) -> set:
+    '''
+    Returns the field names in the `fields` query parameter of the
+    request or None if no fields were requested.
+    '''
+    fields = request.query_params.get('fields')
+    if fields:
+        return {field.strip() for field in fields.split(',') if field.strip()}
+
 
-class TemplateSerializer(ModelSerializer):
+class TemplateSerializer(FieldsMixin, ModelSerializer):
     '''
     Default serializer for the Template model.
     '''
     class Meta:
         model = models.Template
         fields = '__all__'
+
+
+class TemplateListSerializer(FieldsMixin, ModelSerializer):
+    '''
+    Lightweight serializer used to list templates without their content.
+    '''
+    class Meta:
+        model = models.Template
+        exclude = ('content',)
+
+
+class TemplateMetricSerializer(ModelSerializer):
+    '''
+    Read only serializer for the TemplateMetric model.  The histograms are
+    returned as estimated percentiles.
+    '''
+    compile_time_percentiles = SerializerMethodField()
+    render_time_percentiles = SerializerMethodField()
+    output_size_percentiles = SerializerMethodField()
+
+    def get_compile_time_percentiles(self, obj: models.TemplateMetric):
+        return obj.get_percentiles('compile_histogram', metrics.TIME_BUCKETS)
+
+    def get_render_time_percentiles(self, obj: models.TemplateMetric):
+        return obj.get_percentiles('render_histogram', metrics.TIME_BUCKETS)
+
+    def get_output_size_percentiles(self, obj: models.TemplateMetric):
+        return obj.get_percentiles('size_histogram', metrics.SIZE_BUCKETS)
+
+    class Meta:
+        model = models.TemplateMetric
+        exclude = ('compile_histogram', 'render_histogram', 'size_histogram')
+
+
+class TemplateDependencySerializer(ModelSerializer):
+    '''
+    Read only serializer for the TemplateDependency model.
+    '''
+    template_name = CharField(source='template.name', read_only=True)
+
+    class Meta:
+        model = models.TemplateDependency
+        fields = ('id', 'template', 'template_name', 'referenced_name')
@@ -0,0 +1,60 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from quartet_templates.cache import template_cache
+from quartet_templates.dependencies import get_dependents
+from quartet_templates.generation import next_generation
+from quartet_templates.loaders import template_loader
+from quartet_templates.output import output_cache
+from quartet_templates.models import Template
+
+
+def invalidate(*names: str):
+    """
+    Removes any compiled versions and cached output of the named
+    templates, and of every template that includes, extends or imports
+    them, and marks them out of date in the template loader.  Templates
+    that do not depend on the changed templates are left alone.
+    Call this after changing templates without sending model signals,
+    i.e. with bulk_create or bulk_update.
+    :param names: The names of the templates that changed.
+    :return: None
+    """
+    for name in set(names) | get_dependents(*names):
+        template_cache.invalidate(name)
+        template_loader.invalidate(name)
+        output_cache.invalidate(name)
+
+
+@receiver(post_save, sender=Template)
+@receiver(post_delete, sender=Template)
+def invalidate_template_cache(sender, instance: Template, **kwargs):
+    """
+    Invalidates a template when it is changed or deleted, under its old
+    name as well if it was renamed.
+    """
+    invalidate(*instance.get_names())
+    instance.loaded_name = instance.name
+
+
+@receiver(post_delete, sender=Template)
+def bump_generation(sender, instance: Template, **kwargs):
+    """
+    Bumps the global template generation, inside the delete transaction,
+    so other processes drop the deleted template.
+    """
+    next_generation()
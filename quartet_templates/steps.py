@@ -13,20 +13,308 @@
 #
 # Copyright 2018 SerialLab Corp.  All rights reserved.
 
+import os
 import sys
+import zlib
 import random
+import tempfile
+from hashlib import sha1
 from uuid import uuid4
 from time import time
 from datetime import datetime
 
-from jinja2.environment import Environment
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from quartet_templates.models import Template
+from quartet_templates.batch import pack_event, render_events_in_pool
+from quartet_templates.profiler import TemplateProfiler
+from quartet_templates.limits import RenderLimitExceeded, RenderBudget, \
+    get_render_limits
 from quartet_capture.rules import Step, RuleContext
-from quartet_capture.models import Task
+from quartet_capture.models import Task, StepParameter
+from django.db.models import Q
 from quartet_output.steps import ContextKeys
+from EPCPyYes.core.v1_2.template_events import TransactionEvent
 
 
-class TemplateStep(Step):
+# the rule context key the templates used by a rule are shared under
+TEMPLATES_CONTEXT_KEY = 'QUARTET_TEMPLATES'
+
+# the zlib window bits of each supported output compression
+COMPRESSION_WBITS = {
+    'gzip': 31,
+    'zlib': 15,
+}
+# the number of characters of rendered output passed to the compressor
+# at a time
+COMPRESSION_BUFFER_SIZE = 64 * 1024
+
+# the step parameters, of any step, that name a template
+TEMPLATE_PARAMETERS = (
+    'Template Name',
+    'Object Event Template',
+    'Aggregation Event Template',
+    'Transaction Event Template',
+    'Header Template',
+    'Item Template',
+    'Footer Template',
+)
+
+
+class RuleTemplatesMixin:
+    """
+    Loads every template named by the template parameters of all of the
+    steps in the current rule with a single query the first time a
+    template step in the rule asks for a template.  The templates are
+    shared with the rule's other steps through the rule context for the
+    rest of the task.
+    """
+
+    def get_rule_templates(self, rule_context: RuleContext,
+                           names) -> dict:
+        """
+        Returns the named templates, loading the rule's templates if they
+        have not been loaded for this task yet.
+        :param rule_context: The rule context.
+        :param names: The template names, empty names are ignored.
+        :return: A dictionary of Template instances keyed by name.  Names
+        of templates that do not exist are left out.
+        """
+        names = [name for name in names if name]
+        templates = rule_context.context.get(TEMPLATES_CONTEXT_KEY)
+        if templates is None:
+            templates = rule_context.context[TEMPLATES_CONTEXT_KEY] = \
+                self.prefetch_templates(names)
+        missing = [name for name in names if name not in templates]
+        if missing:
+            templates.update((template.name, template) for template in
+                             Template.objects.filter(name__in=missing))
+        return {name: templates[name] for name in names if name in templates}
+
+    def get_rule_template(self, rule_context: RuleContext,
+                          name: str) -> Template:
+        """
+        Returns a single template by name.
+        :raises Template.DoesNotExist: If the template does not exist.
+        """
+        template = self.get_rule_templates(rule_context, [name]).get(name)
+        if template is None:
+            raise Template.DoesNotExist(
+                'Template with name %s does not exist.' % name)
+        return template
+
+    async def aget_rule_template(self, rule_context: RuleContext,
+                                 name: str) -> Template:
+        """
+        An async version of get_rule_template that queries the database
+        with the async ORM.
+        :raises Template.DoesNotExist: If the template does not exist.
+        """
+        templates = rule_context.context.get(TEMPLATES_CONTEXT_KEY)
+        if templates is None:
+            templates = rule_context.context[TEMPLATES_CONTEXT_KEY] = {
+                template.name: template async for template in
+                Template.objects.filter(self.get_prefetch_query([name]))}
+        if name not in templates:
+            templates[name] = await Template.objects.aget(name=name)
+        return templates[name]
+
+    def prefetch_templates(self, names) -> dict:
+        """
+        Loads the named templates and every template named in the
+        parameters of the steps of the current task's rule with a single
+        query.
+        :param names: The template names this step needs.
+        :return: A dictionary of Template instances keyed by name.
+        """
+        return {template.name: template for template in
+                Template.objects.filter(self.get_prefetch_query(names))}
+
+    def get_prefetch_query(self, names) -> Q:
+        """
+        Returns the filter matching the named templates and every template
+        named in the parameters of the steps of the current task's rule.
+        """
+        query = Q(name__in=names)
+        rule_id = getattr(self.task, 'rule_id', None)
+        if rule_id:
+            query |= Q(name__in=StepParameter.objects.filter(
+                step__rule_id=rule_id, name__in=TEMPLATE_PARAMETERS
+            ).values('value'))
+        return query
+
+    def get_templates(self, rule_context: RuleContext, names: list) -> dict:
+        """
+        Returns the named templates from those loaded for the rule.
+        :param rule_context: The rule context.
+        :param names: The template names, empty names are ignored.
+        :return: A dictionary of Template instances keyed by name.
+        :raises Template.DoesNotExist: If a template could not be found.
+        """
+        names = [name for name in names if name]
+        templates = self.get_rule_templates(rule_context, names)
+        missing = set(names) - set(templates)
+        if missing:
+            self.error('Could not find the templates %s.',
+                       ', '.join(sorted(missing)))
+            raise Template.DoesNotExist(
+                'Could not find the templates %s.' % ', '.join(
+                    sorted(missing)))
+        return templates
+
+
+class TemplateOutputMixin:
+    """
+    The context, render limit and output handling shared by the steps that
+    render templates.
+    """
+
+    def get_context(self, data, rule_context: RuleContext,
+                    variables: frozenset = None) -> dict:
+        """
+        Builds the context the template is rendered with.  The data and
+        rule context are always included, every other value is only
+        computed if its name is in `variables` so a template that does not
+        use, i.e., the task parameters does not pay for the query.
+        :param data: The data passed into the step.
+        :param rule_context: The rule context.
+        :param variables: The variable names the template uses, see
+        Template.get_variables, or None to compute every value.
+        :return: A dictionary of template variables.
+        """
+        context = {'data': data, 'rule_context': rule_context}
+        for name, provider in self.get_context_providers(
+                rule_context).items():
+            if variables is None or name in variables:
+                context[name] = provider()
+        return context
+
+    def get_context_providers(self, rule_context: RuleContext) -> dict:
+        """
+        Returns the functions that compute the optional context values,
+        keyed by variable name.
+        :param rule_context: The rule context.
+        :return: A dictionary of callables.
+        """
+        return {
+            'step_parameters': lambda: self.parameters,
+            'task_parameters': lambda: self.get_task_parameters(rule_context),
+            'epoch': time,
+            'random': lambda: random.randint(1, sys.maxsize),
+            'UUID': lambda: str(uuid4()),
+            'datetime': lambda: datetime.isoformat(datetime.now())
+        }
+
+    def get_all_variables(self, templates, autoescape: bool,
+                          compact: bool = None) -> frozenset:
+        """
+        Returns the variables used by any of the templates or None if any
+        template's variables can not be known.
+        """
+        variables = frozenset()
+        for template in templates:
+            used = template.get_variables(autoescape, compact=compact)
+            if used is None:
+                return None
+            variables |= used
+        return variables
+
+    def get_render_limits(self) -> tuple:
+        """
+        Reads the render budget from the "Render Timeout" and "Max Output
+        Size" step parameters.  Limits that are not configured are
+        returned as None so the limits of the template, or the defaults in
+        settings, apply.
+        :return: A tuple of (timeout in seconds, max output size in bytes).
+        """
+        timeout = self.get_parameter('Render Timeout')
+        max_size = self.get_parameter('Max Output Size')
+        return (float(timeout) if timeout else None,
+                int(max_size) if max_size else None)
+
+    def handle_output(self, output, data, rule_context: RuleContext,
+                      context_key: str = None):
+        """
+        Places the output into the context key, if one was configured, or
+        returns it to the rule in place of the inbound data.
+        :param output: The rendered output or the path to the output file.
+        :param data: The data passed into the step.
+        :param rule_context: The rule context.
+        :param context_key: The context key to place the output into.
+        :return: The data to return to the rule.
+        """
+        if context_key:
+            self.info("Placing rendered content into context key %s.",
+                      context_key)
+            rule_context.context[context_key] = output
+        else:
+            self.info("Returning rendered content to the rule.")
+            data = output
+        return data
+
+    def describe_output(self, output: str) -> str:
+        """
+        Describes rendered output for the task messages without logging
+        the entire document.  The output is truncated to the number of
+        characters in the "Preview Length" step parameter (or the
+        QUARTET_TEMPLATES_PREVIEW_LENGTH setting, default 200).  A preview
+        length of 0 will log a sha1 digest of the output instead.
+        :param output: The rendered output.
+        :return: A description of the output.
+        """
+        if isinstance(output, bytes):
+            return '(%s compressed bytes, sha1 %s)' % (
+                len(output), sha1(output).hexdigest())
+        length = self.get_integer_parameter(
+            'Preview Length',
+            getattr(settings, 'QUARTET_TEMPLATES_PREVIEW_LENGTH', 200)
+        )
+        if length <= 0:
+            return '(%s characters, sha1 %s)' % (
+                len(output), sha1(output.encode('utf-8')).hexdigest())
+        elif len(output) > length:
+            return '(%s characters): %s...' % (len(output), output[:length])
+        return '(%s characters): %s' % (len(output), output)
+
+    def open_output_file(self, rule_context: RuleContext,
+                         compression: str = None):
+        """
+        Creates the file rendered output is streamed into, named after the
+        current task, in the "Stream Directory" or the system temp
+        directory.  The file is not deleted when it is closed.
+        :param rule_context: The rule context.
+        :param compression: If given, the file is opened for writing the
+        compressed bytes and named with a .gz or .zz extension.
+        :return: A file object opened for writing text, or bytes if a
+        compression was given.
+        """
+        if compression:
+            return tempfile.NamedTemporaryFile(
+                mode='wb',
+                prefix='%s_' % rule_context.task_name,
+                suffix='.out.gz' if compression == 'gzip' else '.out.zz',
+                dir=self.get_parameter('Stream Directory'),
+                delete=False
+            )
+        return tempfile.NamedTemporaryFile(
+            mode='w',
+            encoding='utf-8',
+            prefix='%s_' % rule_context.task_name,
+            suffix='.out',
+            dir=self.get_parameter('Stream Directory'),
+            delete=False
+        )
+
+    def _write(self, write, template: Template, context: dict,
+               autoescape: bool, budget: RenderBudget, compact: bool = None):
+        for chunk in budget.watch(template.render_stream(
+                context, autoescape=autoescape, timeout=0, max_size=0,
+                compact=compact)):
+            budget.spend(chunk)
+            write(chunk)
+
+
+class TemplateStep(RuleTemplatesMixin, TemplateOutputMixin, Step):
     """
     Will load a template based on the step parameter "Template Name" and
     render it using a combination of rule data, context variables and
@@ -42,32 +330,214 @@ class TemplateStep(Step):
         context_key = self.get_parameter("Context Key")
         self.info("Template Name parameter value found: %s.  "
                   "Looking up Template...", template_name)
-        template = Template.objects.get(name=template_name)
+        template = self.get_rule_template(rule_context, template_name)
         self.info("Found template...rendering...")
-        environment = Environment(
-            trim_blocks=True,
-            lstrip_blocks=True,
-            autoescape=self.get_boolean_parameter('Auto Escape', True)
+        autoescape = self.get_boolean_parameter('Auto Escape', True)
+        compact = self.get_boolean_parameter('Compact', None)
+        timeout, max_size = self.get_render_limits()
+        context = self.get_context(
+            data, rule_context, template.get_variables(autoescape,
+                                                       compact=compact))
+        profiler = TemplateProfiler(self.get_boolean_parameter(
+            'Profile', getattr(settings, 'QUARTET_TEMPLATES_PROFILE', False)))
+        compression = self.get_compression()
+        try:
+            with profiler:
+                if self.get_boolean_parameter('Stream To File', False):
+                    ret = self.render_to_file(
+                        template, context, rule_context,
+                        autoescape=autoescape, timeout=timeout,
+                        max_size=max_size, compact=compact,
+                        compression=compression)
+                    self.info("Template rendered to file %s.", ret)
+                elif compression:
+                    ret = self.render_compressed(
+                        template, context, compression,
+                        autoescape=autoescape, timeout=timeout,
+                        max_size=max_size, compact=compact)
+                    self.info("Template response %s",
+                              self.describe_output(ret))
+                else:
+                    render = template.render
+                    if self.get_boolean_parameter('Cache Output', getattr(
+                            settings, 'QUARTET_TEMPLATES_OUTPUT_CACHE',
+                            False)):
+                        render = template.render_cached
+                    ret = render(context, autoescape=autoescape,
+                                 timeout=timeout, max_size=max_size,
+                                 compact=compact)
+                    self.info("Template response %s",
+                              self.describe_output(ret))
+        except RenderLimitExceeded as e:
+            self.error(str(e))
+            raise
+        finally:
+            if profiler.enabled:
+                self.info("Template profile:\n%s", profiler.format_report(
+                    template.get_sources(profiler.names())))
+        return self.handle_output(ret, data, rule_context, context_key)
+
+    async def aexecute(self, data, rule_context: RuleContext):
+        """
+        An async version of execute for callers running steps in an event
+        loop.  The template is looked up with the async ORM and rendered
+        with Template.arender.  Task messages, task parameters, cached
+        output and streaming to a file use the synchronous ORM, cache or
+        file system and are run through sync_to_async.  Profiling is not
+        supported and the Profile parameter is ignored.
+        """
+        info = sync_to_async(self.info)
+        template_name = self.get_parameter(
+            'Template Name',
+            raise_exception=True
         )
-        ret = template.render({'data': data, 'rule_context': rule_context,
-                               'step_parameters': self.parameters,
-                               'task_parameters': self.get_task_parameters(
-                                   rule_context
-                               ),
-                               'epoch': time(),
-                               'random': random.randint(1, sys.maxsize),
-                               'UUID': str(uuid4()),
-                               'datetime': datetime.isoformat(datetime.now())
-                               }, environment=environment)
-        self.info("Template response %s:", ret)
-        if context_key:
-            self.info("Placing rendered content into context key %s.",
-                      context_key)
-            rule_context.context[context_key] = ret
-        else:
-            self.info("Returning rendered content to the rule.")
-            data = ret
-        return data
+        context_key = self.get_parameter("Context Key")
+        await info("Template Name parameter value found: %s.  "
+                   "Looking up Template...", template_name)
+        template = await self.aget_rule_template(rule_context,
+                                                 template_name)
+        await info("Found template...rendering...")
+        autoescape = self.get_boolean_parameter('Auto Escape', True)
+        compact = self.get_boolean_parameter('Compact', None)
+        timeout, max_size = self.get_render_limits()
+        variables = await sync_to_async(template.get_variables)(
+            autoescape, enable_async=True, compact=compact)
+        context = await sync_to_async(self.get_context)(data, rule_context,
+                                                        variables)
+        compression = self.get_compression()
+        if self.get_boolean_parameter('Profile', getattr(
+                settings, 'QUARTET_TEMPLATES_PROFILE', False)):
+            await info("Profiling is not supported when the step is run "
+                       "asynchronously, rendering without the profiler.")
+        try:
+            if self.get_boolean_parameter('Stream To File', False):
+                ret = await sync_to_async(self.render_to_file)(
+                    template, context, rule_context, autoescape=autoescape,
+                    timeout=timeout, max_size=max_size, compact=compact,
+                    compression=compression)
+                await info("Template rendered to file %s.", ret)
+            elif compression:
+                ret = await sync_to_async(self.render_compressed)(
+                    template, context, compression, autoescape=autoescape,
+                    timeout=timeout, max_size=max_size, compact=compact)
+                await info("Template response %s", self.describe_output(ret))
+            elif self.get_boolean_parameter('Cache Output', getattr(
+                    settings, 'QUARTET_TEMPLATES_OUTPUT_CACHE', False)):
+                ret = await sync_to_async(template.render_cached)(
+                    context, autoescape=autoescape, timeout=timeout,
+                    max_size=max_size, compact=compact)
+                await info("Template response %s", self.describe_output(ret))
+            else:
+                ret = await template.arender(context, autoescape=autoescape,
+                                             timeout=timeout,
+                                             max_size=max_size,
+                                             compact=compact)
+                await info("Template response %s", self.describe_output(ret))
+        except RenderLimitExceeded as e:
+            await sync_to_async(self.error)(str(e))
+            raise
+        return await sync_to_async(self.handle_output)(
+            ret, data, rule_context, context_key)
+
+    def render_to_file(self, template: Template, context: dict,
+                       rule_context: RuleContext,
+                       autoescape: bool = True, timeout: float = None,
+                       max_size: int = None, compact: bool = None,
+                       compression: str = None) -> str:
+        """
+        Streams the rendered template into a file named after the current
+        task so the full output is never held in memory.  The file is
+        created in the directory defined by the "Stream Directory" step
+        parameter or in the system temp directory if none is defined.  If
+        a compression is given the output is compressed as it is written.
+        :param template: The template to render.
+        :param context: The template context.
+        :param rule_context: The rule context.
+        :param autoescape: Whether or not to auto escape the output.
+        :param timeout: The maximum render time in seconds.
+        :param max_size: The maximum output size in bytes.
+        :param compact: Whether or not to compact the template, None uses
+        the template's compact setting.
+        :param compression: gzip, zlib or None, see get_compression.
+        :return: The path of the file the output was written to.
+        """
+        output = self.open_output_file(rule_context, compression)
+        try:
+            with output:
+                chunks = template.render_stream(
+                    context, autoescape=autoescape, timeout=timeout,
+                    max_size=max_size, compact=compact)
+                if compression:
+                    chunks = self.compress_stream(chunks, compression)
+                for chunk in chunks:
+                    output.write(chunk)
+        except Exception:
+            os.remove(output.name)
+            raise
+        return output.name
+
+    def get_compression(self) -> str:
+        """
+        Reads the "Compress Output" step parameter.
+        :return: gzip, zlib or None if the output is not compressed.
+        :raises ValueError: If the parameter names another compression.
+        """
+        compression = self.get_parameter('Compress Output')
+        if not compression:
+            return None
+        compression = compression.strip().lower()
+        if compression not in COMPRESSION_WBITS:
+            raise ValueError('Unknown Compress Output value %s.  Use gzip '
+                             'or zlib.' % compression)
+        return compression
+
+    def render_compressed(self, template: Template, context: dict,
+                          compression: str, autoescape: bool = True,
+                          timeout: float = None, max_size: int = None,
+                          compact: bool = None) -> bytes:
+        """
+        Streams the rendered template through the compressor so only the
+        compressed output is held in memory.
+        :param template: The template to render.
+        :param context: The template context.
+        :param compression: gzip or zlib.
+        :param autoescape: Whether or not to auto escape the output.
+        :param timeout: The maximum render time in seconds.
+        :param max_size: The maximum output size in bytes.
+        :param compact: Whether or not to compact the template, None uses
+        the template's compact setting.
+        :return: The compressed output.
+        """
+        return b''.join(self.compress_stream(template.render_stream(
+            context, autoescape=autoescape, timeout=timeout,
+            max_size=max_size, compact=compact), compression))
+
+    def compress_stream(self, chunks, compression: str):
+        """
+        Encodes the rendered chunks as utf-8 and compresses them
+        incrementally, passing about COMPRESSION_BUFFER_SIZE characters to
+        the compressor at a time.
+        :param chunks: An iterable of rendered strings.
+        :param compression: gzip or zlib.
+        :return: A generator of compressed bytes.
+        """
+        compressor = zlib.compressobj(wbits=COMPRESSION_WBITS[compression])
+        buffer = []
+        size = 0
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= COMPRESSION_BUFFER_SIZE:
+                data = compressor.compress(''.join(buffer).encode('utf-8'))
+                buffer = []
+                size = 0
+                if data:
+                    yield data
+        if buffer:
+            data = compressor.compress(''.join(buffer).encode('utf-8'))
+            if data:
+                yield data
+        yield compressor.flush()
 
     @property
     def declared_parameters(self):
@@ -78,25 +548,78 @@ class TemplateStep(Step):
                            "the rule in place of the inbound data.",
             "Auto Escape": "Whether or not the jinja2 template should be "
                            "auto escaped.  Default is True, set to False if "
-                           "you are embedding XML within XML, etc."
+                           "you are embedding XML within XML, etc.",
+            "Stream To File": "Whether or not to stream the rendered output "
+                              "into a file instead of memory.  If True, the "
+                              "path to the file is placed in the context key "
+                              "or returned to the rule in place of the "
+                              "rendered content.  Default is False.",
+            "Stream Directory": "The directory to stream rendered output "
+                                "files into.  Default is the system temp "
+                                "directory.",
+            "Preview Length": "The number of characters of the rendered "
+                              "output to include in the task messages. "
+                              "Default is 200, set to 0 to log a digest of "
+                              "the output instead.",
+            "Render Timeout": "The maximum number of seconds rendering may "
+                              "take before the step fails.  It is checked "
+                              "as output is written and on each loop "
+                              "iteration, a single slow filter or call is "
+                              "only stopped once it returns.  Overrides the "
+                              "template's render timeout, set to 0 for no "
+                              "limit.",
+            "Max Output Size": "The maximum number of bytes of output "
+                               "rendering may produce before the step "
+                               "fails.  Overrides the template's max output "
+                               "size, set to 0 for no limit.",
+            "Cache Output": "Whether or not to reuse the output of an earlier "
+                            "render with the same inputs.  Templates that use "
+                            "epoch, random, UUID or datetime are always "
+                            "rendered.  Default is the "
+                            "QUARTET_TEMPLATES_OUTPUT_CACHE setting (False).",
+            "Compress Output": "gzip or zlib to compress the rendered output "
+                               "as it is rendered.  The compressed bytes, or "
+                               "the path of the compressed file if Stream To "
+                               "File is True, are placed in the context key "
+                               "or returned to the rule.  Default is no "
+                               "compression.",
+            "Compact": "Whether or not to remove the indentation and line "
+                       "breaks between the tags of the template's static "
+                       "text when it is compiled.  Default is the "
+                       "template's compact setting.",
+            "Profile": "Whether or not to profile the render and add a report "
+                       "of the slowest template lines to the task messages.  "
+                       "Profiling slows rendering down considerably.  "
+                       "Default is the QUARTET_TEMPLATES_PROFILE setting "
+                       "(False)."
         }
 
     def on_failure(self):
         pass
 
 
-class ChangeTemplatesStep(Step):
+class ChangeTemplatesStep(RuleTemplatesMixin, Step):
     """
     Looks for aggregation, object and transaction events on the context using
     the context keys in quartet_output and changes the default template for
-    each event.
+    each event.  The configured templates are loaded with the rule's other
+    templates and each is compiled once and shared by every event it is
+    assigned to.
     """
 
+    def __init__(self, db_task: Task, **kwargs):
+        super().__init__(db_task, **kwargs)
+        self.templates = {}
+
     def execute(self, data, rule_context: RuleContext):
         oe_template = self.get_parameter('Object Event Template')
         ae_template = self.get_parameter('Aggregation Event Template')
+        te_template = self.get_parameter('Transaction Event Template')
+        self.templates = self.get_rule_templates(
+            rule_context, [oe_template, ae_template, te_template])
         self.chagne_object_event_template(rule_context, oe_template)
         self.change_aggregation_event_template(rule_context, ae_template)
+        self.change_transaction_event_template(rule_context, te_template)
         return data
 
     def chagne_object_event_template(self, rule_context: RuleContext,
@@ -137,15 +660,39 @@ class ChangeTemplatesStep(Step):
                           template_name)
                 self.change_templates(aggregation_events, template_name)
 
-    def change_transaction_event_template(self, rule_context: RuleContext):
-        raise NotImplementedError(
-            'This function has not yet been implemented.')
+    def change_transaction_event_template(self, rule_context: RuleContext,
+                                          template_name: str):
+        """
+        quartet_output does not define a context key for transaction events
+        so this iterates through any transaction events in the
+        FILTERED_EVENTS_KEY value and changes each of their templates to
+        the one defined in the Transaction Event Template step parameter.
+        :param rule_context: The rule context.
+        :return: None
+        """
+        if template_name:
+            filtered_events = rule_context.context.get(
+                ContextKeys.FILTERED_EVENTS_KEY.value
+            ) or []
+            transaction_events = [event for event in filtered_events
+                                  if isinstance(event, TransactionEvent)]
+            if transaction_events:
+                self.info('Changing the transaction events template to %s',
+                          template_name)
+                self.change_templates(transaction_events, template_name)
 
     def change_templates(self, events: list, template_name: str):
         try:
-            template = Template.objects.get(name=template_name)
+            template = self.templates.get(template_name)
+            if not template:
+                template = Template.objects.get(name=template_name)
+                self.templates[template_name] = template
+            # EPCPyYes renders events with autoescape off, compile once
+            # and share the compiled template with every event
+            compiled_template = template.get_compiled_template(
+                autoescape=False, event_templates=True)
             for event in events:
-                event.template = template.content
+                event.template = compiled_template
         except Template.DoesNotExist:
             self.error('Could not find a template with the name %s. '
                        'Make sure this is configured as a template.',
@@ -164,3 +711,334 @@ class ChangeTemplatesStep(Step):
 
     def on_failure(self):
         pass
+
+
+class EventStreamStep(RuleTemplatesMixin, TemplateOutputMixin, Step):
+    """
+    Renders a document from a header template, an item template rendered
+    once for each event in a rule context key and a footer template.  The
+    events are iterated lazily and the output is written as it is
+    rendered, to a file by default, so memory use does not grow with the
+    number of events.  Each template is compiled once and reused for every
+    event.  The item template is rendered with the step context plus the
+    `event` and its zero based `index`.
+    """
+
+    def execute(self, data, rule_context: RuleContext):
+        item_name = self.get_parameter('Item Template', raise_exception=True)
+        names = [self.get_parameter('Header Template'), item_name,
+                 self.get_parameter('Footer Template')]
+        templates = self.get_templates(rule_context, names)
+        header, item, footer = [templates.get(name) for name in names]
+        autoescape = self.get_boolean_parameter('Auto Escape', True)
+        compact = self.get_boolean_parameter('Compact', None)
+        events_key = self.get_parameter('Events Context Key',
+                                         ContextKeys.OBJECT_EVENTS_KEY.value)
+        events = rule_context.context.get(events_key) or []
+        context = self.get_context(data, rule_context, self.get_all_variables(
+            templates.values(), autoescape, compact))
+        # the item template's own limits are for a single render, only the
+        # step parameters and settings limit the whole document
+        budget = RenderBudget(item.name, *get_render_limits(
+            None, *self.get_render_limits()))
+        self.info('Rendering the events in context key %s with template '
+                  '%s.', events_key, item.name)
+        try:
+            if self.get_boolean_parameter('Stream To File', True):
+                output = self.open_output_file(rule_context)
+                try:
+                    with output:
+                        count = self.render_events(
+                            output.write, header, item, footer, events,
+                            context, autoescape, budget, compact)
+                except Exception:
+                    os.remove(output.name)
+                    raise
+                ret = output.name
+                self.info('Rendered %s events to file %s.', count, ret)
+            else:
+                chunks = []
+                count = self.render_events(
+                    chunks.append, header, item, footer, events, context,
+                    autoescape, budget, compact)
+                ret = ''.join(chunks)
+                self.info('Rendered %s events %s', count,
+                          self.describe_output(ret))
+        except RenderLimitExceeded as e:
+            self.error(str(e))
+            raise
+        return self.handle_output(ret, data, rule_context,
+                                  self.get_parameter('Context Key'))
+
+    def render_events(self, write, header: Template, item: Template,
+                      footer: Template, events, context: dict,
+                      autoescape: bool, budget: RenderBudget,
+                      compact: bool = None) -> int:
+        """
+        Renders the header, each event and the footer, passing each chunk
+        of output to the write function as it is rendered.
+        :param write: A function called with each chunk of output.
+        :param header: The header template or None.
+        :param item: The template rendered for each event.
+        :param footer: The footer template or None.
+        :param events: An iterable of events.
+        :param context: The step context.
+        :param autoescape: Whether or not to auto escape the output.
+        :param budget: The render budget of the whole document.
+        :param compact: Whether or not to compact the templates, None uses
+        each template's compact setting.
+        :return: The number of events rendered.
+        """
+        count = 0
+        if header:
+            self._write(write, header, context, autoescape, budget, compact)
+        compiled = item.get_compiled_template(autoescape=autoescape,
+                                              compact=compact)
+        for count, event in enumerate(events, 1):
+            for chunk in budget.watch(item._measure_stream(compiled.generate(
+                    context, event=event, index=count - 1))):
+                budget.spend(chunk)
+                write(chunk)
+        if footer:
+            self._write(write, footer, context, autoescape, budget, compact)
+        return count
+
+    @property
+    def declared_parameters(self):
+        return {
+            "Header Template": "The name of the template rendered once "
+                               "before the events.",
+            "Item Template": "The name of the template rendered for each "
+                             "event.  The event is available as `event` and "
+                             "its position as `index`.",
+            "Footer Template": "The name of the template rendered once after "
+                               "the events.",
+            "Events Context Key": "The rule context key holding the events.  "
+                                  "Default is the quartet_output object "
+                                  "events key.",
+            "Context Key": "The context key to place the output into.  If "
+                           "none is specified, the output will be returned to "
+                           "the rule in place of the inbound data.",
+            "Auto Escape": "Whether or not the templates should be auto "
+                           "escaped.  Default is True.",
+            "Stream To File": "Whether or not to write the output into a file "
+                              "and return its path.  Default is True, if "
+                              "False the output is returned as a string.",
+            "Stream Directory": "The directory to write output files into.  "
+                                "Default is the system temp directory.",
+            "Preview Length": "The number of characters of the output to "
+                              "include in the task messages when not "
+                              "streaming to a file.  Default is 200.",
+            "Render Timeout": "The maximum number of seconds rendering the "
+                              "whole document may take.  Default is the "
+                              "QUARTET_TEMPLATES_RENDER_TIMEOUT setting, the "
+                              "templates' own render timeouts are not "
+                              "used.",
+            "Max Output Size": "The maximum number of bytes the whole "
+                               "document may be.  Default is the "
+                               "QUARTET_TEMPLATES_MAX_OUTPUT_SIZE setting, "
+                               "the templates' own max output sizes are not "
+                               "used.",
+            "Compact": "Whether or not to remove the indentation and line "
+                       "breaks between the tags of the templates' static "
+                       "text when they are compiled.  Default is each "
+                       "template's compact setting."
+        }
+
+    def on_failure(self):
+        pass
+
+
+class ParallelRenderStep(RuleTemplatesMixin, TemplateOutputMixin, Step):
+    """
+    Renders the EPCPyYes events in one or more rule context keys, with the
+    templates assigned to them (i.e. by the ChangeTemplatesStep or the
+    default EPCPyYes templates), using a pool of worker processes.  The
+    events are sent to the workers in chunks, each worker compiles each
+    template once and the output is concatenated in order, between an
+    optional header and footer template, into a file or a string.
+    """
+
+    def execute(self, data, rule_context: RuleContext):
+        names = [self.get_parameter('Header Template'),
+                 self.get_parameter('Footer Template')]
+        templates = self.get_templates(rule_context, names)
+        header, footer = [templates.get(name) for name in names]
+        autoescape = self.get_boolean_parameter('Auto Escape', True)
+        compact = self.get_boolean_parameter('Compact', None)
+        events_keys = [key.strip() for key in self.get_parameter(
+            'Events Context Keys', '%s,%s' % (
+                ContextKeys.OBJECT_EVENTS_KEY.value,
+                ContextKeys.AGGREGATION_EVENTS_KEY.value)).split(',')
+            if key.strip()]
+        events = []
+        for events_key in events_keys:
+            events.extend(rule_context.context.get(events_key) or [])
+        processes = self.get_processes()
+        chunk_size = int(self.get_parameter('Chunk Size', 1000))
+        context = self.get_context(data, rule_context, self.get_all_variables(
+            templates.values(), autoescape, compact))
+        budget = RenderBudget('events', *get_render_limits(
+            None, *self.get_render_limits()))
+        self.info('Rendering %s events in context keys %s with %s '
+                  'processes.', len(events), ', '.join(events_keys),
+                  processes)
+        try:
+            if self.get_boolean_parameter('Stream To File', True):
+                output = self.open_output_file(rule_context)
+                try:
+                    with output:
+                        self.render_parallel(
+                            output.write, header, footer, events, context,
+                            autoescape, budget, rule_context, processes,
+                            chunk_size, compact)
+                except Exception:
+                    os.remove(output.name)
+                    raise
+                ret = output.name
+                self.info('Rendered %s events to file %s.', len(events), ret)
+            else:
+                chunks = []
+                self.render_parallel(
+                    chunks.append, header, footer, events, context,
+                    autoescape, budget, rule_context, processes, chunk_size,
+                    compact)
+                ret = ''.join(chunks)
+                self.info('Rendered %s events %s', len(events),
+                          self.describe_output(ret))
+        except RenderLimitExceeded as e:
+            self.error(str(e))
+            raise
+        return self.handle_output(ret, data, rule_context,
+                                  self.get_parameter('Context Key'))
+
+    def get_processes(self) -> int:
+        """
+        Reads the number of worker processes from the "Processes" step
+        parameter, the QUARTET_TEMPLATES_RENDER_PROCESSES setting or the
+        number of CPUs, in that order.
+        """
+        processes = self.get_parameter('Processes')
+        if processes:
+            return int(processes)
+        return getattr(settings, 'QUARTET_TEMPLATES_RENDER_PROCESSES',
+                       None) or os.cpu_count() or 1
+
+    def render_parallel(self, write, header: Template, footer: Template,
+                        events: list, context: dict, autoescape: bool,
+                        budget: RenderBudget, rule_context: RuleContext,
+                        processes: int, chunk_size: int,
+                        compact: bool = None):
+        """
+        Renders the header, each event and the footer, passing the output
+        to the write function in order.  With more than one process the
+        events are rendered by a pool of worker processes, otherwise they
+        are rendered in this process.
+        :param write: A function called with each chunk of output.
+        :param header: The header template or None.
+        :param footer: The footer template or None.
+        :param events: The events to render.
+        :param context: The step context used by the header and footer.
+        :param autoescape: Whether or not to auto escape the header and
+        footer.
+        :param budget: The render budget of the whole document.
+        :param rule_context: The rule context.
+        :param processes: The number of worker processes.
+        :param chunk_size: The number of events sent to a worker at a time.
+        :param compact: Whether or not to compact the header and footer, None
+        uses each template's compact setting.
+        :return: None
+        """
+        if header:
+            self._write(write, header, context, autoescape, budget, compact)
+        if processes > 1 and len(events) > chunk_size:
+            keys, templates = self.get_event_templates(events)
+            rendered = render_events_in_pool(
+                templates,
+                (pack_event(event, keys[id(event.template)])
+                 for event in events),
+                processes, chunk_size)
+        else:
+            rendered = (event.render() for event in events)
+        for chunk in rendered:
+            budget.spend(chunk)
+            write(chunk)
+        if footer:
+            self._write(write, footer, context, autoescape, budget, compact)
+
+    def get_event_templates(self, events: list) -> tuple:
+        """
+        Works out how a worker process can compile each of the templates
+        assigned to the events.  Templates compiled from quartet templates
+        are sent by content with the options they were compiled with, any
+        other template must be one of the default EPCPyYes templates and is
+        sent by name.
+        :param events: The events to render.
+        :return: A tuple of a dictionary of template keys, keyed by the id
+        of each compiled template, and the list of (key, name, content,
+        options) tuples for render_events_in_pool.
+        """
+        keys = {}
+        templates = []
+        for event in events:
+            compiled = event.template
+            if id(compiled) in keys:
+                continue
+            key = len(templates)
+            source = getattr(compiled, 'quartet_source', None)
+            if source is not None:
+                templates.append((key,) + source)
+            elif getattr(compiled, 'name', None):
+                templates.append((key, compiled.name, None, {}))
+            else:
+                self.error('The template of event %s is not a QU4RTET '
+                           'template or a default EPCPyYes template and can '
+                           'not be rendered by a worker process.', event)
+                raise ValueError('The template of event %s can not be '
+                                 'rendered by a worker process.' % event)
+            keys[id(compiled)] = key
+        return keys, templates
+
+    @property
+    def declared_parameters(self):
+        return {
+            "Header Template": "The name of the template rendered once "
+                               "before the events.",
+            "Footer Template": "The name of the template rendered once after "
+                               "the events.",
+            "Events Context Keys": "A comma separated list of the rule "
+                                   "context keys holding the events, "
+                                   "rendered in that order.  Default is the "
+                                   "quartet_output object and aggregation "
+                                   "events keys.",
+            "Processes": "The number of worker processes.  Default is the "
+                         "QUARTET_TEMPLATES_RENDER_PROCESSES setting or the "
+                         "number of CPUs, 1 renders the events in the rule's "
+                         "process.",
+            "Chunk Size": "The number of events sent to a worker process at "
+                          "a time.  Default is 1000.",
+            "Context Key": "The context key to place the output into.  If "
+                           "none is specified, the output will be returned to "
+                           "the rule in place of the inbound data.",
+            "Auto Escape": "Whether or not the header and footer templates "
+                           "should be auto escaped.  Default is True.",
+            "Stream To File": "Whether or not to write the output into a file "
+                              "and return its path.  Default is True, if "
+                              "False the output is returned as a string.",
+            "Stream Directory": "The directory to write output files into.  "
+                                "Default is the system temp directory.",
+            "Preview Length": "The number of characters of the output to "
+                              "include in the task messages when not "
+                              "streaming to a file.  Default is 200.",
+            "Render Timeout": "The maximum number of seconds rendering the "
+                              "whole document may take.",
+            "Max Output Size": "The maximum number of bytes the whole "
+                               "document may be.",
+            "Compact": "Whether or not to remove the indentation and line "
+                       "breaks between the tags of the header and footer "
+                       "templates' static text when they are compiled.  "
+                       "Default is each template's compact setting."
+        }
+
+    def on_failure(self):
+        pass
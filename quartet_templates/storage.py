@@ -0,0 +1,173 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+"""
+Content-addressed storage of template content.  When the
+QUARTET_TEMPLATES_CONTENT_STORE setting is True, template bodies of at
+least QUARTET_TEMPLATES_CONTENT_STORE_MIN_SIZE characters are stored once
+per distinct body in the TemplateContent table, zlib compressed unless
+QUARTET_TEMPLATES_COMPRESS_CONTENT is False, and the template row only
+holds a short reference to them.  Identical bodies share one row and
+loading a template only transfers the body the first time a process
+sees it; the decompressed text is kept in an in-process LRU cache of up
+to QUARTET_TEMPLATES_CONTENT_CACHE_SIZE characters.
+"""
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import models
+from django.db.models.functions import Substr
+
+from quartet_templates.cache import content_hash
+
+REFERENCE_PREFIX = 'quartet-content:sha1:'
+REFERENCE = re.compile(r'^quartet-content:sha1:([0-9a-f]{40})$')
+
+
+class ContentCache:
+    """
+    A thread-safe LRU cache of decompressed template bodies keyed by their
+    content hash and bounded by the total number of characters held.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, checksum: str) -> str:
+        with self._lock:
+            text = self._bodies.get(checksum)
+            if text is not None:
+                self._bodies.move_to_end(checksum)
+            return text
+
+    def set(self, checksum: str, text: str):
+        if len(text) > self.max_size:
+            return
+        with self._lock:
+            if checksum in self._bodies:
+                self._bodies.move_to_end(checksum)
+                return
+            self._bodies[checksum] = text
+            self.size += len(text)
+            while self.size > self.max_size:
+                self.size -= len(self._bodies.popitem(last=False)[1])
+
+    def clear(self):
+        with self._lock:
+            self._bodies.clear()
+            self.size = 0
+
+
+content_cache = ContentCache(
+    getattr(settings, 'QUARTET_TEMPLATES_CONTENT_CACHE_SIZE',
+            32 * 1024 * 1024)
+)
+
+
+def store(text: str, using: str = 'default') -> str:
+    """
+    Stores the text in the TemplateContent table, if an identical body is
+    not already stored, and returns the reference to save in its place.
+    :param text: The template content.
+    :param using: The database alias to store the content in.
+    :return: The reference string.
+    """
+    from quartet_templates.models import TemplateContent
+    checksum = content_hash(text)
+    queryset = TemplateContent.objects.using(using)
+    if not queryset.filter(hash=checksum).exists():
+        data = text.encode('utf-8')
+        compressed = False
+        if getattr(settings, 'QUARTET_TEMPLATES_COMPRESS_CONTENT', True):
+            packed = zlib.compress(data)
+            if len(packed) < len(data):
+                data, compressed = packed, True
+        queryset.get_or_create(hash=checksum, defaults={
+            'data': data, 'compressed': compressed, 'size': len(text)})
+    content_cache.set(checksum, text)
+    return REFERENCE_PREFIX + checksum
+
+
+def resolve(checksum: str, using: str = 'default') -> str:
+    """
+    Returns the text of a stored body from the in-process cache, loading
+    and decompressing it on a miss.
+    :param checksum: The content hash of the body.
+    :param using: The database alias to load the content from.
+    :return: The template content.
+    """
+    from quartet_templates.models import TemplateContent
+    text = content_cache.get(checksum)
+    if text is None:
+        row = TemplateContent.objects.using(using).filter(
+            hash=checksum).values_list('data', 'compressed').first()
+        if row is None:
+            raise TemplateContent.DoesNotExist(
+                'No stored template content with hash %s.' % checksum)
+        data = bytes(row[0])
+        text = (zlib.decompress(data) if row[1] else data).decode('utf-8')
+        content_cache.set(checksum, text)
+    return text
+
+
+def prune(using: str = 'default') -> int:
+    """
+    Deletes the stored bodies no template refers to any longer.  The
+    references are read from the raw content column rather than the
+    content_hash field, which is not kept up to date by queryset updates.
+    :param using: The database alias to prune.
+    :return: The number of bodies deleted.
+    """
+    from quartet_templates.models import Template, TemplateContent
+    referenced = Template.objects.using(using).filter(
+        content__startswith=REFERENCE_PREFIX).annotate(
+        referenced_hash=Substr('content', len(REFERENCE_PREFIX) + 1)
+    ).values('referenced_hash')
+    deleted, _ = TemplateContent.objects.using(using).exclude(
+        hash__in=referenced).delete()
+    return deleted
+
+
+class ContentField(models.TextField):
+    """
+    A text field that transparently moves large values into the content
+    store when QUARTET_TEMPLATES_CONTENT_STORE is enabled.  Values read
+    from the database are always the full text.
+    """
+
+    def get_db_prep_save(self, value, connection):
+        value = super().get_db_prep_save(value, connection)
+        if not isinstance(value, str) or not getattr(
+                settings, 'QUARTET_TEMPLATES_CONTENT_STORE', False):
+            return value
+        min_size = getattr(settings,
+                           'QUARTET_TEMPLATES_CONTENT_STORE_MIN_SIZE', 1024)
+        # text that looks like a reference is always stored so it can not
+        # be mistaken for one when it is read back
+        if len(value) >= min_size or REFERENCE.match(value):
+            value = store(value, connection.alias)
+        return value
+
+    def from_db_value(self, value, expression, connection):
+        if value and value.startswith(REFERENCE_PREFIX):
+            match = REFERENCE.match(value)
+            if match:
+                return resolve(match.group(1), connection.alias)
+        return value
@@ -0,0 +1,306 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+"""
+Streaming bulk export and import of templates as newline delimited JSON
+(NDJSON), one `{"name": ..., "description": ..., "content": ...,
+"compact": ..., "render_timeout": ..., "max_output_size": ...}` object per
+line, or as a gzipped tar archive with one member per template.  Tar
+members are named after the url quoted template name, hold the template
+content and store the other fields in `quartet.<field>` PAX headers.
+"""
+import json
+import math
+import tarfile
+import time
+from io import BytesIO
+from urllib.parse import quote, unquote
+
+from django.db import transaction
+from django.utils import timezone
+
+from quartet_templates.cache import content_hash
+from quartet_templates.dependencies import set_dependencies
+from quartet_templates.generation import next_generation
+from quartet_templates.models import Template
+from quartet_templates.signals import invalidate
+
+DESCRIPTION_HEADER = 'quartet.description'
+COMPACT_HEADER = 'quartet.compact'
+RENDER_TIMEOUT_HEADER = 'quartet.render_timeout'
+MAX_OUTPUT_SIZE_HEADER = 'quartet.max_output_size'
+BATCH_SIZE = 500
+# the largest value a PositiveIntegerField holds on every database
+MAX_POSITIVE_INTEGER = 2147483647
+
+
+class InvalidRecord(ValueError):
+    """
+    Raised when a template record can not be imported.  The message names
+    the line, tar member or record that is invalid.
+    """
+    pass
+
+
+def validate_record(record, position: str):
+    """
+    Checks that a record has a name no longer than the Template name field
+    allows, string content and that each of the optional fields, if
+    present, has a value the Template model can store.
+    :param record: The record to check.
+    :param position: Where the record came from, used in the message.
+    :raises InvalidRecord: If the record is invalid.
+    """
+    if not isinstance(record, dict):
+        raise InvalidRecord('%s is not a JSON object.' % position)
+    name = record.get('name')
+    max_length = Template._meta.get_field('name').max_length
+    if not isinstance(name, str) or not name:
+        raise InvalidRecord('%s has no name.' % position)
+    if len(name) > max_length:
+        raise InvalidRecord('%s has a name longer than %s characters.' % (
+            position, max_length))
+    if not isinstance(record.get('content'), str):
+        raise InvalidRecord('%s has no content.' % position)
+    description = record.get('description')
+    max_length = Template._meta.get_field('description').max_length
+    if description is not None and (not isinstance(description, str) or
+                                    len(description) > max_length):
+        raise InvalidRecord(
+            '%s has a description that is not a string of at most %s '
+            'characters.' % (position, max_length))
+    if record.get('compact') not in (None, True, False):
+        raise InvalidRecord('%s has a compact value that is not true or '
+                            'false.' % position)
+    render_timeout = record.get('render_timeout')
+    if render_timeout is not None and (
+            isinstance(render_timeout, bool) or
+            not isinstance(render_timeout, (int, float)) or
+            not math.isfinite(render_timeout) or render_timeout < 0):
+        raise InvalidRecord('%s has a render_timeout that is not a number '
+                            'of seconds of 0 or more.' % position)
+    max_output_size = record.get('max_output_size')
+    if max_output_size is not None and (
+            isinstance(max_output_size, bool) or
+            not isinstance(max_output_size, int) or
+            not 0 <= max_output_size <= MAX_POSITIVE_INTEGER):
+        raise InvalidRecord('%s has a max_output_size that is not a whole '
+                            'number of bytes from 0 to %s.' % (
+                                position, MAX_POSITIVE_INTEGER))
+
+
+def _export_queryset(queryset=None):
+    queryset = queryset if queryset is not None else Template.objects.all()
+    return queryset.order_by('name').values_list(
+        'name', 'description', 'content', 'compact', 'render_timeout',
+        'max_output_size').iterator(chunk_size=BATCH_SIZE)
+
+
+def export_ndjson(queryset=None):
+    """
+    Yields each template as a line of NDJSON.  Templates are read from the
+    database in batches so memory use does not grow with their number.
+    :param queryset: The templates to export, all templates by default.
+    :return: A generator of NDJSON lines.
+    """
+    for name, description, content, compact, render_timeout, \
+            max_output_size in _export_queryset(queryset):
+        yield json.dumps({'name': name, 'description': description,
+                          'content': content, 'compact': compact,
+                          'render_timeout': render_timeout,
+                          'max_output_size': max_output_size}) + '\n'
+
+
+class _StreamBuffer:
+    """
+    A write-only file object the tar archive writes into and that is
+    drained after each member so the archive can be streamed.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def export_tar(queryset=None):
+    """
+    Yields the bytes of a gzipped tar archive of the templates as each
+    template is added to it.
+    :param queryset: The templates to export, all templates by default.
+    :return: A generator of bytes.
+    """
+    buffer = _StreamBuffer()
+    archive = tarfile.open(fileobj=buffer, mode='w|gz',
+                           format=tarfile.PAX_FORMAT)
+    now = time.time()
+    for name, description, content, compact, render_timeout, \
+            max_output_size in _export_queryset(queryset):
+        data = content.encode('utf-8')
+        info = tarfile.TarInfo(quote(name, safe=''))
+        info.size = len(data)
+        info.mtime = now
+        if description is not None:
+            info.pax_headers[DESCRIPTION_HEADER] = description
+        if compact:
+            info.pax_headers[COMPACT_HEADER] = '1'
+        if render_timeout is not None:
+            info.pax_headers[RENDER_TIMEOUT_HEADER] = repr(render_timeout)
+        if max_output_size is not None:
+            info.pax_headers[MAX_OUTPUT_SIZE_HEADER] = str(max_output_size)
+        archive.addfile(info, BytesIO(data))
+        yield buffer.drain()
+    archive.close()
+    yield buffer.drain()
+
+
+def read_ndjson(lines):
+    """
+    Parses template records from NDJSON lines, skipping blank lines.
+    :raises InvalidRecord: If a line is not a valid template record.
+    """
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise InvalidRecord('Line %s is not valid JSON.' % number)
+            validate_record(record, 'Line %s' % number)
+            yield record
+
+
+def read_tar(fileobj):
+    """
+    Parses template records from a, optionally compressed, tar archive
+    read from a file object as a stream.
+    :raises InvalidRecord: If a member is not a valid template record.
+    :raises tarfile.TarError: If the archive can not be read.
+    """
+    with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            position = 'Member %s' % member.name
+            headers = member.pax_headers
+            compact = headers.get(COMPACT_HEADER)
+            if compact not in (None, '0', '1'):
+                raise InvalidRecord('%s has a %s header that is not 0 or 1.'
+                                    % (position, COMPACT_HEADER))
+            try:
+                content = archive.extractfile(member).read().decode('utf-8')
+            except UnicodeDecodeError:
+                raise InvalidRecord('%s is not UTF-8 encoded.' % position)
+            record = {
+                'name': unquote(member.name),
+                'description': headers.get(DESCRIPTION_HEADER),
+                'compact': compact == '1',
+                'render_timeout': _read_header(
+                    headers, RENDER_TIMEOUT_HEADER, float, position),
+                'max_output_size': _read_header(
+                    headers, MAX_OUTPUT_SIZE_HEADER, int, position),
+                'content': content
+            }
+            validate_record(record, position)
+            yield record
+
+
+def _read_header(headers: dict, header: str, parse, position: str):
+    value = headers.get(header)
+    if not value:
+        return None
+    try:
+        return parse(value)
+    except ValueError:
+        raise InvalidRecord('%s has an invalid %s header.' % (position,
+                                                              header))
+
+
+def _chunked(records, size: int):
+    batch = {}
+    for record in records:
+        batch[record['name']] = record
+        if len(batch) >= size:
+            yield batch
+            batch = {}
+    if batch:
+        yield batch
+
+
+def import_templates(records, batch_size: int = BATCH_SIZE) -> dict:
+    """
+    Creates or updates, by name, a template for each record using
+    bulk_create and bulk_update in batches.  If a name appears more than
+    once the last record wins.  The import runs in a single transaction.
+    :param records: An iterable of dictionaries with name, content and
+    (optionally) description, compact, render_timeout and max_output_size
+    keys, i.e. from read_ndjson or read_tar.
+    :param batch_size: The number of records to write at a time.
+    :return: A dictionary with the number of templates created and
+    updated.
+    :raises InvalidRecord: If a record is invalid, nothing is imported.
+    """
+    created = updated = 0
+
+    def validated(records):
+        for number, record in enumerate(records, 1):
+            validate_record(record, 'Record %s' % number)
+            yield record
+
+    with transaction.atomic():
+        for batch in _chunked(validated(records), batch_size):
+            now = timezone.now()
+            generation = next_generation()
+            existing = {
+                template.name: template for template in
+                Template.objects.filter(name__in=list(batch)).only(
+                    'id', 'name')
+            }
+            new_templates = []
+            for name, record in batch.items():
+                template = existing.get(name) or Template(name=name)
+                template.content = record['content']
+                template.description = record.get('description')
+                template.compact = record.get('compact') or False
+                template.render_timeout = record.get('render_timeout')
+                template.max_output_size = record.get('max_output_size')
+                template.content_hash = content_hash(record['content'])
+                template.modified = now
+                template.generation = generation
+                if name not in existing:
+                    new_templates.append(template)
+            Template.objects.bulk_create(new_templates)
+            if any(template.pk is None for template in new_templates):
+                # not every database returns the primary keys of bulk
+                # created rows, they are needed for the dependency edges
+                new_templates = list(Template.objects.filter(
+                    name__in=[template.name for template in new_templates]
+                ).only('id', 'name', 'content'))
+            Template.objects.bulk_update(
+                list(existing.values()),
+                ['content', 'description', 'compact', 'render_timeout',
+                 'max_output_size', 'content_hash', 'modified',
+                 'generation']
+            )
+            set_dependencies(new_templates + list(existing.values()))
+            created += len(new_templates)
+            updated += len(existing)
+            transaction.on_commit(
+                lambda names=list(batch): invalidate(*names))
+    return {'created': created, 'updated': updated}
@@ -13,15 +13,269 @@
 #
 # Copyright 2018 SerialLab Corp.  All rights reserved.
 
+import json
+import tarfile
+from hashlib import sha1
+
+from django.db.models import Count, Max
+from django.http import StreamingHttpResponse
 from django.shortcuts import render
-from rest_framework.viewsets import ModelViewSet
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, quote_etag
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+from django.conf import settings
+from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from quartet_templates import models
 from quartet_templates import serializers
+from quartet_templates import transfer
+from quartet_templates.dependencies import get_dependents
+from quartet_templates.limits import RenderLimitExceeded
+
+
+class TemplateCursorPagination(CursorPagination):
+    """
+    Pages through templates by name.  The page size defaults to the
+    QUARTET_TEMPLATES_PAGE_SIZE setting and can be changed with the
+    `page_size` query parameter.
+    """
+    ordering = 'name'
+    page_size = getattr(settings, 'QUARTET_TEMPLATES_PAGE_SIZE', 100)
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
 
 
 class TemplateViewSet(ModelViewSet):
     """
     CRUD model views for the Template model.
+
+    The list and retrieve views return an ETag header and honour
+    If-None-Match with a 304 response, which is determined without loading
+    any template content.  The retrieve view also returns Last-Modified and
+    honours If-Modified-Since.  The list view does not, because deleting a
+    template does not change the latest modification time, while the
+    list's ETag includes the number of templates.  The list view accepts a
+    `changed_since` ISO 8601 date time parameter to only return templates
+    modified after that time.  Deleted templates are not reported by
+    `changed_since`, compare the names of a full list to find them.
+
+    Lists are cursor paginated and do not load or return template content.
+    Both views accept a comma separated `fields` parameter to return, and
+    load, only the named fields; i.e. `?fields=name,content`.
     """
     queryset = models.Template.objects.all()
     serializer_class = serializers.TemplateSerializer
+    pagination_class = TemplateCursorPagination
+
+    def get_serializer_class(self):
+        if self.action == 'list' and not serializers.get_requested_fields(
+                self.request):
+            return serializers.TemplateListSerializer
+        return super().get_serializer_class()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ['list', 'retrieve']:
+            requested = serializers.get_requested_fields(self.request)
+            if requested:
+                model_fields = {field.name for field in
+                                models.Template._meta.concrete_fields}
+                queryset = queryset.only(
+                    'pk', *(requested & model_fields - {'id'}))
+            elif self.action == 'list':
+                queryset = queryset.defer('content')
+        changed_since = self.request.query_params.get('changed_since')
+        if changed_since and self.action == 'list':
+            value = parse_datetime(changed_since)
+            if value is None:
+                raise ValidationError(
+                    {'changed_since': 'Use an ISO 8601 date time.'})
+            if timezone.is_naive(value):
+                value = timezone.make_aware(value)
+            queryset = queryset.filter(modified__gt=value)
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        state = self.filter_queryset(self.get_queryset()).order_by().aggregate(
+            count=Count('pk'), modified=Max('modified'))
+        etag = sha1(('%s|%s|%s' % (
+            state['count'], state['modified'], request.get_full_path())
+        ).encode('utf-8')).hexdigest()
+        # no Last-Modified, a delete does not move the latest modified time
+        return self._conditional_response(
+            request, etag, None,
+            lambda: super(TemplateViewSet, self).list(
+                request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup = self.lookup_url_kwarg or self.lookup_field
+        state = self.filter_queryset(self.get_queryset()).filter(
+            **{self.lookup_field: kwargs[lookup]}
+        ).values('content_hash', 'modified').first()
+        if not state:
+            return super().retrieve(request, *args, **kwargs)
+        etag = '%s-%s' % (state['content_hash'],
+                          int(state['modified'].timestamp() * 1000000))
+        requested = serializers.get_requested_fields(request)
+        if requested:
+            # a partial representation must not match the full one
+            etag += '-' + sha1(','.join(sorted(requested)).encode(
+                'utf-8')).hexdigest()[:12]
+        return self._conditional_response(
+            request, etag, state['modified'],
+            lambda: super(TemplateViewSet, self).retrieve(
+                request, *args, **kwargs))
+
+    def _conditional_response(self, request, etag: str, modified,
+                              get_response):
+        """
+        Returns a 304 response if the request's conditional headers match
+        the etag and modification time, otherwise the response returned by
+        get_response with ETag and Last-Modified headers added.
+        """
+        etag = quote_etag(etag)
+        last_modified = int(modified.timestamp()) if modified else None
+        response = get_conditional_response(request, etag=etag,
+                                            last_modified=last_modified)
+        if response is None:
+            response = get_response()
+            response['ETag'] = etag
+            if last_modified:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    @action(detail=True, methods=['post'])
+    def render(self, request, pk=None):
+        """
+        Renders the template once for each JSON context in a newline
+        delimited JSON (NDJSON) request body and streams the results back
+        as NDJSON, one `{"output": ...}` object per context, in order.
+        If a context can not be rendered an `{"error": ...}` object is
+        returned in its place and the response ends.  Pass
+        `autoescape=false` as a query parameter to turn off auto escaping.
+        """
+        template = self.get_object()
+        autoescape = request.query_params.get(
+            'autoescape', 'true').lower() in ['true', '1']
+        lines = iter(request.stream.readline, b'') if request.stream else []
+        return StreamingHttpResponse(
+            self._render_lines(template, lines, autoescape),
+            content_type='application/x-ndjson'
+        )
+
+    @action(detail=True, methods=['post'])
+    def profile(self, request, pk=None):
+        """
+        Renders the template with the JSON object in the request body as
+        its context under the template profiler and returns a report of
+        the template lines that took the most time.  Pass `autoescape=false`
+        to turn off auto escaping and `limit` to change the number of lines
+        reported (default 20).
+        """
+        template = self.get_object()
+        autoescape = request.query_params.get(
+            'autoescape', 'true').lower() in ['true', '1']
+        try:
+            limit = int(request.query_params.get('limit', 20))
+        except ValueError:
+            raise ValidationError({'limit': 'Use a whole number.'})
+        try:
+            output, report = template.profile(
+                request.data or {}, autoescape=autoescape, limit=limit)
+        except RenderLimitExceeded as e:
+            return Response({'error': str(e)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response({'name': template.name, 'output_size': len(output),
+                         'lines': report})
+
+    @action(detail=True, methods=['get'])
+    def dependents(self, request, pk=None):
+        """
+        Returns the names of every template that includes, extends or
+        imports this template, directly or indirectly.  These are the
+        templates affected when this template changes.
+        """
+        template = self.get_object()
+        return Response({'name': template.name,
+                         'dependents': sorted(get_dependents(template.name))})
+
+    @action(detail=False, methods=['get'], url_path='export',
+            url_name='export')
+    def export_templates(self, request):
+        """
+        Streams every template as NDJSON or, with `archive=tar`, as a
+        gzipped tar archive.
+        """
+        if request.query_params.get('archive') == 'tar':
+            response = StreamingHttpResponse(transfer.export_tar(),
+                                             content_type='application/gzip')
+            response['Content-Disposition'] = \
+                'attachment; filename="templates.tar.gz"'
+            return response
+        return StreamingHttpResponse(transfer.export_ndjson(),
+                                     content_type='application/x-ndjson')
+
+    @action(detail=False, methods=['post'], url_path='import',
+            url_name='import')
+    def import_templates(self, request):
+        """
+        Creates or updates templates, by name, from an NDJSON request body
+        or, if the content type is application/x-tar or application/gzip,
+        from a tar archive as created by the export view.  Returns the
+        number of templates created and updated.
+        """
+        if not request.stream:
+            return Response({'created': 0, 'updated': 0})
+        if request.content_type in ['application/x-tar', 'application/gzip']:
+            records = transfer.read_tar(request.stream)
+        else:
+            records = transfer.read_ndjson(
+                iter(request.stream.readline, b''))
+        try:
+            return Response(transfer.import_templates(records))
+        except (transfer.InvalidRecord, tarfile.TarError) as e:
+            return Response({'error': str(e)},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+    def _render_lines(self, template: models.Template, lines,
+                      autoescape: bool):
+        contexts = (json.loads(line) for line in lines if line.strip())
+        try:
+            for output in template.render_many(contexts,
+                                               autoescape=autoescape):
+                yield json.dumps({'output': output}) + '\n'
+        except Exception as e:
+            yield json.dumps({'error': str(e)}) + '\n'
+
+
+class TemplateMetricViewSet(ReadOnlyModelViewSet):
+    """
+    Read only views of the render metrics gathered for each template.
+    """
+    queryset = models.TemplateMetric.objects.all()
+    serializer_class = serializers.TemplateMetricSerializer
+
+
+class TemplateDependencyViewSet(ReadOnlyModelViewSet):
+    """
+    Read only views of the include/extends/import graph.  Each edge links
+    a template to the name of a template it references.  Filter the edges
+    with the `template_name` and `referenced_name` query parameters.
+    """
+    queryset = models.TemplateDependency.objects.select_related('template')
+    serializer_class = serializers.TemplateDependencySerializer
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        template_name = self.request.query_params.get('template_name')
+        if template_name:
+            queryset = queryset.filter(template__name=template_name)
+        referenced_name = self.request.query_params.get('referenced_name')
+        if referenced_name:
+            queryset = queryset.filter(referenced_name=referenced_name)
+        return queryset
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+Runs the benchmarks against an in-memory SQLite database and prints the
+results as JSON.  Exits with a non-zero status if any measurement is over
+its budget in benchmarks/budgets.json.
+
+    python runbenchmarks.py [--output results.json] [--repeat 20]
+                            [benchmark names...]
+"""
+from __future__ import unicode_literals, absolute_import
+
+import argparse
+import json
+import os
+import platform
+import sys
+
+import django
+
+
+def run_benchmarks(names: list, repeat: int, budgets_path: str) -> dict:
+    from django.db import connection
+    from django.test.utils import setup_test_environment, \
+        teardown_test_environment
+    from benchmarks.benchmarks import BENCHMARKS
+
+    with open(budgets_path) as f:
+        budgets = json.load(f)
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    results = {}
+    failures = []
+    try:
+        for name in names or BENCHMARKS:
+            results[name] = BENCHMARKS[name]({'repeat': repeat})
+            for measurement, budget in budgets.get(name, {}).items():
+                value = results[name].get(measurement)
+                if value is not None and value > budget:
+                    failures.append({'benchmark': name,
+                                     'measurement': measurement,
+                                     'value': value, 'budget': budget})
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'benchmarks': results,
+        'failures': failures,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('names', nargs='*', help='The benchmarks to run.')
+    parser.add_argument('--output', help='A file to write the results to.')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='The number of times to repeat each timing.')
+    parser.add_argument('--budgets', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'benchmarks',
+        'budgets.json'), help='The budgets file.')
+    args = parser.parse_args()
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+    django.setup()
+    result = run_benchmarks(args.names, args.repeat, args.budgets)
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+    sys.exit(bool(result['failures']))
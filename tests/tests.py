@@ -1,9 +1,44 @@
+import io
 import os
+import gzip
+import zlib
+import json
+import time
+import tarfile
+import tempfile
+from unittest import mock
 from django.test import TestCase
+from jinja2.environment import Environment
+from jinja2.exceptions import TemplateNotFound
 from django.db.utils import IntegrityError
 from quartet_templates import models
+from quartet_templates.cache import template_cache, TemplateCache, \
+    compile_template, get_environment, content_hash
+from quartet_templates import transfer
+from quartet_templates import storage
+from quartet_templates.output import output_cache, OutputCache, make_key
+from quartet_templates.dependencies import get_dependents
+from quartet_templates.generation import GenerationWatcher, \
+    get_generation, next_generation
+from quartet_templates.precompiled import PrecompiledTemplates, warm_up
+from django.core.management import call_command
+from quartet_templates.metrics import render_metrics
+from quartet_templates.limits import RenderLimitExceeded
+from quartet_templates.bytecode import DatabaseBytecodeCache, \
+    DirectoryBytecodeCache
 from quartet_capture.models import Rule, Step, Task, StepParameter
 from quartet_capture.rules import Rule as CRule
+from django.contrib.auth.models import User
+from django.urls import reverse
+from django.utils.http import http_date
+from rest_framework.test import APIClient
+from quartet_templates.steps import TemplateStep, ChangeTemplatesStep, \
+    EventStreamStep, ParallelRenderStep, TEMPLATES_CONTEXT_KEY
+from quartet_capture.rules import RuleContext
+from quartet_output.steps import ContextKeys
+from EPCPyYes.core.v1_2 import template_events
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 class TemplateTest(TestCase):
     '''
@@ -50,7 +85,1132 @@ class TemplateTest(TestCase):
 </soapenv:Envelope>
         '''
         self.assertEqual(expected, rendered)
-        
+
+    def test_compiled_template_cache(self):
+        template = self.create_template(name="Cached Template",
+                                        content="<a>{{ value }}</a>",
+                                        description="A cached template")
+        compiled = template.get_compiled_template()
+        self.assertIs(compiled, template.get_compiled_template())
+        self.assertIsNot(compiled,
+                         template.get_compiled_template(autoescape=False))
+        self.assertEqual('<a>&lt;b&gt;</a>', template.render({'value': '<b>'}))
+        self.assertEqual('<a><b></a>', template.render({'value': '<b>'},
+                                                       autoescape=False))
+
+    def test_cache_invalidated_on_save(self):
+        template = self.create_template(name="Cached Template",
+                                        content="<a>{{ value }}</a>",
+                                        description="A cached template")
+        template.render({'value': 1})
+        self.assertIn("Cached Template", template_cache)
+        template.content = "<b>{{ value }}</b>"
+        template.save()
+        self.assertNotIn("Cached Template", template_cache)
+        self.assertEqual('<b>1</b>', template.render({'value': 1}))
+        template.delete()
+        self.assertNotIn("Cached Template", template_cache)
+
+    def test_cache_size_bound(self):
+        cache = TemplateCache(max_size=2)
+        first = cache.get_template('one', '1')
+        cache.get_template('two', '2')
+        cache.get_template('one', '1')
+        cache.get_template('three', '3')
+        self.assertEqual(2, len(cache))
+        self.assertNotIn('two', cache)
+        self.assertIs(first, cache.get_template('one', '1'))
+
+    def test_database_bytecode_cache(self):
+        environment = Environment(bytecode_cache=DatabaseBytecodeCache())
+        compiled = compile_template(environment, 'bytecode', '{{ 1 + 1 }}')
+        self.assertEqual('2', compiled.render())
+        self.assertEqual(1, models.TemplateBytecode.objects.count())
+        with mock.patch.object(environment, 'compile') as compile:
+            compiled = compile_template(environment, 'bytecode',
+                                        '{{ 1 + 1 }}')
+            self.assertFalse(compile.called)
+        self.assertEqual('2', compiled.render())
+
+    def test_database_bytecode_cache_eviction(self):
+        environment = Environment(
+            bytecode_cache=DatabaseBytecodeCache(max_size=1))
+        compile_template(environment, 'first', '{{ 1 }}')
+        compile_template(environment, 'second', '{{ 2 }}')
+        self.assertEqual(0, models.TemplateBytecode.objects.count())
+
+    def test_directory_bytecode_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            bytecode_cache = DirectoryBytecodeCache(directory)
+            environment = Environment(bytecode_cache=bytecode_cache)
+            compile_template(environment, 'bytecode', '{{ 1 + 1 }}')
+            self.assertEqual(1, len(os.listdir(directory)))
+            with mock.patch.object(environment, 'compile') as compile:
+                compiled = compile_template(environment, 'bytecode',
+                                            '{{ 1 + 1 }}')
+                self.assertFalse(compile.called)
+            self.assertEqual('2', compiled.render())
+            bytecode_cache.max_size = 1
+            bytecode_cache.evict()
+            self.assertEqual(0, len(os.listdir(directory)))
+
+    def test_template_step(self):
+        self._create_test_template()
+        db_rule, db_task, db_step = self._create_rule()
+        db_task.save()
+        rule = CRule(db_rule, db_task)
+        rule.execute(['urn:epc:id:sgtin:1.1.1', 'urn:epc:id:sgtin:1.1.2'])
+        self.assertIn('<id>urn:epc:id:sgtin:1.1.1</id>', rule.data)
+        self.assertIn('<id>urn:epc:id:sgtin:1.1.2</id>', rule.data)
+
+    def test_render_stream(self):
+        self._create_test_template()
+        template = models.Template.objects.get(name="Test Template")
+        context = {'data': ['1', '2']}
+        chunks = list(template.render_stream(context))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(template.render(context), ''.join(chunks))
+
+    def test_render_limits(self):
+        template = self.create_template(
+            name="Loop Template",
+            content="{% for i in data %}{% for j in data %}<i>{{ i }}</i>"
+                    "{% endfor %}{% endfor %}",
+            description="A nested loop")
+        context = {'data': range(100)}
+        self.assertEqual(100 * 100, template.render(context).count('<i>'))
+        with self.assertRaises(RenderLimitExceeded):
+            template.render(context, max_size=1000)
+        with self.assertRaises(RenderLimitExceeded):
+            template.render(context, timeout=1e-9)
+        template.max_output_size = 1000
+        template.save()
+        with self.assertRaises(RenderLimitExceeded):
+            list(template.render_stream(context))
+        # an explicit limit of 0 overrides the template's limit
+        self.assertEqual(100 * 100, template.render(
+            context, max_size=0).count('<i>'))
+        with self.settings(QUARTET_TEMPLATES_RENDER_TIMEOUT=1e-9):
+            template.max_output_size = None
+            with self.assertRaises(RenderLimitExceeded):
+                template.render(context)
+
+    def test_render_timeout_without_output(self):
+        # the loops write nothing so only the loop checks can stop them
+        template = self.create_template(
+            name="Silent Loop",
+            content="{% for i in data %}{% for j in data %}"
+                    "{% set k = i * j %}{% endfor %}{% endfor %}done",
+            description="A nested loop without output")
+        started = time.perf_counter()
+        with self.assertRaises(RenderLimitExceeded):
+            template.render({'data': range(100000)}, timeout=0.05)
+        self.assertLess(time.perf_counter() - started, 5)
+        self.assertEqual('done', template.render({'data': range(10)},
+                                                 timeout=10))
+        # loops keep their meaning when the budget is checked
+        template = self.create_template(
+            name="Loop Forms",
+            content="{% for a, b in pairs if a %}{{ a }}{{ b }}"
+                    "{{ loop.length }}{% endfor %}|"
+                    "{% for item in (tree) recursive %}{{ item.name }}"
+                    "{% if item.children %}({{ loop(item.children) }})"
+                    "{% endif %}{% endfor %}",
+            description="Loop forms")
+        context = {'pairs': [(0, 'x'), (1, 'y'), (2, 'z')],
+                   'tree': [{'name': 'a', 'children': [{'name': 'b'}]}]}
+        expected = '1y22z2|a(b)'
+        self.assertEqual(expected, template.render(context))
+        self.assertEqual(expected, template.render(context, timeout=10))
+        # a single slow call is only stopped once it returns
+        template = self.create_template(
+            name="Slow Call", content="{{ wait() }}done",
+            description="A slow call")
+        with self.assertRaises(RenderLimitExceeded):
+            template.render({'wait': lambda: time.sleep(0.1) or ''},
+                            timeout=0.01)
+
+    def test_template_step_render_limits(self):
+        self.create_template(
+            name="Loop Template",
+            content="{% for i in data %}{% for j in data %}<i>{{ i }}</i>"
+                    "{% endfor %}{% endfor %}",
+            description="A nested loop")
+        step = TemplateStep(None, **{'Template Name': 'Loop Template',
+                                     'Max Output Size': '1000'})
+        step.info = lambda *args, **kwargs: None
+        step.error = mock.Mock()
+        rule_context = RuleContext('Test Rule', 'Test Task')
+        with self.assertRaises(RenderLimitExceeded):
+            step.execute(list(range(100)), rule_context)
+        self.assertIn('maximum output size of 1000 bytes',
+                      step.error.call_args[0][0])
+        step = TemplateStep(None, **{'Template Name': 'Loop Template',
+                                     'Render Timeout': '1e-9',
+                                     'Stream To File': 'True'})
+        step.info = lambda *args, **kwargs: None
+        step.error = mock.Mock()
+        with self.assertRaises(RenderLimitExceeded):
+            step.execute(list(range(100)), rule_context)
+        self.assertIn('render timeout', step.error.call_args[0][0])
+
+    def test_template_step_lazy_context(self):
+        self.create_template(name="Data Template",
+                             content="{% for i in data %}{{ i }}{% endfor %}",
+                             description="Uses the data only")
+        self.create_template(name="Header",
+                             content="{{ task_parameters.Sender }}|{{ UUID }}",
+                             description="Uses the task parameters")
+        template = self.create_template(
+            name="Including Template",
+            content="{% include 'Header' %}|{{ data }}",
+            description="Includes the header")
+        self.assertEqual({'data', 'task_parameters', 'UUID'},
+                         template.get_variables())
+        dynamic = self.create_template(
+            name="Dynamic Template",
+            content="{% include name %}",
+            description="Includes a template by variable")
+        self.assertIsNone(dynamic.get_variables())
+        rule_context = RuleContext('Test Rule', 'Test Task')
+        step = TemplateStep(None, **{'Template Name': 'Data Template'})
+        step.info = lambda *args, **kwargs: None
+        step.get_task_parameters = mock.Mock(return_value={'Sender': 'S'})
+        self.assertEqual('12', step.execute(['1', '2'], rule_context))
+        step.get_task_parameters.assert_not_called()
+        step.parameters['Template Name'] = 'Including Template'
+        output = step.execute('1', rule_context)
+        step.get_task_parameters.assert_called_once_with(rule_context)
+        self.assertTrue(output.startswith('S|'))
+        self.assertEqual(
+            {'data', 'rule_context', 'step_parameters', 'task_parameters',
+             'epoch', 'random', 'UUID', 'datetime'},
+            set(step.get_context('1', rule_context)))
+
+    def test_output_cache(self):
+        output_cache.clear()
+        header = self.create_template(name="Header", content="<h>1</h>",
+                                      description="A shared header")
+        template = self.create_template(
+            name="Cached Output",
+            content="{% include 'Header' %}{% for i in data %}{{ i }}"
+                    "{% endfor %}",
+            description="A deterministic template")
+        with mock.patch.object(models.Template, 'render',
+                               wraps=template.render) as render:
+            self.assertEqual('<h>1</h>12', template.render_cached(
+                {'data': ['1', '2']}))
+            self.assertEqual('<h>1</h>12', template.render_cached(
+                {'data': ['1', '2'], 'unused': object()}))
+            self.assertEqual(1, render.call_count)
+            self.assertEqual('<h>1</h>3', template.render_cached(
+                {'data': ['3']}))
+            self.assertEqual(2, render.call_count)
+        self.assertEqual(2, len(output_cache))
+        header.content = "<h>2</h>"
+        header.save()
+        self.assertEqual(0, len(output_cache))
+        self.assertEqual('<h>2</h>12', template.render_cached(
+            {'data': ['1', '2']}))
+        keyed = self.create_template(name="Keyed Template",
+                                     content="{{ d[1] }}",
+                                     description="A keyed template")
+        self.assertEqual('v', keyed.render_cached({'d': {1: 'v'}}))
+        self.assertEqual('', keyed.render_cached({'d': {'1': 'v'}}))
+        self.assertNotEqual(make_key('a', 'b', True, {'d': (1,)}, {'d'}),
+                            make_key('a', 'b', True, {'d': [1]}, {'d'}))
+        for content in ["{{ items|random }}", "{{ lipsum(1) }}"]:
+            random_template = self.create_template(
+                name="Random Template %s" % len(content), content=content,
+                description="A non-deterministic template")
+            self.assertIsNone(make_key(
+                random_template.name, 'b', True, {'items': [1, 2]},
+                random_template.get_variables()))
+        uuid_template = self.create_template(
+            name="UUID Template", content="{{ UUID }}",
+            description="A non-deterministic template")
+        self.assertNotEqual(uuid_template.render_cached({'UUID': '1'}),
+                            uuid_template.render_cached({'UUID': '2'}))
+        self.assertIsNone(make_key('UUID Template', '', True, {'UUID': '1'},
+                                   frozenset(['UUID'])))
+        cache = OutputCache(max_size=10)
+        cache.set(('a', '1'), '12345')
+        cache.set(('b', '1'), '\u00e9\u00e9\u00e9')
+        self.assertIsNone(cache.get(('a', '1')))
+        self.assertEqual(6, cache.size)
+        step = TemplateStep(None, **{'Template Name': 'Cached Output',
+                                     'Cache Output': 'True'})
+        step.info = lambda *args, **kwargs: None
+        rule_context = RuleContext('Test Rule', 'Test Task')
+        self.assertEqual('<h>2</h>12', step.execute(['1', '2'],
+                                                    rule_context))
+
+    def test_event_stream_step(self):
+        self.create_template(name="Header", content="<doc>{{ title }}",
+                             description="The document header")
+        self.create_template(
+            name="Item",
+            content="<e i=\"{{ index }}\">{{ event.action }}</e>",
+            description="One event")
+        self.create_template(name="Footer", content="</doc>",
+                             description="The document footer")
+        events = (template_events.ObjectEvent(action=action)
+                  for action in ['ADD', 'OBSERVE', 'DELETE'])
+        rule_context = RuleContext('Test Rule', 'Test Task', context={
+            ContextKeys.OBJECT_EVENTS_KEY.value: events})
+        step = EventStreamStep(None, **{'Header Template': 'Header',
+                                        'Item Template': 'Item',
+                                        'Footer Template': 'Footer',
+                                        'Context Key': 'OUTPUT'})
+        step.info = lambda *args, **kwargs: None
+        step.execute(None, rule_context)
+        path = rule_context.context['OUTPUT']
+        try:
+            with open(path) as f:
+                self.assertEqual('<doc><e i="0">ADD</e><e i="1">OBSERVE</e>'
+                                 '<e i="2">DELETE</e></doc>', f.read())
+        finally:
+            os.remove(path)
+        rule_context.context['EVENTS'] = [
+            template_events.ObjectEvent(action='ADD')] * 100
+        step = EventStreamStep(None, **{'Item Template': 'Item',
+                                        'Events Context Key': 'EVENTS',
+                                        'Stream To File': 'False',
+                                        'Max Output Size': '100'})
+        step.info = lambda *args, **kwargs: None
+        step.error = mock.Mock()
+        with self.assertRaises(RenderLimitExceeded):
+            step.execute(None, rule_context)
+        step.parameters['Max Output Size'] = '0'
+        self.assertEqual(100, step.execute(None, rule_context).count('<e'))
+        # the item template's own limit is for one render, not the document
+        models.Template.objects.filter(name='Item').update(
+            max_output_size=100)
+        del rule_context.context[TEMPLATES_CONTEXT_KEY]
+        del step.parameters['Max Output Size']
+        self.assertEqual(100, step.execute(None, rule_context).count('<e'))
+        self.create_template(name="Spaced", content="<e>\n  {{ index }}</e>",
+                             description="One indented event")
+        rule_context.context['EVENTS'] = rule_context.context['EVENTS'][:2]
+        step.parameters['Item Template'] = 'Spaced'
+        step.parameters['Compact'] = 'True'
+        self.assertEqual('<e>\n  0</e><e>\n  1</e>',
+                         step.execute(None, rule_context))
+        self.create_template(name="Wrapped", content="<doc>\n  <body>",
+                             description="An indented header")
+        step.parameters['Item Template'] = 'Item'
+        step.parameters['Header Template'] = 'Wrapped'
+        self.assertTrue(step.execute(None, rule_context).startswith(
+            '<doc><body><e i="0">'))
+        self.assertFalse(hasattr(step, 'aexecute'))
+        step.parameters['Footer Template'] = 'Missing'
+        with self.assertRaises(models.Template.DoesNotExist):
+            step.execute(None, rule_context)
+
+    def test_parallel_render_step(self):
+        # event templates can include the EPCPyYes package templates
+        self.create_template(
+            name="OE", content="<oe>{{ event.action }}"
+                               "{% include 'epcis/event_times.xml' %}</oe>",
+            description="Object event template")
+        self.create_template(name="Header", content="<doc>",
+                             description="The document header")
+        object_events = [template_events.ObjectEvent(
+            action='ADD' if i % 2 else 'OBSERVE', epc_list=[str(i)])
+            for i in range(50)]
+        aggregation_events = [template_events.AggregationEvent(
+            parent_id='2', child_epcs=['1'])]
+        rule_context = RuleContext('Test Rule', 'Test Task', context={
+            ContextKeys.OBJECT_EVENTS_KEY.value: object_events,
+            ContextKeys.AGGREGATION_EVENTS_KEY.value: aggregation_events
+        })
+        step = ChangeTemplatesStep(None, **{'Object Event Template': 'OE'})
+        step.info = lambda *args, **kwargs: None
+        step.execute(None, rule_context)
+        expected = '<doc>' + ''.join(
+            event.render() for event in object_events + aggregation_events)
+        self.assertIn('<oe>ADD<eventTime>', expected)
+        # the compiled templates may have left the cache since they were
+        # assigned to the events
+        template_cache.clear()
+        step = ParallelRenderStep(None, **{'Header Template': 'Header',
+                                           'Processes': '2',
+                                           'Chunk Size': '10',
+                                           'Context Key': 'OUTPUT'})
+        step.info = lambda *args, **kwargs: None
+        step.execute(None, rule_context)
+        path = rule_context.context['OUTPUT']
+        try:
+            with open(path) as f:
+                self.assertEqual(expected, f.read())
+        finally:
+            os.remove(path)
+        step.parameters['Processes'] = '1'
+        step.parameters['Stream To File'] = 'False'
+        step.execute(None, rule_context)
+        self.assertEqual(expected, rule_context.context['OUTPUT'])
+        object_events[3].template = Environment().from_string('{{ 1 }}')
+        step.parameters['Processes'] = '2'
+        step.error = mock.Mock()
+        with self.assertRaises(ValueError):
+            step.execute(None, rule_context)
+
+    def test_compact_template(self):
+        content = """<soapenv:Envelope>
+   <soapenv:Body>
+      <ids>
+      {% for serial_number in data %}
+         <id>{{ serial_number }}</id>
+      {% endfor %}
+      </ids>
+      <note>Keep {{ note }}
+      </note>
+   </soapenv:Body>
+</soapenv:Envelope>
+"""
+        template = self.create_template(name="Compact Template",
+                                        content=content,
+                                        description="A compact template")
+        context = {'data': ['1', '2'], 'note': '<a>\n  </a>'}
+        compacted = ('<soapenv:Envelope><soapenv:Body><ids><id>1</id>'
+                     '<id>2</id></ids><note>Keep &lt;a&gt;\n  &lt;/a&gt;\n'
+                     '      </note></soapenv:Body></soapenv:Envelope>')
+        self.assertIn('\n   <soapenv:Body>', template.render(context))
+        self.assertEqual(compacted, template.render(context, compact=True))
+        self.assertEqual(compacted, ''.join(template.render_stream(
+            context, compact=True)))
+        template.compact = True
+        template.save()
+        self.assertEqual(compacted, template.render(context))
+        self.assertIn('\n   <soapenv:Body>',
+                      template.render(context, compact=False))
+        step = TemplateStep(None, **{'Template Name': 'Compact Template',
+                                     'Compact': 'False'})
+        step.info = lambda *args, **kwargs: None
+        rule_context = RuleContext('Test Rule', 'Test Task')
+        self.assertIn('\n   <soapenv:Body>',
+                      step.execute(['1', '2'], rule_context))
+        step.parameters['Compact'] = 'True'
+        self.assertIn('<soapenv:Body><ids><id>1</id>',
+                      step.execute(['1', '2'], rule_context))
+        inline = self.create_template(
+            name="Inline Template",
+            content="<b>Total:</b> {% if x %}yes{% endif %}",
+            description="A compact template")
+        self.assertEqual('<b>Total:</b> yes',
+                         inline.render({'x': True}, compact=True))
+
+    def test_template_profiler(self):
+        self.create_template(name="Row", content="<r>{{ i * 2 }}</r>",
+                             description="A row")
+        template = self.create_template(
+            name="Profiled Template",
+            content="<doc>\n{% for i in data %}\n"
+                    "{% include 'Row' %}\n{% endfor %}\n</doc>",
+            description="A template to profile")
+        output, report = template.profile({'data': range(50)})
+        self.assertEqual(50, output.count('<r>'))
+        lines = {(row['template'], row['line']): row for row in report}
+        self.assertEqual('<r>{{ i * 2 }}</r>', lines['Row', 1]['source'])
+        self.assertEqual(50, lines['Row', 1]['hits'])
+        self.assertEqual("{% include 'Row' %}",
+                         lines['Profiled Template', 3]['source'])
+        self.assertTrue(all(row['seconds'] >= 0 for row in report))
+        step = TemplateStep(None, **{'Template Name': 'Profiled Template',
+                                     'Profile': 'True'})
+        step.info = mock.Mock()
+        step.execute(range(5), RuleContext('Test Rule', 'Test Task'))
+        messages = [call[0][1] for call in step.info.call_args_list
+                    if call[0][0].startswith('Template profile')]
+        self.assertIn('Row:1', messages[0])
+        client = self._get_api_client()
+        response = client.post(
+            reverse('templates-profile', args=[template.pk]),
+            {'data': [1, 2, 3]}, format='json')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, next(row['hits'] for row in
+                                 response.data['lines']
+                                 if row['template'] == 'Row'))
+        template.max_output_size = 20
+        template.save()
+        with self.assertRaises(RenderLimitExceeded):
+            template.profile({'data': range(50)})
+        response = client.post(
+            reverse('templates-profile', args=[template.pk]),
+            {'data': list(range(50))}, format='json')
+        self.assertEqual(400, response.status_code)
+
+    def test_template_step_stream_to_file(self):
+        self._create_test_template()
+        db_rule, db_task, db_step = self._create_rule()
+        db_task.save()
+        StepParameter.objects.create(step=db_step, name="Stream To File",
+                                     value="True")
+        StepParameter.objects.create(step=db_step, name="Context Key",
+                                     value="OUTPUT")
+        rule = CRule(db_rule, db_task)
+        rule.execute(['urn:epc:id:sgtin:1.1.1'])
+        path = rule.context.context['OUTPUT']
+        try:
+            with open(path) as f:
+                self.assertIn('<id>urn:epc:id:sgtin:1.1.1</id>', f.read())
+        finally:
+            os.remove(path)
+
+    def test_template_step_compress_output(self):
+        template = self.create_template(
+            name="Compressed Template",
+            content="{% for i in data %}<id>{{ i }}</id>{% endfor %}",
+            description="A compressed template")
+        data = list(range(20000))
+        expected = template.render({'data': data})
+        rule_context = RuleContext('Test Rule', 'Test Task')
+        step = TemplateStep(None, **{'Template Name': 'Compressed Template',
+                                     'Compress Output': 'gzip'})
+        step.info = lambda *args, **kwargs: None
+        ret = step.execute(data, rule_context)
+        self.assertIsInstance(ret, bytes)
+        self.assertEqual(expected, gzip.decompress(ret).decode('utf-8'))
+        step.parameters.update({'Compress Output': 'zlib',
+                                'Stream To File': 'True'})
+        path = step.execute(data, rule_context)
+        try:
+            self.assertTrue(path.endswith('.zz'))
+            with open(path, 'rb') as f:
+                self.assertEqual(expected,
+                                 zlib.decompress(f.read()).decode('utf-8'))
+        finally:
+            os.remove(path)
+        step.parameters['Compress Output'] = 'lzma'
+        with self.assertRaises(ValueError):
+            step.execute(data, rule_context)
+
+    def test_include_and_extend_templates(self):
+        header = self.create_template(name="Header",
+                                      content="<header>{{ value }}</header>",
+                                      description="A shared header")
+        self.create_template(name="Base",
+                             content="<doc>{% block body %}{% endblock %}"
+                                     "</doc>",
+                             description="A base template")
+        template = self.create_template(
+            name="Document",
+            content="{% extends 'Base' %}{% block body %}"
+                    "{% include 'Header' %}{% endblock %}",
+            description="A document template")
+        self.assertEqual('<doc><header>1</header></doc>',
+                         template.render({'value': 1}))
+        header.content = "<h>{{ value }}</h>"
+        header.save()
+        self.assertEqual('<doc><h>1</h></doc>',
+                         template.render({'value': 1}))
+        header = models.Template.objects.get(name="Header")
+        header.name = "Header2"
+        header.save()
+        with self.assertRaises(TemplateNotFound):
+            template.render({'value': 1})
+
+    def test_dependency_graph(self):
+        header = self.create_template(name="Header",
+                                      content="<header>{{ value }}</header>",
+                                      description="A shared header")
+        self.create_template(name="Base",
+                             content="<doc>{% include 'Header' %}"
+                                     "{% block body %}{% endblock %}</doc>",
+                             description="A base template")
+        document = self.create_template(
+            name="Document",
+            content="{% extends 'Base' %}{% block body %}{% endblock %}",
+            description="A document template")
+        other = self.create_template(name="Other", content="<o/>",
+                                     description="An unrelated template")
+        self.assertEqual(
+            {'Header'}, set(models.TemplateDependency.objects.filter(
+                template__name='Base').values_list(
+                'referenced_name', flat=True)))
+        self.assertEqual({'Base', 'Document'}, get_dependents('Header'))
+        for template in (document, other):
+            template.render({'value': 1})
+        header.content = "<h>{{ value }}</h>"
+        header.save()
+        self.assertNotIn('Document', template_cache)
+        self.assertIn('Other', template_cache)
+        self.assertEqual('<doc><h>1</h></doc>', document.render({'value': 1}))
+        document.content = "<doc/>"
+        document.save()
+        self.assertEqual({'Base'}, get_dependents('Header'))
+        client = self._get_api_client()
+        response = client.get(reverse('template-dependencies-list'),
+                              {'referenced_name': 'Header'})
+        self.assertEqual(['Base'], [edge['template_name']
+                                    for edge in response.data])
+        response = client.get(reverse('templates-dependents',
+                                      args=[header.pk]))
+        self.assertEqual(['Base'], response.data['dependents'])
+
+    def test_generation_watcher(self):
+        self.create_template(name="Header", content="<h>1</h>",
+                             description="A shared header")
+        document = self.create_template(
+            name="Document", content="<doc>{% include 'Header' %}</doc>",
+            description="A document template")
+        other = self.create_template(name="Other", content="<o/>",
+                                     description="An unrelated template")
+        watcher = GenerationWatcher(interval=60)
+        watcher.check()
+        self.assertEqual(get_generation(), watcher.generation)
+        self.assertEqual('<doc><h>1</h></doc>', document.render({}))
+        other.render({})
+        # change and delete templates the way another process would,
+        # without sending signals to this one
+        models.Template.objects.filter(name='Header').update(
+            content="<h>2</h>", generation=next_generation())
+        self.assertEqual('<doc><h>1</h></doc>', document.render({}))
+        watcher.check()
+        self.assertEqual('<doc><h>1</h></doc>', document.render({}))
+        watcher.checked = None
+        watcher.check()
+        self.assertEqual('<doc><h>2</h></doc>', document.render({}))
+        self.assertIn('Other', template_cache)
+        models.Template.objects.filter(name='Other')._raw_delete('default')
+        next_generation()
+        watcher.checked = None
+        watcher.check()
+        self.assertNotIn('Other', template_cache)
+
+    def test_include_missing_template(self):
+        template = self.create_template(name="Document",
+                                        content="{% include 'Missing' %}",
+                                        description="A document template")
+        with self.assertRaises(TemplateNotFound):
+            template.render({})
+
+    def test_render_metrics(self):
+        render_metrics.reset()
+        template = self.create_template(name="Measured Template",
+                                        content="<a>{{ value }}</a>",
+                                        description="A measured template")
+        template.render({'value': 1})
+        template.render({'value': 2})
+        ''.join(template.render_stream({'value': 3}))
+        render_metrics.flush()
+        metric = models.TemplateMetric.objects.get(
+            template_name="Measured Template")
+        self.assertEqual(3, metric.calls)
+        self.assertEqual(1, metric.cache_misses)
+        self.assertEqual(2, metric.cache_hits)
+        self.assertEqual(24, metric.output_size)
+        self.assertEqual(8, metric.max_output_size)
+        user = User.objects.create_user(username='metrics', password='pass')
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.get(
+            reverse('template-metrics-list'))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, response.data[0]['calls'])
+        self.assertIsNotNone(
+            response.data[0]['render_time_percentiles']['p50'])
+
+    def test_describe_output(self):
+        step = TemplateStep(None, **{'Preview Length': '5'})
+        self.assertEqual('(10 characters): 01234...',
+                         step.describe_output('0123456789'))
+        step = TemplateStep(None, **{'Preview Length': '0'})
+        self.assertIn('sha1', step.describe_output('0123456789'))
+
+    def test_render_many(self):
+        template = self.create_template(name="Batch Template",
+                                        content="<a>{{ value }}</a>",
+                                        description="A batch template")
+        contexts = [{'value': i} for i in range(250)]
+        expected = ['<a>%s</a>' % i for i in range(250)]
+        self.assertEqual(expected, list(template.render_many(contexts)))
+        self.assertEqual(expected, list(template.render_many(
+            iter(contexts), processes=2, chunk_size=20)))
+        template.max_output_size = 8
+        template.save()
+        with self.assertRaises(RenderLimitExceeded):
+            list(template.render_many([{'value': 10}]))
+        with self.assertRaises(RenderLimitExceeded):
+            list(template.render_many(contexts, processes=2, chunk_size=20))
+
+    def test_render_endpoint(self):
+        template = self.create_template(name="Batch Template",
+                                        content="<a>{{ value }}</a>",
+                                        description="A batch template")
+        user = User.objects.create_superuser(username='render',
+                                             password='pass',
+                                             email='render@example.com')
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post(
+            reverse('templates-render', args=[template.pk]),
+            data=b'{"value": "<1>"}\n\n{"value": 2}\n',
+            content_type='application/x-ndjson'
+        )
+        self.assertEqual(200, response.status_code)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([{'output': '<a>&lt;1&gt;</a>'},
+                          {'output': '<a>2</a>'}],
+                         [json.loads(line) for line in lines])
+        template.max_output_size = 8
+        template.save()
+        response = client.post(
+            reverse('templates-render', args=[template.pk]),
+            data=b'{"value": 1}\n{"value": 10}\n',
+            content_type='application/x-ndjson'
+        )
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual({'output': '<a>1</a>'}, json.loads(lines[0]))
+        self.assertIn('error', json.loads(lines[1]))
+
+    def test_change_templates_step(self):
+        self.create_template(name="OE", content="<oe>{{ event.action }}</oe>",
+                             description="Object event template")
+        self.create_template(name="AE", content="<ae>{{ event.action }}</ae>",
+                             description="Aggregation event template")
+        self.create_template(name="TE", content="<te>{{ event.action }}</te>",
+                             description="Transaction event template")
+        object_events = [template_events.ObjectEvent(epc_list=['1'])
+                         for i in range(3)]
+        aggregation_events = [template_events.AggregationEvent(
+            parent_id='2', child_epcs=['1'])]
+        transaction_events = [template_events.TransactionEvent(
+            epc_list=['1'])]
+        rule_context = RuleContext('Test Rule', 'Test Task', context={
+            ContextKeys.OBJECT_EVENTS_KEY.value: object_events,
+            ContextKeys.AGGREGATION_EVENTS_KEY.value: aggregation_events,
+            ContextKeys.FILTERED_EVENTS_KEY.value:
+                object_events + transaction_events
+        })
+        db_rule, db_task, db_step = self._create_rule()
+        db_task.save()
+        step = ChangeTemplatesStep(db_task, **{
+            'Object Event Template': 'OE',
+            'Aggregation Event Template': 'AE',
+            'Transaction Event Template': 'TE'
+        })
+        with CaptureQueriesContext(connection) as queries:
+            step.execute(None, rule_context)
+        template_queries = [query for query in queries.captured_queries
+                            if 'quartet_templates_template' in query['sql']]
+        self.assertEqual(1, len(template_queries))
+        self.assertIs(object_events[0].template, object_events[2].template)
+        self.assertEqual('<oe>ADD</oe>', object_events[0].render())
+        self.assertEqual('<ae>ADD</ae>', aggregation_events[0].render())
+        self.assertEqual('<te>ADD</te>', transaction_events[0].render())
+
+    def test_rule_template_prefetch(self):
+        self._create_test_template()
+        self.create_template(name="OE", content="<oe>{{ event.action }}</oe>",
+                             description="An object event template")
+        db_rule, db_task, db_step = self._create_rule()
+        db_task.save()
+        change_step = Step.objects.create(
+            name='change templates', description='Change templates.',
+            order=2, rule=db_rule,
+            step_class='quartet_templates.steps.ChangeTemplatesStep')
+        StepParameter.objects.create(step=change_step,
+                                     name='Object Event Template', value='OE')
+        object_events = [template_events.ObjectEvent(epc_list=['1'])]
+        rule = CRule(db_rule, db_task)
+        rule.context.context[ContextKeys.OBJECT_EVENTS_KEY.value] = \
+            object_events
+        with CaptureQueriesContext(connection) as queries:
+            rule.execute(['urn:epc:id:sgtin:1.1.1'])
+        template_queries = [
+            query for query in queries.captured_queries
+            if 'FROM "quartet_templates_template"' in query['sql']]
+        self.assertEqual(1, len(template_queries))
+        self.assertEqual({'Test Template', 'OE'},
+                         set(rule.context.context[TEMPLATES_CONTEXT_KEY]))
+        self.assertIn('<id>urn:epc:id:sgtin:1.1.1</id>', rule.data)
+        self.assertEqual('<oe>ADD</oe>', object_events[0].render())
+
+    async def test_arender(self):
+        await models.Template.objects.acreate(
+            name="Header", content="<header>{{ value }}</header>",
+            description="A shared header")
+        template = await models.Template.objects.acreate(
+            name="Async Template",
+            content="<doc>{% include 'Header' %}{{ value }}</doc>",
+            description="An async template")
+        self.assertEqual('<doc><header>&lt;1&gt;</header>&lt;1&gt;</doc>',
+                         await template.arender({'value': '<1>'}))
+        self.assertEqual('<doc><header><1></header><1></doc>',
+                         await template.arender({'value': '<1>'},
+                                                autoescape=False))
+
+    async def test_template_step_aexecute(self):
+        await models.Template.objects.acreate(
+            name="Test Template", description="A test template",
+            content=self._get_file_data())
+        step = TemplateStep(None, **{'Template Name': 'Test Template',
+                                     'Context Key': 'OUTPUT'})
+        step.info = lambda *args, **kwargs: None
+        rule_context = RuleContext('Test Rule', 'Test Task')
+        data = await step.aexecute(['urn:epc:id:sgtin:1.1.1'], rule_context)
+        self.assertEqual(['urn:epc:id:sgtin:1.1.1'], data)
+        self.assertIn('<id>urn:epc:id:sgtin:1.1.1</id>',
+                      rule_context.context['OUTPUT'])
+        self.assertIn('Test Template',
+                      rule_context.context[TEMPLATES_CONTEXT_KEY])
+        messages = []
+        step.info = lambda message, *args: messages.append(message)
+        step.parameters['Profile'] = 'True'
+        await step.aexecute(['urn:epc:id:sgtin:1.1.1'], rule_context)
+        self.assertTrue(any(message.startswith('Profiling is not supported')
+                            for message in messages))
+        step.parameters['Template Name'] = 'Missing'
+        with self.assertRaises(models.Template.DoesNotExist):
+            await step.aexecute(['urn:epc:id:sgtin:1.1.1'], rule_context)
+
+    def test_compile_quartet_templates(self):
+        template = self.create_template(name="Compiled Template",
+                                        content="<a>{{ value }}</a>",
+                                        description="A compiled template")
+        with tempfile.TemporaryDirectory() as directory:
+            call_command('compile_quartet_templates', target=directory,
+                         stdout=io.StringIO())
+            precompiled = PrecompiledTemplates(directory)
+            environment = get_environment(autoescape=False)
+            compiled = precompiled.load(environment, template.name,
+                                        content_hash(template.content))
+            self.assertEqual('<a><b></a>', compiled.render(value='<b>'))
+            self.assertIsNone(precompiled.load(environment, template.name,
+                                               content_hash('changed')))
+            self.assertIsNone(precompiled.load(environment, 'Missing',
+                                               content_hash('missing')))
+        compact = self.create_template(name="Compact Compiled",
+                                       content="<a>\n  <b/>\n</a>",
+                                       description="A compact template")
+        compact.compact = True
+        compact.save()
+        with tempfile.TemporaryDirectory() as directory:
+            call_command('compile_quartet_templates', target=directory,
+                         stdout=io.StringIO())
+            precompiled = PrecompiledTemplates(directory)
+            checksum = content_hash(compact.content)
+            self.assertIsNone(precompiled.load(
+                get_environment(), compact.name, checksum))
+            compiled = precompiled.load(get_environment(compact=True),
+                                        compact.name, checksum)
+            self.assertEqual('<a><b/></a>', compiled.render())
+
+    def test_warm_up(self):
+        self.create_template(name="Warm Template", content="{{ value }}",
+                             description="A warm template")
+        template_cache.invalidate("Warm Template")
+        self.assertEqual(1, warm_up())
+        self.assertIn("Warm Template", template_cache)
+        for i in range(3):
+            self.create_template(name="Warm Template %s" % i,
+                                 content="{{ value }}",
+                                 description="A warm template")
+        template_cache.clear()
+        with mock.patch.object(template_cache, 'max_size', 4):
+            self.assertEqual(2, warm_up())
+        self.assertEqual(4, len(template_cache))
+
+    def test_content_hash(self):
+        template = self.create_template(name="Hashed Template",
+                                        content="{{ value }}",
+                                        description="A hashed template")
+        self.assertEqual(content_hash("{{ value }}"), template.content_hash)
+        with mock.patch('quartet_templates.models.content_hash',
+                        wraps=content_hash) as hashed, \
+                mock.patch('quartet_templates.cache.content_hash',
+                           wraps=content_hash) as cache_hashed:
+            for i in range(3):
+                template.render({'value': i})
+                template.get_variables()
+            self.assertEqual(0, hashed.call_count)
+            self.assertEqual(0, cache_hashed.call_count)
+            template.content = "{{ changed }}"
+            self.assertEqual(content_hash("{{ changed }}"),
+                             template.get_checksum())
+            self.assertEqual(1, hashed.call_count)
+        modified = template.modified
+        template.content = "{{ other }}"
+        template.save(update_fields=['content'])
+        template.refresh_from_db()
+        self.assertGreater(template.modified, modified)
+        self.assertEqual(content_hash("{{ other }}"), template.content_hash)
+
+    def test_conditional_get(self):
+        template = self.create_template(name="Synced Template",
+                                        content="{{ value }}",
+                                        description="A synced template")
+        client = self._get_api_client()
+        url = reverse('templates-detail', args=[template.pk])
+        response = client.get(url)
+        self.assertEqual(200, response.status_code)
+        etag = response['ETag']
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        template.content = "{{ other }}"
+        template.save()
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("{{ other }}", response.data['content'])
+        response = client.get(url, {'fields': 'name'})
+        response = client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(200, response.status_code)
+        self.assertIn('content', response.data)
+        list_url = reverse('templates-list')
+        response = client.get(list_url)
+        self.assertNotIn('Last-Modified', response)
+        etag = response['ETag']
+        response = client.get(list_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.create_template(name="Deleted Template", content="x",
+                             description="A deleted template")
+        response = client.get(list_url)
+        etag = response['ETag']
+        models.Template.objects.get(name="Deleted Template").delete()
+        response = client.get(list_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        response = client.get(
+            list_url, HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 60))
+        self.assertEqual(200, response.status_code)
+
+    def test_changed_since(self):
+        template = self.create_template(name="Synced Template",
+                                        content="{{ value }}",
+                                        description="A synced template")
+        client = self._get_api_client()
+        url = reverse('templates-list')
+        response = client.get(url, {'changed_since': '2000-01-01T00:00:00'})
+        self.assertEqual(1, len(response.data['results']))
+        response = client.get(url, {
+            'changed_since': template.modified.isoformat()})
+        self.assertEqual(0, len(response.data['results']))
+        response = client.get(url, {'changed_since': 'yesterday'})
+        self.assertEqual(400, response.status_code)
+
+    def test_list_templates(self):
+        for i in range(3):
+            self.create_template(name="Template %s" % i,
+                                 content="{{ value }}",
+                                 description="A listed template")
+        client = self._get_api_client()
+        url = reverse('templates-list')
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url, {'page_size': 2})
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'quartet_templates_template"."content"'
+                          in query['sql']])
+        self.assertEqual(['Template 0', 'Template 1'],
+                         [item['name'] for item in response.data['results']])
+        self.assertNotIn('content', response.data['results'][0])
+        response = client.get(response.data['next'])
+        self.assertEqual(['Template 2'],
+                         [item['name'] for item in response.data['results']])
+        response = client.get(url, {'fields': 'name,content'})
+        self.assertEqual({'name': 'Template 0', 'content': '{{ value }}'},
+                         response.data['results'][0])
+        template = models.Template.objects.get(name='Template 0')
+        response = client.get(reverse('templates-detail', args=[template.pk]),
+                              {'fields': 'id,name'})
+        self.assertEqual({'id': template.pk, 'name': 'Template 0'},
+                         response.data)
+        # the projection does not apply to creates and updates
+        response = client.post(url + '?fields=name', {
+            'name': 'Created', 'content': 'hello',
+            'description': 'A created template'}, format='json')
+        self.assertEqual(201, response.status_code)
+        self.assertEqual('hello', models.Template.objects.get(
+            name='Created').content)
+        response = client.patch(
+            reverse('templates-detail', args=[template.pk]) + '?fields=name',
+            {'content': 'patched'}, format='json')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('patched', models.Template.objects.get(
+            pk=template.pk).content)
+
+    def test_content_store(self):
+        content = '<doc>{{ value }}</doc>' + '<static/>' * 500
+        with self.settings(QUARTET_TEMPLATES_CONTENT_STORE=True):
+            first = self.create_template(name="First", content=content,
+                                         description="A large template")
+            self.create_template(name="Second", content=content,
+                                 description="A copy")
+            self.create_template(name="Small", content="<a/>",
+                                 description="A small template")
+            transfer.import_templates([{'name': 'Third',
+                                        'content': content}])
+        stored = models.TemplateContent.objects.get()
+        self.assertTrue(stored.compressed)
+        self.assertLess(len(stored.data), len(content))
+        self.assertEqual(3, models.Template.objects.filter(
+            content__startswith=storage.REFERENCE_PREFIX).count())
+        self.assertEqual('<a/>', models.Template.objects.filter(
+            name='Small').values_list('content', flat=True).get())
+        storage.content_cache.clear()
+        # the shared body is only loaded once
+        with self.assertNumQueries(3):
+            self.assertEqual(content, models.Template.objects.get(
+                name='First').content)
+            self.assertEqual(content, models.Template.objects.get(
+                name='Second').content)
+        self.assertTrue(first.render({'value': 1}).startswith('<doc>1'))
+        # a queryset update leaves content_hash stale, the new body must
+        # still survive pruning
+        changed = '<changed/>' * 500
+        with self.settings(QUARTET_TEMPLATES_CONTENT_STORE=True):
+            models.Template.objects.filter(name='First').update(
+                content=changed)
+        models.Template.objects.filter(name__in=['Second', 'Third']).delete()
+        self.assertEqual(1, storage.prune())
+        storage.content_cache.clear()
+        self.assertEqual(changed, models.Template.objects.get(
+            name='First').content)
+        self.assertEqual(2, models.Template.objects.count())
+        models.Template.objects.filter(name='First').delete()
+        call_command('prune_quartet_template_content', stdout=io.StringIO())
+        self.assertFalse(models.TemplateContent.objects.exists())
+
+    def test_export_import_ndjson(self):
+        self.create_template(name="One", content="1", description="First")
+        self.create_template(name="Two", content="2", description=None)
+        lines = list(transfer.export_ndjson())
+        self.assertEqual(2, len(lines))
+        models.Template.objects.filter(name="One").update(content="old")
+        models.Template.objects.filter(name="Two").delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            result = transfer.import_templates(
+                transfer.read_ndjson(lines), batch_size=1)
+        self.assertEqual({'created': 1, 'updated': 1}, result)
+        one = models.Template.objects.get(name="One")
+        self.assertEqual("1", one.content)
+        self.assertEqual(content_hash("1"), one.content_hash)
+        self.assertIsNone(models.Template.objects.get(name="Two").description)
+        models.Template.objects.filter(name="Two").update(
+            compact=True, max_output_size=10)
+        transfer.import_templates(transfer.read_ndjson(
+            list(transfer.export_ndjson())))
+        two = models.Template.objects.get(name="Two")
+        self.assertTrue(two.compact)
+        self.assertEqual(10, two.max_output_size)
+        self.assertIsNone(two.render_timeout)
+
+    def test_export_import_tar(self):
+        template = self.create_template(name="SBDH/Header",
+                                        content="<sbdh/>",
+                                        description="A header")
+        template.compact = True
+        template.render_timeout = 1.5
+        template.max_output_size = 1000
+        template.save()
+        archive = io.BytesIO(b''.join(transfer.export_tar()))
+        models.Template.objects.all().delete()
+        transfer.import_templates(transfer.read_tar(archive))
+        template = models.Template.objects.get(name="SBDH/Header")
+        self.assertEqual("<sbdh/>", template.content)
+        self.assertEqual("A header", template.description)
+        self.assertTrue(template.compact)
+        self.assertEqual(1.5, template.render_timeout)
+        self.assertEqual(1000, template.max_output_size)
+
+    def test_import_export_endpoints(self):
+        self.create_template(name="One", content="old", description="First")
+        client = self._get_api_client()
+        response = client.post(
+            reverse('templates-import'),
+            data=b'{"name": "One", "content": "1"}\n'
+                 b'{"name": "Two", "content": "2"}\n',
+            content_type='application/x-ndjson')
+        self.assertEqual({'created': 1, 'updated': 1}, response.data)
+        for data, message in [
+                (b'{"name": "Three", "content": "3"}\n\n{"name": "Four"}\n',
+                 'Line 3 has no content.'),
+                (b'{"content": "3"}\n', 'Line 1 has no name.'),
+                (json.dumps({'name': 'x' * 101, 'content': '3'}).encode(),
+                 'Line 1 has a name longer than 100 characters.'),
+                (b'{"name": \n', 'Line 1 is not valid JSON.'),
+                (b'{"name": "Three", "content": "3", "compact": "false"}',
+                 'Line 1 has a compact value that is not true or false.'),
+                (b'{"name": "Three", "content": "3", '
+                 b'"render_timeout": "abc"}',
+                 'Line 1 has a render_timeout that is not a number of '
+                 'seconds of 0 or more.'),
+                (b'{"name": "Three", "content": "3", "render_timeout": NaN}',
+                 'Line 1 has a render_timeout that is not a number of '
+                 'seconds of 0 or more.'),
+                (b'{"name": "Three", "content": "3", "max_output_size": -5}',
+                 'Line 1 has a max_output_size that is not a whole number '
+                 'of bytes from 0 to 2147483647.'),
+                (b'{"name": "Three", "content": "3", "max_output_size": 1.5}',
+                 'Line 1 has a max_output_size that is not a whole number '
+                 'of bytes from 0 to 2147483647.'),
+                (json.dumps({'name': 'Three', 'content': '3',
+                             'description': 'x' * 201}).encode(),
+                 'Line 1 has a description that is not a string of at most '
+                 '200 characters.')]:
+            response = client.post(reverse('templates-import'), data=data,
+                                   content_type='application/x-ndjson')
+            self.assertEqual(400, response.status_code)
+            self.assertEqual(message, response.data['error'])
+
+        def archive(data, **headers):
+            buffer = io.BytesIO()
+            with tarfile.open(fileobj=buffer, mode='w:gz',
+                              format=tarfile.PAX_FORMAT) as tar:
+                info = tarfile.TarInfo('Three')
+                info.size = len(data)
+                info.pax_headers.update(headers)
+                tar.addfile(info, io.BytesIO(data))
+            return buffer.getvalue()
+        for data, message in [
+                (archive(b'\xff'), 'Member Three is not UTF-8 encoded.'),
+                (archive(b'3', **{transfer.RENDER_TIMEOUT_HEADER: 'abc'}),
+                 'Member Three has an invalid quartet.render_timeout '
+                 'header.'),
+                (archive(b'3', **{transfer.MAX_OUTPUT_SIZE_HEADER: '-5'}),
+                 'Member Three has a max_output_size that is not a whole '
+                 'number of bytes from 0 to 2147483647.'),
+                (archive(b'3', **{transfer.COMPACT_HEADER: 'false'}),
+                 'Member Three has a quartet.compact header that is not 0 '
+                 'or 1.'),
+                (b'not a tar archive', None)]:
+            response = client.post(reverse('templates-import'), data=data,
+                                   content_type='application/gzip')
+            self.assertEqual(400, response.status_code)
+            if message:
+                self.assertEqual(message, response.data['error'])
+        self.assertFalse(models.Template.objects.filter(
+            name="Three").exists())
+        response = client.get(reverse('templates-export'))
+        records = [json.loads(line) for line in
+                   b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([('One', '1'), ('Two', '2')],
+                         [(r['name'], r['content']) for r in records])
+        response = client.get(reverse('templates-export'), {'archive': 'tar'})
+        archive = io.BytesIO(b''.join(response.streaming_content))
+        self.assertEqual(['One', 'Two'], [record['name'] for record in
+                                          transfer.read_tar(archive)])
+
+    def test_export_import_commands(self):
+        self.create_template(name="One", content="1", description="First")
+        with tempfile.TemporaryDirectory() as directory:
+            for file_name in ['templates.ndjson', 'templates.tar.gz']:
+                path = os.path.join(directory, file_name)
+                call_command('export_quartet_templates', path)
+                models.Template.objects.all().delete()
+                output = io.StringIO()
+                call_command('import_quartet_templates', path, stdout=output)
+                self.assertIn('Created 1 and updated 0', output.getvalue())
+                self.assertEqual(
+                    "1", models.Template.objects.get(name="One").content)
+
+    def _get_api_client(self):
+        user = User.objects.create_superuser(username='api',
+                                             password='pass',
+                                             email='api@example.com')
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
     def _create_rule(self):
         db_rule = Rule()
         db_rule.name = 'Test Rule'